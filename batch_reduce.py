@@ -0,0 +1,315 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Headless batch reduction of a whole directory (or glob) of spectrum files.
+Each file goes through load -> continuum -> line fits -> catalog on a pool of worker processes,
+and one catalog is written per object plus a merged summary of every line.
+
+Example:
+
+    >>> python batch_reduce.py "Example Object Files" --lines 4400 5007 --workers 4
+    >>> python batch_reduce.py "Example Object Files" --auto
+    >>> python batch_reduce.py "Sessions/J1246.npz" --auto --session "Sessions/J1246 reduced.npz"
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+
+# Each worker is single threaded on purpose, otherwise every process spins up a full BLAS thread pool
+# and N workers fight over the same cores. Has to be set before numpy is imported.
+for _var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+    os.environ.setdefault(_var, '1')
+
+import sys
+import glob
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import spectral_core
+import fit_cache
+import line_catalog
+import catalog_db
+import session
+import profiling
+# ----------------------------
+
+
+SUMMARY_NAME = 'Line Catalog Summary'
+# Objects per database transaction while results stream in
+DB_COMMIT_EVERY = 200
+
+
+def find_spectrum_files(targets):
+    '''
+    Expands each target into spectrum files.
+    A directory means every *_Object.csv inside it, anything else is treated as a glob pattern.
+    '''
+    files = []
+    for target in targets:
+        if os.path.isdir(target):
+            files.extend(glob.glob(os.path.join(target, '*_Object.csv')))
+        else:
+            files.extend(glob.glob(target))
+    return sorted(set(files))
+
+
+def find_session_objects(paths):
+    '''
+    Every object of each session file, as (path, index) sources for run_batch.
+    '''
+    return [(path, i) for path in paths for i in range(len(session.load_session(path)))]
+
+
+# One fit cache per worker process (and per cache directory), reused across every job it runs
+_caches = {}
+
+
+def _worker_cache(cache_dir):
+    if cache_dir is None:
+        return None
+    if cache_dir not in _caches:
+        _caches[cache_dir] = fit_cache.ResultCache(directory=cache_dir)
+    return _caches[cache_dir]
+
+
+# Session files a worker has opened (memory mapped, so each one is only a few small reads)
+_sessions = {}
+
+
+def _worker_session(path):
+    if path not in _sessions:
+        _sessions[path] = session.load_session(path)
+    return _sessions[path]
+
+
+# Set in pool workers, which hand their profiling events back with each result
+_in_worker = False
+
+
+def _init_worker(profile, profile_memory):
+    '''
+    Pool initializer: starts a fresh profiler in the worker if the parent is profiling
+    (a forked worker would otherwise inherit the parent's, events and all).
+    '''
+    global _in_worker
+    _in_worker = True
+    profiling.disable()
+    if profile:
+        profiling.enable(memory=profile_memory)
+
+
+def _reduce_one(job):
+    '''
+    Worker entry point. Never raises, so one bad file can't take down the pool.
+    The job's source is a spectrum file, or (session path, index) for an object of a session file, which is
+    reduced as it was saved: its current data, its continuum if it has one, and its lines kept alongside the new ones.
+    Returns (source, object_name, rows, errors, redshift_, cache_stats, events, state) where rows is a line_catalog.LINE_DTYPE
+    array, which pickles cheaply, redshift_ is the found redshift as a line of text ('' without auto_lines), cache_stats counts this job's fit cache hits and misses, events are
+    the profiling events recorded in a worker process (empty when not profiling or run in-process),
+    and state is the reduced session.SessionObject when keep_state is set (None otherwise).
+    '''
+    (source, line_wavelengths, output_dir, auto_lines, continuum_options, continuum_fit, cache_dir, realisations,
+     keep_state) = job
+    cache = _worker_cache(cache_dir)
+    before = cache.stats() if cache is not None else {}
+    state = None
+    redshift_ = ''
+    try:
+        if isinstance(source, tuple):
+            state = _worker_session(source[0])[source[1]]
+            filename = state.filename
+        else:
+            filename = source
+            if keep_state:
+                state = session.SessionObject.from_spectrum(spectral_core.load_spectrum(filename), filename)
+        object_name, lines, errors, z_result = spectral_core.reduce_spectrum(filename, line_wavelengths, output_dir, auto_lines,
+                                                                   continuum_options, continuum_fit, cache, realisations,
+                                                                   state=state)
+        rows = state.lines if state is not None else line_catalog.lines_to_rows(lines, object_name)
+        # Just the numbers: the whole cross-correlation isn't worth sending back
+        if z_result is not None:
+            redshift_ = z_result.describe() + (' - NOT USED' if z_result.problem else '')
+    except Exception:
+        object_name = state.name if state is not None else spectral_core.object_name_from_path(str(source))
+        errors = [traceback.format_exc()]
+        rows = np.zeros(0, dtype=line_catalog.LINE_DTYPE)
+        state = None
+    cache_stats = {name: count - before[name] for name, count in cache.stats().items()} if cache is not None else {}
+    events = profiling.take_events() if _in_worker else []
+    return source, object_name, rows, errors, redshift_, cache_stats, events, state if keep_state else None
+
+
+def shared_continua(files, continuum_options=None):
+    '''
+    Loads every file here and fits all the continua with spectral_core.define_continua, which solves
+    every spectrum on the same wavelength grid in one go. Files that fail to load get None, so the
+    worker loads them itself and reports the error.
+    '''
+    spectra, loaded = [], []
+    for i, filename in enumerate(files):
+        if not isinstance(filename, str):
+            continue  # session objects bring their own data, and usually their own continuum
+        try:
+            spectra.append(spectral_core.load_spectrum(filename))
+            loaded.append(i)
+        except Exception:
+            pass
+    continua = [None] * len(files)
+    for i, fit in zip(loaded, spectral_core.define_continua(spectra, **(continuum_options or {}))):
+        continua[i] = fit
+    return continua
+
+
+def run_batch(files, line_wavelengths=(), output_dir="./Line Catalogs/", workers=None, chunksize=None, auto_lines=False,
+              continuum_options=None, batch_continuum=False, cache_dir=None, db_path=None, realisations=0,
+              session_path=None):
+    '''
+    Reduces every file (or (session path, index) object, see find_session_objects) on a process pool, streaming each object's lines into the merged summary
+    (SUMMARY_NAME .csv and .cols in output_dir) as soon as they come back.
+    auto_lines finds each object's redshift and fits every expected line on top of line_wavelengths.
+    continuum_options (a dict) go to spectral_core.define_continuum for every object.
+    batch_continuum fits every continuum up front in this process with shared_continua,
+    and the workers only fit lines.
+    cache_dir turns on a fit_cache.ResultCache there, so a rerun only recomputes what its changes affect.
+    If profiling is on (profiling.enable, or QUASAR_PROFILE), the workers profile too and their events
+    are merged into this process's.
+    db_path also stores every object's lines in that catalog_db SQLite file (replacing earlier runs of the same object).
+    realisations > 0 gives every line Monte Carlo errors from that many noise realisations.
+    session_path also saves every object, with its continuum and lines, to that session file (session.py),
+    streamed in as results come back, so the GUI or a later run can pick up from there without refitting anything.
+    workers=1 runs everything in this process, which is handy for debugging.
+    Returns the list of per-file results in the same order as files; the rows are dropped from them once
+    written, so a whole survey's lines are never all held in memory at once.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    if batch_continuum:
+        with profiling.stage('shared_continua'):
+            continua = shared_continua(files, continuum_options)
+    else:
+        continua = [None] * len(files)
+    jobs = [(filename, tuple(line_wavelengths), output_dir, auto_lines, continuum_options, continuum_fit, cache_dir,
+             realisations, session_path is not None) for filename, continuum_fit in zip(files, continua)]
+    workers = workers or os.cpu_count() or 1
+
+    results = []
+    store = catalog_db.CatalogStore(db_path) if db_path is not None else None
+    snapshot = session.SessionWriter(session_path) if session_path is not None else None
+    with line_catalog.CatalogWriter(os.path.join(output_dir, SUMMARY_NAME)) as summary:
+        def collect(outcomes):
+            for filename, object_name, rows, errors, redshift_, cache_stats, events, state in outcomes:
+                profiling.add_events(events)
+                with profiling.stage('write_summary', object_name):
+                    summary.write(rows)
+                    if state is not None:
+                        snapshot.add(state)
+                    if store is not None:
+                        store.replace_object(object_name, rows, commit=False)
+                        if len(results) % DB_COMMIT_EVERY == 0:
+                            store.commit()
+                results.append((filename, object_name, len(rows), errors, redshift_, cache_stats))
+
+        if workers == 1:
+            collect(_reduce_one(job) for job in jobs)
+        else:
+            # Hand out work in a few chunks per worker so the per-task IPC doesn't dominate small files
+            if chunksize is None:
+                chunksize = max(1, len(jobs) // (workers * 4))
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(profiling.enabled(), profiling.tracing_memory())) as pool:
+                collect(pool.map(_reduce_one, jobs, chunksize=chunksize))
+    if store is not None:
+        store.close()
+    if snapshot is not None:
+        with profiling.stage('write_session'):
+            snapshot.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reduce a directory of quasar spectra without the GUI.")
+    parser.add_argument('targets', nargs='+',
+                        help="directories of *_Object.csv files, glob patterns, or session files (.npz) to carry on from")
+    parser.add_argument('--lines', nargs='*', type=float, default=[],
+                        help="observed wavelengths (Angstroms) of lines to fit in every object")
+    parser.add_argument('--auto', action='store_true',
+                        help="find each object's redshift and fit every expected emission line automatically")
+    parser.add_argument('--window', type=float, default=200., help="continuum running median window (Angstroms)")
+    parser.add_argument('--order', type=int, default=5, help="final continuum polynomial order")
+    parser.add_argument('--clip', type=float, nargs=2, default=[2.5, 3.], metavar=('UPPER', 'LOWER'),
+                        help="continuum sigma clipping thresholds above and below the fit")
+    parser.add_argument('--mc', type=int, default=0, metavar='N',
+                        help="Monte Carlo errors from N noise realisations per line (default: fit covariance errors)")
+    parser.add_argument('--batch-continuum', action='store_true',
+                        help="fit all continua together up front (spectra sharing a wavelength grid are solved at once)")
+    parser.add_argument('--cache-dir', default=fit_cache.CACHE_DIR_NAME,
+                        help="where continuum and line fits are cached between runs")
+    parser.add_argument('--no-cache', action='store_true', help="recompute every fit and don't store them")
+    parser.add_argument('--db', default=None,
+                        help=f"SQLite catalog to store the lines in (default: {catalog_db.DB_NAME} in the output directory)")
+    parser.add_argument('--no-db', action='store_true', help="don't write the SQLite catalog")
+    parser.add_argument('--session', metavar='SESSION.npz',
+                        help="also save every object's spectrum, continuum and lines to this session file")
+    parser.add_argument('--output', default="./Line Catalogs/", help="directory for the line catalogs")
+    parser.add_argument('--workers', type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument('--profile', metavar='TRACE.json',
+                        help="time every stage, print a summary and write a Chrome trace (chrome://tracing) here")
+    parser.add_argument('--profile-memory', action='store_true', help="with --profile, track allocations too (slower)")
+    args = parser.parse_args(argv)
+
+    sessions = [target for target in args.targets if session.is_session(target)]
+    files = find_spectrum_files([target for target in args.targets if target not in sessions])
+    files += find_session_objects(sessions)
+    if not files:
+        print("No spectrum files found!")
+        return 1
+
+    # Session objects can just be passed through, lines and all, e.g. into a catalog or another session
+    if not args.lines and not args.auto and not sessions:
+        print("Nothing to fit: give --lines and/or --auto")
+        return 1
+
+    if args.profile:
+        profiling.enable(memory=args.profile_memory)
+
+    continuum_options = {'window': args.window, 'final_order': args.order,
+                         'upper_sigma': args.clip[0], 'lower_sigma': args.clip[1]}
+    results = run_batch(files, args.lines, args.output, args.workers, auto_lines=args.auto,
+                        continuum_options=continuum_options, batch_continuum=args.batch_continuum,
+                        cache_dir=None if args.no_cache else args.cache_dir, realisations=args.mc,
+                        session_path=args.session,
+                        db_path=None if args.no_db else args.db or os.path.join(args.output, catalog_db.DB_NAME))
+
+    n_lines = sum(n for _, _, n, *_ in results)
+    if args.session:
+        print(f"Session -> {args.session}")
+    print(f"Reduced {len(results)} objects, {n_lines} lines -> {os.path.join(args.output, SUMMARY_NAME)}.csv")
+    if not args.no_cache:
+        totals = {}
+        for *_, cache_stats in results:
+            for name, count in cache_stats.items():
+                totals[name] = totals.get(name, 0) + count
+        print(f"Fit cache: {totals.get('hits', 0)} memory hits, {totals.get('disk_hits', 0)} disk hits, "
+              f"{totals.get('misses', 0)} misses, {totals.get('evictions', 0)} evicted")
+    if args.auto:
+        for _, object_name, _, _, redshift_, _ in results:
+            print(f"{object_name}: {redshift_}")
+    for _, _, _, errors, _, _ in results:
+        for error in errors:
+            print(error)
+    if args.profile:
+        events = profiling.disable()
+        print(profiling.summary_table(events))
+        profiling.write_trace(args.profile, events)
+        print(f"Profile trace -> {args.profile}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
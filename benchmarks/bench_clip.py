@@ -0,0 +1,81 @@
+'''
+Spike clipping (noise.clip_spikes) on synthetic quasars with cosmic rays added, and a check that it leaves lines alone.
+
+    >>> python benchmarks/bench_clip.py --pixels 4000 100000 1000000
+
+Each spectrum has 1 - 3 pixel spikes scattered over it, away from a narrow (500 km/s FWHM) [O III] 5007 line at
+S/N 50 on the usual 1.5 Angstrom grid. The noise is smoothed over three pixels, like a resampled spectrum's, which is
+where the pixel to pixel noise map comes out low. Reported: how many spike pixels were missed, how many other
+pixels changed, and how much the narrow line changed (it should be untouched). Exits with 1 if the line changed.
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import noise
+import redshift
+
+STEP = 1.5
+SNR = 50.
+FWHM_KMS = 500.
+
+
+def make_spectrum(n_pixels, n_spikes, seed=0):
+    '''
+    Flat continuum of 1, the narrow line near the middle, correlated noise and spikes.
+    Returns (wavelengths, clean fluxes, fluxes with spikes, spike mask, line mask).
+    '''
+    rng = np.random.default_rng(seed)
+    wavelengths = 3800. + STEP * np.arange(n_pixels)
+    # The line sits in the middle of the spectrum with its 500 km/s width at 5007 Angstroms (about 5.5 pixels FWHM)
+    rest = redshift.QUASAR_LINES['[O III] 5007'][0]
+    centre = wavelengths[n_pixels // 2]
+    sigma = rest * FWHM_KMS / redshift.C_KMS / 2.3548
+    line = np.exp(-0.5 * ((wavelengths - centre) / sigma) ** 2)
+    white = rng.standard_normal(n_pixels + 2)
+    correlated = np.convolve(white, [0.25, 0.5, 0.25], mode='valid')
+    clean = 1. + line + correlated / correlated.std() / SNR
+
+    fluxes = clean.copy()
+    spikes = np.zeros(n_pixels, dtype=bool)
+    away = np.flatnonzero(np.abs(wavelengths - centre) > 10 * sigma)
+    for start in rng.choice(away[:-3], n_spikes, replace=False):
+        width = rng.integers(1, 4)
+        fluxes[start:start + width] += rng.uniform(0.2, 2.)
+        spikes[start:start + width] = True
+    return wavelengths, clean, fluxes, spikes, np.abs(wavelengths - centre) < 5 * sigma
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pixels', type=int, nargs='+', default=[4000, 100000, 1000000])
+    parser.add_argument('--spikes', type=float, default=0.01, help="fraction of pixels that start a spike")
+    parser.add_argument('--sigma', type=float, default=5.)
+    parser.add_argument('--max-width', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print(f"{'pixels':>9} {'time':>10} {'spike px':>9} {'missed':>7} {'others changed':>15} {'line peak change':>17}")
+    status = 0
+    for n in args.pixels:
+        wavelengths, clean, fluxes, spikes, line = make_spectrum(n, max(1, int(n * args.spikes)))
+        t0 = time.perf_counter()
+        _, clipped = noise.clip_spikes(wavelengths, fluxes, sigma=args.sigma, max_width=args.max_width)
+        elapsed = time.perf_counter() - t0
+
+        missed = np.sum(spikes & (np.abs(clipped - clean) > 5. / SNR))
+        others = np.sum(~spikes & (clipped != fluxes))
+        peak_change = (clipped[line].max() - fluxes[line].max()) / (fluxes[line].max() - 1.)
+        if np.any(clipped[line] != fluxes[line]):
+            status = 1
+        print(f'{n:9d} {elapsed * 1e3:8.1f} ms {spikes.sum():9d} {missed:7d} {others:15d} {peak_change:16.1%}')
+    print('narrow line unchanged' if status == 0 else 'NARROW LINE WAS CLIPPED')
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+'''
+Batched continuum fitting (continuum.fit_continua) vs. one continuum.fit_continuum call per spectrum.
+
+    >>> python benchmarks/bench_continuum.py --spectra 1000
+
+The spectra are the bundled objects sharing the most common grid (3400 Angstroms + 1.5 Angstrom steps),
+repeated with a little extra noise until there are enough of them.
+'''
+
+import os
+import sys
+import glob
+import time
+import argparse
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import continuum
+import spectral_core
+import spectrum
+
+
+def make_spectra(m, seed=0):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Example Object Files')
+    spectra = [spectral_core.load_spectrum(f, cache=False) for f in sorted(glob.glob(os.path.join(root, '*_Object.csv')))]
+    grid, _ = Counter(spectrum.grid_key(s.wavelengths) for s in spectra).most_common(1)[0]
+    fluxes = np.stack([s.fluxes for s in spectra if spectrum.grid_key(s.wavelengths) == grid])
+    rng = np.random.default_rng(seed)
+    fluxes = np.resize(fluxes, (m, fluxes.shape[1]))
+    return grid, fluxes * (1 + rng.normal(0, 0.05, fluxes.shape))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--spectra', type=int, default=1000)
+    parser.add_argument('--loop', type=int, default=100, help="how many spectra to time the per-spectrum loop on")
+    args = parser.parse_args(argv)
+
+    wavelengths, fluxes = make_spectra(args.spectra)
+
+    t0 = time.perf_counter()
+    fits = continuum.fit_continua(wavelengths, fluxes)
+    t_batch = time.perf_counter() - t0
+
+    n_loop = min(args.loop, args.spectra)
+    t0 = time.perf_counter()
+    for row in fluxes[:n_loop]:
+        continuum.fit_continuum(wavelengths, row)
+    t_loop = (time.perf_counter() - t0) * args.spectra / n_loop
+
+    print(f'{args.spectra} spectra of {fluxes.shape[1]} pixels')
+    print(f'  fit_continuum loop : {t_loop:8.3f} s  (extrapolated from {n_loop})')
+    print(f'  fit_continua       : {t_batch:8.3f} s  ({sum(not f.converged for f in fits)} not converged, {t_loop / t_batch:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
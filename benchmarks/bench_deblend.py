@@ -0,0 +1,80 @@
+'''
+Deblending K Gaussians at once (deblend.fit_blend, analytic banded Jacobian) vs. scipy curve_fit on the
+same sum of K Gaussians (dense finite difference Jacobian, 3K parameters, no tying).
+
+    >>> python benchmarks/bench_deblend.py --components 2 4 8 16 32 64
+
+Lines are 20 Angstroms apart with sigma 3 Angstroms on the usual 1.5 Angstrom grid, so neighbours overlap,
+and both fitters start from the same guesses.
+'''
+
+import os
+import sys
+import time
+import argparse
+import warnings
+
+import numpy as np
+from scipy.optimize import curve_fit, OptimizeWarning
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import deblend
+import redshift
+
+SPACING = 20.
+SIGMA = 3.
+
+
+def make_blend(k, seed=0):
+    rng = np.random.default_rng(seed)
+    centres = 5000. + SPACING * np.arange(k)
+    x = np.arange(centres[0] - 60., centres[-1] + 60., 1.5)
+    amplitude = rng.uniform(0.5, 1.5, k)
+    y = (amplitude[:, None] * np.exp(-0.5 * ((x - centres[:, None]) / SIGMA) ** 2)).sum(axis=0)
+    y += rng.normal(0, 0.02, len(x))
+    return x, y, centres, amplitude
+
+
+def sum_of_gaussians(x, *p):
+    p = np.reshape(p, (-1, 3))
+    return (p[:, 0:1] * np.exp(-0.5 * ((x - p[:, 1:2]) / p[:, 2:3]) ** 2)).sum(axis=0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--components', type=int, nargs='*', default=[2, 4, 8, 16, 32, 64])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    deblend.fit_blend(*make_blend(2)[:2], [deblend.Component('a', 5000.), deblend.Component('b', 5020.)])  # imports scipy
+    fwhm_kms = SIGMA * 2.3548 / 5000. * redshift.C_KMS
+    print(f'  {"K":>4s} {"pixels":>7s} {"curve_fit":>12s} {"fit_blend":>12s} {"speedup":>8s}  max |amplitude error|')
+    for k in args.components:
+        x, y, centres, amplitude = make_blend(k)
+        components = [deblend.Component(f'L{i}', c, fwhm_kms=fwhm_kms) for i, c in enumerate(centres)]
+
+        times = []
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            fit = deblend.fit_blend(x, y, components, baseline=False)
+            times.append(time.perf_counter() - t0)
+        t_blend = min(times)
+
+        p0 = np.column_stack([np.interp(centres, x, y), centres, np.full(k, SIGMA * 1.2)]).ravel()
+        times = []
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', OptimizeWarning)
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                try:
+                    curve_fit(sum_of_gaussians, x, y, p0=p0)
+                except RuntimeError:
+                    pass
+                times.append(time.perf_counter() - t0)
+        t_dense = min(times)
+        error = np.abs(fit.params[:, 0] - amplitude).max()
+        print(f'  {k:4d} {len(x):7d} {t_dense * 1e3:9.1f} ms {t_blend * 1e3:9.1f} ms {t_dense / t_blend:7.1f}x  {error:.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+'''
+Batched Levenberg-Marquardt Gaussian fitter vs. one scipy curve_fit call per line.
+
+    >>> python benchmarks/bench_gaussian_fit.py --lines 5000
+
+The windows are 100 pixels on the usual 1.5 Angstrom grid, like fit_spectral_line's fixed windows (linewidth=50),
+and curve_fit gets the same stddev=1.0 starting guess the GUI used to give it.
+'''
+
+import os
+import sys
+import time
+import argparse
+import warnings
+
+import numpy as np
+from scipy.optimize import curve_fit, OptimizeWarning
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import gaussian_fit
+
+
+def make_windows(m, k=100, seed=0):
+    rng = np.random.default_rng(seed)
+    x = 3400. + rng.uniform(0, 5000, (m, 1)) + 1.5 * np.arange(k)[None, :]
+    amplitude = rng.uniform(1e-17, 1e-15, m)
+    mean = x[:, k // 2] + rng.normal(0, 5, m)
+    stddev = rng.uniform(2, 30, m)
+    y = gaussian_fit.gaussian(x, amplitude[:, None], mean[:, None], stddev[:, None])
+    y += rng.normal(0, 1, (m, k)) * 0.05 * amplitude[:, None]
+    return x, y
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    x, y = make_windows(args.lines)
+
+    t0 = time.perf_counter()
+    result = gaussian_fit.fit_gaussians(x, y)
+    t_batch = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    failed = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', OptimizeWarning)
+        for xi, yi in zip(x, y):
+            try:
+                curve_fit(gaussian_fit.gaussian, xi, yi, p0=[yi.max(), xi[np.argmax(yi)], 1.0])
+            except RuntimeError:
+                failed += 1
+    t_loop = time.perf_counter() - t0
+
+    print(f'{args.lines} lines')
+    print(f'  curve_fit loop : {t_loop:8.3f} s  ({failed} failed)')
+    print(f'  batched LM     : {t_batch:8.3f} s  ({np.sum(~result.converged)} not converged, {t_loop / t_batch:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Import (cold start) time of the project's modules, measured with python -X importtime in fresh interpreters.
+
+    >>> python benchmarks/bench_import.py
+    >>> python benchmarks/bench_import.py --modules interactive_plot --top 15
+
+For each module it reports the median wall time of a new interpreter importing it (what a batch worker
+pays when it is spawned, and most of what the GUI pays before its window appears), the cumulative import
+time -X importtime attributes to the module, and the slowest imports underneath it.
+'python -c pass' is timed as the baseline interpreter start.
+'''
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MODULES = ['spectral_core', 'batch_reduce', 'redshift', 'catalog_db', 'interactive_plot', 'main_window']
+
+
+def run(code):
+    '''
+    Runs code in a fresh interpreter with -X importtime; returns (wall seconds, stderr).
+    '''
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'))
+    t0 = time.perf_counter()
+    done = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, env=env,
+                          capture_output=True, text=True, timeout=300)
+    elapsed = time.perf_counter() - t0
+    if done.returncode != 0:
+        raise RuntimeError(f'{code!r} failed:\n{done.stderr[-2000:]}')
+    return elapsed, done.stderr
+
+
+def parse_importtime(stderr):
+    '''
+    [(module, self us, cumulative us, depth)] from -X importtime output.
+    '''
+    entries = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        entries.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return entries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters per module (median reported)")
+    parser.add_argument('--top', type=int, default=5, help="slowest imports to list per module")
+    args = parser.parse_args(argv)
+
+    baseline = np.median([run('pass')[0] for _ in range(args.repeat)])
+    print(f'interpreter start (python -c pass): {baseline * 1e3:7.1f} ms')
+
+    for module in args.modules:
+        walls, cumulative = [], []
+        for _ in range(args.repeat):
+            wall, stderr = run(f'import {module}')
+            entries = parse_importtime(stderr)
+            walls.append(wall)
+            cumulative.append(next(c for name, _, c, depth in entries if name == module and depth == 0))
+        # Heaviest packages (self time summed over everything under a top level name) from the last run
+        by_package = {}
+        for name, self_us, _, _ in entries:
+            package = name.split('.')[0]
+            by_package[package] = by_package.get(package, 0) + self_us
+        heaviest = sorted(by_package.items(), key=lambda item: -item[1])[:args.top]
+
+        print(f'\n{module}')
+        print(f'  cold start      : {np.median(walls) * 1e3:7.1f} ms  ({(np.median(walls) - baseline) * 1e3:.1f} ms over the baseline)')
+        print(f'  -X importtime   : {np.median(cumulative) / 1e3:7.1f} ms')
+        print('  heaviest        : ' + ', '.join(f'{package} {us / 1e3:.0f} ms' for package, us in heaviest))
+
+
+if __name__ == '__main__':
+    main()
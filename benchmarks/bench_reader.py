@@ -0,0 +1,92 @@
+'''
+Benchmark of the spectrum reader against the old pandas path in open_file.
+
+    >>> python benchmarks/bench_reader.py             # example files + synthetic 10M row spectrum
+    >>> python benchmarks/bench_reader.py --rows 1000000
+
+The old path is pd.read_csv(..., delim_whitespace=True, skiprows=1). delim_whitespace is deprecated
+(and gone in pandas 3), so it is timed as the equivalent sep=r'\s+'.
+'''
+
+import os
+import sys
+import time
+import glob
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import spectrum_io
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Example Object Files')
+
+
+def pandas_read(filename):
+    data = pd.read_csv(filename, sep=r'\s+', skiprows=1)
+    return data.iloc[:, 0], data.iloc[:, 1]
+
+
+def best_time(func, repeat=5):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def write_synthetic(filename, rows, seed=0):
+    '''
+    Writes a title + '# start' file on the usual 3400 + 1.5*i Angstrom grid.
+    '''
+    rng = np.random.default_rng(seed)
+    data = np.column_stack([3400. + 1.5 * np.arange(rows), rng.uniform(0, 1e-16, rows)])
+    with open(filename, 'w') as f:
+        f.write("Wavelength (Angstroms) Flux (erg/s/cm2/A)\n# start\n")
+        np.savetxt(f, data, fmt=['%.2f', '%.4e'])
+
+
+def bench_files(files, repeat):
+    cache_dir = tempfile.mkdtemp()
+    try:
+        t_pandas = sum(best_time(lambda: pandas_read(f), repeat) for f in files)
+        t_parse = sum(best_time(lambda: spectrum_io.load_spectrum(f, cache=False), repeat) for f in files)
+        for f in files:
+            spectrum_io.load_spectrum(f, cache_dir=cache_dir)   # warm the sidecars
+        t_cached = sum(best_time(lambda: spectrum_io.load_spectrum(f, cache_dir=cache_dir), repeat) for f in files)
+    finally:
+        shutil.rmtree(cache_dir)
+    return t_pandas, t_parse, t_cached
+
+
+def report(label, t_pandas, t_parse, t_cached):
+    print(f'{label}')
+    print(f'  pandas read_csv : {t_pandas * 1e3:10.2f} ms')
+    print(f'  text parse      : {t_parse * 1e3:10.2f} ms  ({t_pandas / t_parse:6.1f}x)')
+    print(f'  cached sidecar  : {t_cached * 1e3:10.2f} ms  ({t_pandas / t_cached:6.1f}x)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000_000, help="rows in the synthetic spectrum")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    files = sorted(glob.glob(os.path.join(EXAMPLE_DIR, '*_Object.csv')))
+    report(f'{len(files)} example files (total)', *bench_files(files, args.repeat))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        big = os.path.join(tmp, 'SYNTH_Object.csv')
+        write_synthetic(big, args.rows)
+        report(f'synthetic {args.rows:,} row spectrum', *bench_files([big], max(1, args.repeat // 2)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
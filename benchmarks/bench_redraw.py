@@ -0,0 +1,96 @@
+'''
+Redraw latency as the line catalog grows: the old plot()+legend()+draw() pattern
+against the persistent artists + blitting in plot_canvas.MplCanvas.
+
+    >>> python benchmarks/bench_redraw.py --lines 200
+
+Runs headless with QT_QPA_PLATFORM=offscreen unless a display is set.
+'''
+
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from PyQt5 import QtWidgets
+from plot_canvas import MplCanvas
+
+
+def synthetic_lines(n, seed=0):
+    rng = np.random.default_rng(seed)
+    wavelengths = 3400. + 1.5 * np.arange(4000)
+    fluxes = 1e-16 * (wavelengths / 5000) ** -1.5 + rng.normal(0, 5e-18, wavelengths.size)
+    fits = []
+    for _ in range(n):
+        i = rng.integers(50, 3950)
+        x = wavelengths[i - 50:i + 50]
+        y = 5e-17 * np.exp(-((x - x[50]) / 10) ** 2 / 2)
+        fits.append((x, y, y + rng.normal(0, 5e-18, x.size)))
+    return wavelengths, fluxes, fits
+
+
+def bench_old(canvas, wavelengths, fluxes, fits):
+    canvas.axes.cla()
+    canvas.axes.plot(wavelengths, fluxes)
+    canvas.draw()
+    times = []
+    for x, y, resid in fits:
+        t0 = time.perf_counter()
+        canvas.axes.plot(x, y, '--', label=f'Line {x[50]}')
+        canvas.axes.plot(x, resid, '--', color='red')
+        canvas.axes.legend()
+        canvas.draw()
+        times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+
+def bench_new(canvas, wavelengths, fluxes, fits):
+    '''
+    The whole add_line_fit call per line, i.e. settling the previous fit into the background plus the blit.
+    '''
+    canvas.show_spectrum(wavelengths, fluxes, title='synthetic')
+    times = []
+    for x, y, resid in fits:
+        t0 = time.perf_counter()
+        canvas.add_line_fit(x, y, resid, label=f'Line {x[50]}')
+        times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+
+def report(label, times, checkpoints):
+    cols = '  '.join(f'{times[c - 1] * 1e3:7.2f}' for c in checkpoints)
+    print(f'  {label:28s}{cols}   (ms per frame)')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--lines', type=int, default=200)
+    parser.add_argument('--max-growth', type=float, default=1.5,
+                        help="fail if the last 10 frames are slower than the first 10 by more than this factor")
+    args = parser.parse_args(argv)
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    wavelengths, fluxes, fits = synthetic_lines(args.lines)
+    checkpoints = sorted({1, 10, max(1, args.lines // 2), args.lines})
+
+    print('frame time after n line fits, n = ' + ', '.join(map(str, checkpoints)))
+    report('plot + legend + draw', bench_old(MplCanvas(), wavelengths, fluxes, fits), checkpoints)
+    new = bench_new(MplCanvas(), wavelengths, fluxes, fits)
+    report('persistent artists + blit', new, checkpoints)
+
+    # Latency has to stay flat as the catalog grows (medians, so one slow frame doesn't decide it)
+    growth = np.median(new[-10:]) / np.median(new[:10])
+    print(f'last 10 / first 10 frames: {growth:.2f}x')
+    if growth > args.max_growth:
+        print(f'Frame time grew by more than {args.max_growth}x')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+'''
+Resuming a working set from a session file (session.py) vs. redoing it from the spectrum files.
+
+    >>> python benchmarks/bench_session.py --objects 1000
+
+Every object is a synthetic quasar with its continuum and automatically fit lines. Redoing the work means
+parsing each text file, fitting its continuum and fitting its lines again (timed on --loop objects and scaled up);
+resuming means opening the session, plus building every object from it. np.load of the same file, which reads
+every member into memory, is timed for comparison.
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import spectral_core
+import redshift
+import line_catalog
+import session
+import synthetic
+
+
+def redo(filename):
+    spec = spectral_core.load_spectrum(filename, cache=False)
+    fit = spectral_core.define_continuum(spec.wavelengths, spec.fluxes)
+    _, lines, _, _ = redshift.auto_fit_lines(spec.wavelengths, spec.fluxes, fit.continuum)
+    return session.SessionObject.from_spectrum(spec, filename, fit), line_catalog.lines_to_rows(lines, spec.name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=1000)
+    parser.add_argument('--pixels', type=int, default=4000)
+    parser.add_argument('--loop', type=int, default=50, help="how many objects to time redoing the work on")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        wavelengths, fluxes, _ = synthetic.synthetic_survey(args.objects, args.pixels)
+        files = []
+        for i, row in enumerate(fluxes):
+            files.append(os.path.join(directory, f'Q{i:05d}_Object.csv'))
+            synthetic.write_spectrum(files[-1], wavelengths, row)
+
+        redshift.auto_fit_lines(wavelengths, fluxes[0], np.full(len(wavelengths), np.median(fluxes[0])))  # warm up
+        t0 = time.perf_counter()
+        for filename in files[:args.loop]:
+            redo(filename)
+        t_redo = (time.perf_counter() - t0) / min(args.loop, args.objects) * args.objects
+
+        path = os.path.join(directory, 'working set.npz')
+        t0 = time.perf_counter()
+        with session.SessionWriter(path) as writer:
+            for filename in files:
+                obj, rows = redo(filename)
+                obj.lines = rows
+                writer.add(obj)
+        t_build = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        opened = session.load_session(path)
+        t_open = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        objects = list(opened)
+        t_objects = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        total = sum(float(np.nansum(obj.fluxes)) for obj in objects)
+        t_touch = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        t_npload = time.perf_counter() - t0
+
+        print(f'{args.objects} objects x {args.pixels} pixels, {len(opened.lines)} lines, '
+              f'session file {os.path.getsize(path) / 1e6:.1f} MB')
+        print(f'  redo (parse + continuum + lines) {t_redo:9.3f} s   (from {min(args.loop, args.objects)} objects)')
+        print(f'  build + write the session        {t_build:9.3f} s')
+        print(f'  open the session                 {t_open:9.3f} s   ({t_redo / t_open:.0f}x faster than redoing)')
+        print(f'  + build every SessionObject      {t_objects:9.3f} s')
+        print(f'  + read every flux (page in)      {t_touch:9.3f} s')
+        print(f'  np.load every member             {t_npload:9.3f} s   ({len(arrays)} members, checksum {total:.3g})')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
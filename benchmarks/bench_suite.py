@@ -0,0 +1,201 @@
+'''
+Benchmark suite for every stage of a reduction, with results saved as JSON for comparing commits.
+
+    >>> python benchmarks/bench_suite.py                      # everything (the 10M pixel spectrum takes a while)
+    >>> python benchmarks/bench_suite.py --quick              # 5k and 100k pixels, 1000 objects
+    >>> python benchmarks/bench_suite.py --compare benchmarks/results/<older>.json
+
+Stages, each run on the 13 bundled Example Object Files (totals) and on seeded synthetic quasars
+(benchmarks/synthetic.py) of 5k, 100k, 1M and 10M pixels:
+- parse: reading the text file like open_file does (spectral_core.load_spectrum, no sidecar cache)
+- continuum: spectral_core.define_continuum
+- smooth: the Smooth button's defaults (Gaussian, width 3 px, rebin x2)
+- fit_line: spectral_core.fit_spectral_line on the strongest line
+Survey stages, on 1000 and 10000 synthetic objects sharing one 4000 pixel grid:
+- fit_continua: continuum.fit_continua on all of them at once
+- fit_gaussians: gaussian_fit.fit_gaussians on a 100 pixel window around each object's strongest line
+
+Each result has the best and median wall time over --repeat runs, the throughput (pixels or objects
+per second) and the peak memory allocated during one extra run (tracemalloc, which numpy reports to).
+Results go to benchmarks/results/<commit>-<time>.json unless --output is given.
+'''
+
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import continuum
+import gaussian_fit
+import resample
+import spectral_core
+import spectrum
+import synthetic
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+EXAMPLE_DIR = os.path.join(ROOT, 'Example Object Files')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+PIXELS = [5_000, 100_000, 1_000_000, 10_000_000]
+OBJECTS = [1_000, 10_000]
+WINDOW = 50
+
+
+# ----------------------------
+# Measuring
+# ----------------------------
+def measure(fn, repeat):
+    '''
+    (best seconds, median seconds, peak MB) of fn(); the memory is taken on a separate, untimed run.
+    '''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), float(np.median(times)), peak / 1024 ** 2
+
+
+def record(results, stage, dataset, fn, repeat, pixels=None, objects=None):
+    best, median, peak_mb = measure(fn, repeat)
+    amount, unit = (objects, 'objects/s') if objects is not None else (pixels, 'pixels/s')
+    result = {'stage': stage, 'dataset': dataset, 'pixels': pixels, 'objects': objects, 'best_s': best,
+              'median_s': median, 'throughput': amount / best, 'unit': unit, 'peak_mb': peak_mb}
+    results.append(result)
+    print(f'  {stage:14s} {dataset:18s} {best * 1e3:10.2f} ms  {result["throughput"]:12.4g} {unit:9s} {peak_mb:9.1f} MB')
+
+
+def strongest_line(fluxes, continuum_fluxes):
+    return int(np.nanargmax(fluxes - continuum_fluxes))
+
+
+# ----------------------------
+# Stages
+# ----------------------------
+def bench_spectra(results, label, files, repeat):
+    '''
+    The four per-spectrum stages over files, timed as the total over all of them.
+    '''
+    spectra = [spectral_core.load_spectrum(f, cache=False) for f in files]
+    pixels = sum(len(s.fluxes) for s in spectra)
+    continua = [spectral_core.define_continuum(s.wavelengths, s.fluxes).continuum for s in spectra]
+    clicks = [spectrum.take(s.wavelengths, strongest_line(s.fluxes, c)) for s, c in zip(spectra, continua)]
+
+    def fit_lines():
+        for s, c, click in zip(spectra, continua, clicks):
+            try:
+                spectral_core.fit_spectral_line(s.wavelengths, s.fluxes, c, click)
+            except RuntimeError:
+                pass
+
+    record(results, 'parse', label, lambda: [spectral_core.load_spectrum(f, cache=False) for f in files], repeat, pixels)
+    record(results, 'continuum', label, lambda: [spectral_core.define_continuum(s.wavelengths, s.fluxes) for s in spectra],
+           repeat, pixels)
+    record(results, 'smooth', label, lambda: [resample.smooth_and_rebin(s.wavelengths, s.fluxes, 'gaussian', 3., 2.)
+                                              for s in spectra], repeat, pixels)
+    record(results, 'fit_line', label, fit_lines, repeat, pixels)
+
+
+def bench_survey(results, n_objects, repeat, seed):
+    wavelengths, fluxes, _ = synthetic.synthetic_survey(n_objects, seed=seed)
+    label = f'survey {n_objects}'
+    record(results, 'fit_continua', label, lambda: continuum.fit_continua(wavelengths, fluxes), repeat,
+           fluxes.size, n_objects)
+
+    continua = np.stack([fit.continuum for fit in continuum.fit_continua(wavelengths, fluxes)])
+    residuals = fluxes - continua
+    peaks = np.clip(np.nanargmax(residuals, axis=1), WINDOW, fluxes.shape[1] - WINDOW)
+    cols = peaks[:, None] + np.arange(-WINDOW, WINDOW)
+    x = wavelengths[cols]
+    y = np.take_along_axis(residuals, cols, axis=1)
+    record(results, 'fit_gaussians', label, lambda: gaussian_fit.fit_gaussians(x, y), repeat, x.size, n_objects)
+
+
+# ----------------------------
+# Results
+# ----------------------------
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def compare(old_path, results):
+    with open(old_path) as f:
+        old = json.load(f)
+    before = {(r['stage'], r['dataset']): r for r in old['results']}
+    print(f'\ncompared with {old_path} (commit {old["meta"]["commit"]}); speedup > 1 is faster now')
+    for r in results:
+        o = before.get((r['stage'], r['dataset']))
+        if o is not None:
+            print(f'  {r["stage"]:14s} {r["dataset"]:18s} {o["best_s"] / r["best_s"]:7.2f}x speed'
+                  f'  {r["peak_mb"] - o["peak_mb"]:+9.1f} MB peak')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pixels', type=int, nargs='*', default=PIXELS, help="synthetic spectrum sizes")
+    parser.add_argument('--objects', type=int, nargs='*', default=OBJECTS, help="synthetic survey sizes")
+    parser.add_argument('--quick', action='store_true', help="only 5k and 100k pixels and 1000 objects")
+    parser.add_argument('--no-examples', action='store_true', help="skip the bundled example files")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per stage (1 for spectra over 1M pixels)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="JSON file for the results")
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.pixels, args.objects = PIXELS[:2], OBJECTS[:1]
+
+    results = []
+    print(f'  {"stage":14s} {"dataset":18s} {"best":>13s}  {"throughput":>22s} {"peak":>12s}')
+    if not args.no_examples:
+        files = sorted(glob.glob(os.path.join(EXAMPLE_DIR, '*_Object.csv')))
+        bench_spectra(results, f'examples ({len(files)})', files, args.repeat)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        for n in args.pixels:
+            wavelengths, fluxes, _ = synthetic.synthetic_quasar(n, seed=args.seed)
+            filename = os.path.join(tmp, f'SYNTH{n}_Object.csv')
+            synthetic.write_spectrum(filename, wavelengths, fluxes)
+            bench_spectra(results, f'synthetic {n:,}', [filename], args.repeat if n <= 1_000_000 else 1)
+    finally:
+        shutil.rmtree(tmp)
+
+    for n in args.objects:
+        bench_survey(results, n, args.repeat if n <= 1000 else 1, args.seed)
+
+    meta = metadata()
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f'{meta["commit"]}-{meta["time"].replace(":", "")}.json')
+    with open(output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print(f'\nresults -> {output}')
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+'''
+Seeded synthetic quasar spectra for the benchmarks: a power law continuum, Gaussian emission lines
+(broad for the permitted lines, narrow for the forbidden ones, strengths from redshift.QUASAR_LINES)
+and Gaussian noise at a chosen S/N.
+
+    >>> wavelengths, fluxes, truth = synthetic_quasar(100_000, seed=1)
+    >>> wavelengths, fluxes, truths = synthetic_survey(1000, seed=1)
+    >>> write_spectrum('SYNTH_Object.csv', wavelengths, fluxes)
+
+Every spectrum covers 3400 - 9400 Angstroms, so more pixels means finer sampling of the same spectrum.
+The same seed always gives the same spectra.
+'''
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import redshift
+
+START, STOP = 3400., 9400.
+BROAD_FWHM_KMS = 4000.
+NARROW_FWHM_KMS = 500.
+# Peak height above the continuum of a line with QUASAR_LINES strength 1, as a fraction of the continuum
+PEAK_PER_STRENGTH = 0.08
+
+
+def wavelength_grid(n_pixels):
+    return START + (STOP - START) / n_pixels * np.arange(n_pixels)
+
+
+def _line_profiles(wavelengths, z, continuum, rng, lines):
+    '''
+    Sum of the emission lines visible at redshift z, plus [(name, observed wavelength, amplitude, sigma)].
+    '''
+    flux = np.zeros_like(wavelengths)
+    truth = []
+    for name, (rest, strength) in lines.items():
+        center = rest * (1 + z)
+        fwhm = NARROW_FWHM_KMS if name.startswith('[') else BROAD_FWHM_KMS * rng.uniform(0.7, 1.5)
+        sigma = center * fwhm / redshift.C_KMS / 2.3548
+        if not wavelengths[0] - 3 * sigma < center < wavelengths[-1] + 3 * sigma:
+            continue
+        amplitude = PEAK_PER_STRENGTH * strength * rng.uniform(0.5, 1.5) * np.interp(center, wavelengths, continuum)
+        # Only the pixels within 6 sigma, so 10M pixel spectra stay cheap to build
+        lo, hi = np.searchsorted(wavelengths, [center - 6 * sigma, center + 6 * sigma])
+        flux[lo:hi] += amplitude * np.exp(-0.5 * ((wavelengths[lo:hi] - center) / sigma) ** 2)
+        truth.append((name, center, amplitude, sigma))
+    return flux, truth
+
+
+def synthetic_quasar(n_pixels=4000, z=None, snr=20., seed=0, lines=None):
+    '''
+    One spectrum of n_pixels. z is drawn from 0.5 - 3.5 unless given.
+    Returns (wavelengths, fluxes, truth) with truth a dict of z, the power law slope and the lines added.
+    '''
+    rng = np.random.default_rng(seed)
+    lines = redshift.QUASAR_LINES if lines is None else lines
+    z = rng.uniform(0.5, 3.5) if z is None else z
+    slope = rng.uniform(-2., -0.5)
+    wavelengths = wavelength_grid(n_pixels)
+    continuum = 1e-16 * rng.uniform(0.3, 3.) * (wavelengths / 5000.) ** slope
+    line_flux, line_truth = _line_profiles(wavelengths, z, continuum, rng, lines)
+    # snr is per 1.5 Angstroms (the bundled spectra's pixels), so finer grids get noisier pixels, not cleaner spectra
+    noise = continuum / snr * np.sqrt(n_pixels / (STOP - START) / (1 / 1.5))
+    fluxes = continuum + line_flux + rng.standard_normal(n_pixels) * noise
+    return wavelengths, fluxes, {'z': z, 'slope': slope, 'lines': line_truth}
+
+
+def synthetic_survey(n_objects, n_pixels=4000, snr=20., seed=0):
+    '''
+    n_objects spectra on one shared grid, each with its own redshift, slope and line strengths.
+    Returns (wavelengths, fluxes (n_objects, n_pixels), truths).
+    '''
+    seeds = np.random.SeedSequence(seed).spawn(n_objects)
+    fluxes = np.empty((n_objects, n_pixels))
+    truths = []
+    for i, object_seed in enumerate(seeds):
+        wavelengths, fluxes[i], truth = synthetic_quasar(n_pixels, snr=snr, seed=object_seed)
+        truths.append(truth)
+    return wavelengths, fluxes, truths
+
+
+def write_spectrum(filename, wavelengths, fluxes):
+    '''
+    Writes a spectrum in the format of the bundled *_Object.csv files (title line, '# start', two columns).
+    '''
+    with open(filename, 'w') as f:
+        f.write("Wavelength (Angstroms) Flux (erg/s/cm2/A)\n# start\n")
+        np.savetxt(f, np.column_stack([wavelengths, fluxes]), fmt=['%.4f', '%.4e'])
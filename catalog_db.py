@@ -0,0 +1,289 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+SQLite store for line catalogs, so questions across many objects are one indexed query
+instead of re-reading every per-object .csv. The table has the same columns as line_catalog.LINE_DTYPE,
+with indexes on the object, the observed and rest wavelengths, and the equivalent width.
+The database runs in WAL mode, so the GUI or a batch run can write while queries read.
+
+Examples:
+
+    >>> python catalog_db.py query --near 4400 --tolerance 20 --min-ew 50
+    >>> python catalog_db.py query --near 1549 --rest --object J1246
+    >>> python catalog_db.py import "Line Catalogs"
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import sys
+import csv
+import glob
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+
+import line_catalog
+# ----------------------------
+
+
+DB_NAME = 'line_catalog.sqlite'
+DEFAULT_DB = os.path.join('./Line Catalogs/', DB_NAME)
+
+_SQL_TYPES = {'U': 'TEXT', 'f': 'REAL', 'i': 'INTEGER'}
+COLUMN_NAMES = list(line_catalog.LINE_DTYPE.names)
+INDEXED_COLUMNS = ('object', 'wavelength', 'rest_wav', 'eq_wid')
+
+
+class CatalogStore():
+    '''
+    A line catalog database at path (created if needed). Rows go in and come out as LINE_DTYPE arrays.
+    NaNs are stored as NULL.
+    '''
+
+    def __init__(self, path=DEFAULT_DB):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        columns = ', '.join(f'{name} {_SQL_TYPES[line_catalog.LINE_DTYPE[name].kind]}' for name in COLUMN_NAMES)
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, {columns})')
+            # Databases made before a column was added to LINE_DTYPE get it added (NULL for the old rows)
+            existing = {row[1] for row in self.connection.execute('PRAGMA table_info(lines)')}
+            for name in COLUMN_NAMES:
+                if name not in existing:
+                    sql_type = _SQL_TYPES[line_catalog.LINE_DTYPE[name].kind]
+                    self.connection.execute(f'ALTER TABLE lines ADD COLUMN {name} {sql_type}')
+            for name in INDEXED_COLUMNS:
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS lines_{name} ON lines ({name})')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM lines').fetchone()[0]
+
+    # ----------------------------
+    # Writing
+    # ----------------------------
+    def insert(self, rows, commit=True):
+        '''
+        Appends LINE_DTYPE rows with one executemany. commit=False leaves the transaction open,
+        so many inserts can be committed together with commit().
+        '''
+        rows = np.asarray(rows, dtype=line_catalog.LINE_DTYPE)
+        placeholders = ', '.join('?' * len(COLUMN_NAMES))
+        self.connection.executemany(f'INSERT INTO lines ({", ".join(COLUMN_NAMES)}) VALUES ({placeholders})',
+                                    _sql_rows(rows))
+        if commit:
+            self.connection.commit()
+
+    def replace_object(self, object_name, rows, commit=True):
+        '''
+        Swaps every stored line of object_name for rows, in the same transaction, so rerunning an object never duplicates it.
+        '''
+        self.connection.execute('DELETE FROM lines WHERE object = ?', (str(object_name),))
+        self.insert(rows, commit=commit)
+
+    def commit(self):
+        self.connection.commit()
+
+    # ----------------------------
+    # Reading
+    # ----------------------------
+    def query(self, near=None, tolerance=20., rest=False, min_ew=None, max_ew=None, objects=None, name=None,
+              order_by='object, wavelength', limit=None):
+        '''
+        Lines matching every filter given:
+        - near / tolerance: observed wavelength (rest wavelength with rest=True) within tolerance Angstroms of near
+        - min_ew / max_ew: equivalent width range
+        - objects: an object name or list of them
+        - name: a line name, e.g. 'C IV'
+        Returns a LINE_DTYPE array.
+        '''
+        where, params = [], []
+        if near is not None:
+            where.append(f'{"rest_wav" if rest else "wavelength"} BETWEEN ? AND ?')
+            params += [near - tolerance, near + tolerance]
+        if min_ew is not None:
+            where.append('eq_wid >= ?')
+            params.append(min_ew)
+        if max_ew is not None:
+            where.append('eq_wid <= ?')
+            params.append(max_ew)
+        if objects is not None:
+            objects = [objects] if isinstance(objects, str) else list(objects)
+            where.append(f'object IN ({", ".join("?" * len(objects))})')
+            params += objects
+        if name is not None:
+            where.append('name = ?')
+            params.append(name)
+
+        sql = f'SELECT {", ".join(COLUMN_NAMES)} FROM lines'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        if order_by:
+            sql += f' ORDER BY {order_by}'
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        return _to_rows(self.connection.execute(sql, params).fetchall())
+
+    def objects(self):
+        return [row[0] for row in self.connection.execute('SELECT DISTINCT object FROM lines ORDER BY object')]
+
+
+def _sql_rows(rows):
+    '''
+    Plain Python tuples for sqlite3, with NaN as None (NULL). Built column by column, which is much faster than per value.
+    '''
+    columns = []
+    for name in COLUMN_NAMES:
+        column = rows[name]
+        if column.dtype.kind == 'f' and np.isnan(column).any():
+            column = column.astype(object)
+            column[np.isnan(rows[name])] = None
+        columns.append(column.tolist())
+    return zip(*columns)
+
+
+def _to_rows(records):
+    '''
+    Query results back into a LINE_DTYPE array, column by column (NULL -> NaN, 0 or '').
+    '''
+    rows = np.zeros(len(records), dtype=line_catalog.LINE_DTYPE)
+    if not records:
+        return rows
+    for i, name in enumerate(COLUMN_NAMES):
+        values = [record[i] for record in records]
+        if line_catalog.LINE_DTYPE[name].kind == 'U':
+            rows[name] = ['' if value is None else value for value in values]
+        elif line_catalog.LINE_DTYPE[name].kind == 'i':
+            rows[name] = [0 if value is None else value for value in values]
+        else:
+            rows[name] = np.array(values, dtype=float)
+    return rows
+
+
+# ----------------------------
+# Importing existing catalogs
+# ----------------------------
+def read_catalog_csv(path):
+    '''
+    Reads a line catalog .csv, the old four column files included, into LINE_DTYPE rows.
+    Columns are matched by header; anything missing is NaN (0 for counts), and the object comes from the file name if not stored.
+    '''
+    by_header = {header: column for column, _, header in line_catalog.COLUMNS}
+    with open(path, newline='') as f:
+        reader = csv.reader(f, delimiter=' ')
+        headers = next(reader, [])
+        records = [record for record in reader if record]
+    rows = np.zeros(len(records), dtype=line_catalog.LINE_DTYPE)
+    for column in COLUMN_NAMES:
+        if line_catalog.LINE_DTYPE[column].kind == 'f':
+            rows[column] = np.nan
+    for i, header in enumerate(headers):
+        column = by_header.get(header)
+        if column is None:
+            continue
+        values = [record[i] if i < len(record) else '' for record in records]
+        if line_catalog.LINE_DTYPE[column].kind == 'U':
+            rows[column] = values
+        elif line_catalog.LINE_DTYPE[column].kind == 'i':
+            rows[column] = [int(float(value)) if value.strip() else 0 for value in values]
+        else:
+            rows[column] = [float(value) if value.strip() else np.nan for value in values]
+    if 'Object' not in headers:
+        rows['object'] = os.path.basename(path).replace(' Line Catalog.csv', '')
+    return rows
+
+
+def import_csv_catalogs(store, paths):
+    '''
+    Loads per-object '<object> Line Catalog.csv' files into the store, replacing those objects.
+    Returns the number of lines imported.
+    '''
+    n = 0
+    for path in paths:
+        rows = read_catalog_csv(path)
+        for object_name in np.unique(rows['object']):
+            store.replace_object(object_name, rows[rows['object'] == object_name], commit=False)
+        n += len(rows)
+    store.commit()
+    return n
+
+
+# ----------------------------
+# Command line
+# ----------------------------
+def print_rows(rows):
+    from prettytable import PrettyTable
+    table = PrettyTable()
+    table.field_names = ['Object', 'Line', 'Rest Wavelength', 'Redshift', 'Wavelength', 'Equivalent Width', 'Total Flux']
+    for row in rows:
+        table.add_row([row['object'], row['name'], row['rest_wav'], row['redshift'], row['wavelength'],
+                       row['eq_wid'], row['total_flux']])
+    print(table)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query or fill the SQLite line catalog.")
+    parser.add_argument('--db', default=DEFAULT_DB, help="database file")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    query = commands.add_parser('query', help="find lines across every object")
+    query.add_argument('--near', type=float, help="wavelength (Angstroms) to search around")
+    query.add_argument('--tolerance', type=float, default=20., help="half width of the wavelength search")
+    query.add_argument('--rest', action='store_true', help="search rest wavelengths instead of observed ones")
+    query.add_argument('--min-ew', type=float, help="minimum equivalent width")
+    query.add_argument('--max-ew', type=float, help="maximum equivalent width")
+    query.add_argument('--object', nargs='*', help="only these objects")
+    query.add_argument('--name', help="line name, e.g. 'C IV'")
+    query.add_argument('--limit', type=int)
+    query.add_argument('--csv', help="also write the matches to this .csv (the name has to end in .csv)")
+
+    importer = commands.add_parser('import', help="load per-object line catalog .csv files")
+    importer.add_argument('targets', nargs='+', help="directories of '* Line Catalog.csv' files, or the files themselves")
+
+    args = parser.parse_args(argv)
+    # CatalogWriter adds the .csv itself, so any other extension would quietly end up somewhere else
+    if args.command == 'query' and args.csv and not args.csv.endswith('.csv'):
+        parser.error(f"--csv has to be a .csv file, got '{args.csv}'")
+    with CatalogStore(args.db) as store:
+        if args.command == 'import':
+            paths = []
+            for target in args.targets:
+                paths += glob.glob(os.path.join(target, '* Line Catalog.csv')) if os.path.isdir(target) else glob.glob(target)
+            n = import_csv_catalogs(store, sorted(paths))
+            print(f"Imported {n} lines from {len(paths)} files -> {args.db} ({len(store)} lines in total)")
+            return 0
+
+        t0 = time.perf_counter()
+        rows = store.query(args.near, args.tolerance, args.rest, args.min_ew, args.max_ew, args.object, args.name,
+                           limit=args.limit)
+        elapsed = time.perf_counter() - t0
+        print_rows(rows)
+        print(f"{len(rows)} lines from {len(np.unique(rows['object']))} objects in {elapsed * 1e3:.1f} ms")
+        if args.csv:
+            with line_catalog.CatalogWriter(args.csv[:-len('.csv')], columnar=False) as writer:
+                writer.write(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,503 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Composite spectra from many objects.
+Every spectrum is resampled (flux conserving, see resample.rebin) onto one common grid, observed or
+rest frame, and written as a row of a float32 "cube": a 2D .npy array on disk that is memory mapped,
+never held in RAM, plus a .json with the grid, object names and redshifts.
+Composites (mean, median, sigma clipped mean, percentiles) are then computed a block of pixels at a time
+over every object, so memory is bounded by the block size whether the cube holds 13 spectra or 100k.
+The blocks are read from a pixel-major copy of the cube, written once, so each one is a contiguous read.
+
+Bad pixels (the zero-flux first pixel most files have, NaNs, and any wavelength ranges passed as mask_ranges)
+are masked before resampling: the masked flux and the good-pixel coverage are rebinned separately and divided,
+so a masked pixel never leaks into the bins next to it, and bins less than min_coverage covered are NaN.
+
+    >>> python composite.py "Example Object Files" --normalize continuum
+    >>> python composite.py "Example Object Files" --rest --grid 1000 3000 0.5 --normalize continuum
+    >>> python composite.py survey/ --cube survey_cube --workers 8 --grid 1000 3000 1.0 --rest --db "Line Catalogs/line_catalog.sqlite"
+    >>> python composite.py --from-cube survey_cube --statistics median clipped_mean --percentiles 5 95
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import sys
+import csv
+import json
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import spectrum
+import spectral_core
+import continuum
+import resample
+import profiling
+# ----------------------------
+
+
+NORMALIZATIONS = (None, 'median', 'continuum')
+STATISTICS = ('mean', 'median', 'clipped_mean', 'std')
+COMPOSITE_DIR = './Composites/'
+
+
+# ----------------------------
+# Cube on disk
+# ----------------------------
+class SpectralCube():
+    '''
+    n_objects spectra on one UniformGrid, as a (n_objects, n_pixels) float32 memory map (NaN = no data).
+    - grid: the common spectrum.UniformGrid
+    - names, redshifts: per row (redshift NaN when unknown / observed frame)
+    - rest_frame: whether grid is in rest wavelengths
+    '''
+
+    def __init__(self, path, fluxes, grid, names, redshifts, rest_frame):
+        self.path = path
+        self.fluxes = fluxes
+        self.grid = grid
+        self.names = names
+        self.redshifts = redshifts
+        self.rest_frame = rest_frame
+
+    def __len__(self):
+        return self.fluxes.shape[0]
+
+    def __repr__(self):
+        frame = 'rest' if self.rest_frame else 'observed'
+        return f'SpectralCube({self.path!r}, {len(self)} objects, {frame} frame {self.grid!r})'
+
+    @classmethod
+    def create(cls, path, grid, n_objects, rest_frame=False):
+        '''
+        A new cube of NaNs at path + '.npy' / '.json' (replacing any cube already there).
+        '''
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fluxes = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.float32, shape=(n_objects, grid.n))
+        fluxes[:] = np.nan
+        cube = cls(path, fluxes, grid, [''] * n_objects, np.full(n_objects, np.nan), rest_frame)
+        cube.save_metadata()
+        return cube
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        fluxes = np.load(path + '.npy', mmap_mode=mode)
+        grid = spectrum.UniformGrid(meta['start'], meta['step'], meta['n'])
+        redshifts = np.array([np.nan if z is None else z for z in meta['redshifts']], dtype=np.float64)
+        return cls(path, fluxes, grid, meta['names'], redshifts, meta['rest_frame'])
+
+    def save_metadata(self):
+        meta = {'start': self.grid.start, 'step': self.grid.step, 'n': self.grid.n, 'rest_frame': self.rest_frame,
+                'names': list(self.names), 'redshifts': [None if np.isnan(z) else float(z) for z in self.redshifts]}
+        tmp = self.path + '.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, self.path + '.json')
+
+    def flush(self):
+        self.fluxes.flush()
+        self.save_metadata()
+
+    def pixel_major(self, memory_mb=64):
+        '''
+        The fluxes as a (n_objects, n_pixels) Fortran ordered memory map at path + '.pixels.npy', so a block of
+        pixel columns of every object is one contiguous run of the file. Stacking reads blocks of columns, and in
+        the row-major cube every block touches a page of every row: once the cube is too big for the page cache,
+        each block re-reads nearly the whole file. The copy is written once, about memory_mb of whole rows at a
+        time (sequential reads, and page sized runs of every column written), and reused while it's newer than
+        the cube.
+        '''
+        path = self.path + '.pixels.npy'
+        if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(self.path + '.npy'):
+            fluxes = np.load(path, mmap_mode='r')
+            if fluxes.shape == self.fluxes.shape and fluxes.flags.f_contiguous:
+                return fluxes
+        n_objects, n_pixels = self.fluxes.shape
+        tmp = self.path + '.pixels.tmp.npy'
+        out = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=(n_objects, n_pixels),
+                                        fortran_order=True)
+        chunk = max(1, int(memory_mb * 1024 ** 2 / (max(n_pixels, 1) * 4)))
+        for lo in range(0, n_objects, chunk):
+            out[lo:lo + chunk] = self.fluxes[lo:lo + chunk]
+        out.flush()
+        del out
+        os.replace(tmp, path)
+        return np.load(path, mmap_mode='r')
+
+
+# ----------------------------
+# Resampling one spectrum
+# ----------------------------
+def pixel_mask(wavelengths, fluxes, mask_ranges=()):
+    '''
+    Good pixels: continuum.good_pixels (finite, not the zero padding) outside every (lo, hi) of mask_ranges.
+    '''
+    good = continuum.good_pixels(fluxes)
+    if len(mask_ranges):
+        w = np.asarray(wavelengths)
+        for lo, hi in mask_ranges:
+            good &= ~((w >= lo) & (w <= hi))
+    return good
+
+
+def resample_masked(wavelengths, fluxes, good, edges, min_coverage=0.5):
+    '''
+    Flux conserving rebin of the good pixels only: the flux (zero where masked) and the coverage
+    (1 where good) are rebinned and divided. Bins covered less than min_coverage, or not at all, are NaN.
+    '''
+    flux = resample.rebin(wavelengths, np.where(good, fluxes, 0.), edges, fill=np.nan)
+    coverage = resample.rebin(wavelengths, good.astype(np.float64), edges, fill=0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = flux / coverage
+    out[~(coverage >= min_coverage)] = np.nan
+    return out
+
+
+def rest_wavelengths(wavelengths, z):
+    '''
+    wavelengths / (1 + z); UniformGrids stay uniform.
+    '''
+    if isinstance(wavelengths, spectrum.UniformGrid):
+        return spectrum.UniformGrid(wavelengths.start / (1 + z), wavelengths.step / (1 + z), wavelengths.n)
+    return np.asarray(wavelengths) / (1 + z)
+
+
+def prepare_row(filename, edges, z=None, rest_frame=False, normalize=None, mask_ranges=(), min_coverage=0.5,
+                continuum_options=None):
+    '''
+    Loads one file and resamples it onto the cube's bins.
+    normalize: None, 'median' (divide by the median good flux) or 'continuum' (divide by its fitted continuum).
+    In the rest frame z is found by cross-correlation (redshift.find_redshift) when not given.
+    Returns (object_name, float32 row, z).
+    '''
+    spec = spectral_core.load_spectrum(filename)
+    wavelengths, fluxes = spec.wavelengths, np.asarray(spec.fluxes, dtype=np.float64)
+    good = pixel_mask(wavelengths, fluxes, mask_ranges)
+
+    fit = None
+    if normalize == 'continuum' or (rest_frame and z is None):
+        fit = spectral_core.define_continuum(wavelengths, fluxes, **(continuum_options or {}))
+    if rest_frame and z is None:
+        import redshift  # only needed when a redshift has to be found
+        z = redshift.find_redshift(wavelengths, fluxes, fit.continuum).z
+
+    if normalize == 'continuum':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fluxes = fluxes / fit.continuum
+        good &= fit.continuum > 0
+    elif normalize == 'median':
+        fluxes = fluxes / np.median(fluxes[good])
+    elif normalize is not None:
+        raise ValueError(f'Unknown normalization {normalize!r}, expected one of {NORMALIZATIONS}')
+
+    if rest_frame:
+        wavelengths = rest_wavelengths(wavelengths, z)
+        if normalize is None:
+            # Flux per rest frame Angstrom (normalized spectra are dimensionless, so they keep their values)
+            fluxes = fluxes * (1 + z)
+    row = resample_masked(wavelengths, fluxes, good, edges, min_coverage)
+    return spec.name, row.astype(np.float32), (np.nan if z is None else float(z))
+
+
+def _prepare_one(job):
+    '''
+    Worker entry point, like batch_reduce._reduce_one: never raises. Returns (index, name, row, z, error).
+    '''
+    index, filename, edges, z, options = job
+    try:
+        name, row, z = prepare_row(filename, edges, z, **options)
+        return index, name, row, z, None
+    except Exception:
+        return index, spectral_core.object_name_from_path(filename), None, np.nan, traceback.format_exc()
+
+
+# ----------------------------
+# Building a cube
+# ----------------------------
+def common_grid(files, step=None, rest_frame=False, redshifts=None):
+    '''
+    A UniformGrid covering every file (in the rest frame, every file at its redshift; files without one are skipped).
+    step defaults to the finest native step (divided by 1 + the largest redshift in the rest frame).
+    '''
+    lo, hi, steps, scale = np.inf, -np.inf, [], 1.
+    for filename in files:
+        name = spectral_core.object_name_from_path(filename)
+        z = 0.
+        if rest_frame:
+            z = (redshifts or {}).get(name)
+            if z is None:
+                continue
+            scale = max(scale, 1 + z)
+        w = spectral_core.load_spectrum(filename).wavelengths
+        lo, hi = min(lo, w[0] / (1 + z)), max(hi, w[len(w) - 1] / (1 + z))
+        steps.append((w[len(w) - 1] - w[0]) / max(len(w) - 1, 1))
+    if not steps:
+        raise ValueError('no spectra to build a grid from (rest frame grids need redshifts; use --grid)')
+    if step is None:
+        step = min(steps) / scale
+    return spectrum.UniformGrid(lo, step, int(np.floor((hi - lo) / step)) + 1)
+
+
+@profiling.profiled('build_cube')
+def build_cube(files, path, grid, redshifts=None, rest_frame=False, normalize=None, mask_ranges=(), min_coverage=0.5,
+               continuum_options=None, workers=1, chunksize=None):
+    '''
+    Resamples every file onto grid and writes it into a new SpectralCube at path, row by row,
+    so only the rows in flight are ever in memory. redshifts maps object names to z.
+    Files that fail keep an all-NaN row. workers > 1 spreads the resampling over a process pool.
+    Returns (cube, errors).
+    '''
+    cube = SpectralCube.create(path, grid, len(files), rest_frame=rest_frame)
+    edges = resample.bin_edges(grid)
+    options = {'rest_frame': rest_frame, 'normalize': normalize, 'mask_ranges': tuple(mask_ranges),
+               'min_coverage': min_coverage, 'continuum_options': continuum_options}
+    jobs = [(i, filename, edges, (redshifts or {}).get(spectral_core.object_name_from_path(filename)), options)
+            for i, filename in enumerate(files)]
+
+    errors = []
+
+    def collect(outcomes):
+        for i, (index, name, row, z, error) in enumerate(outcomes):
+            cube.names[index] = name
+            cube.redshifts[index] = z
+            if error is not None:
+                errors.append(f'{name}: {error}')
+            else:
+                cube.fluxes[index] = row
+            if i % 1024 == 1023:
+                cube.flush()
+
+    if workers == 1:
+        collect(_prepare_one(job) for job in jobs)
+    else:
+        if chunksize is None:
+            chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            collect(pool.map(_prepare_one, jobs, chunksize=chunksize))
+    cube.flush()
+    return cube, errors
+
+
+# ----------------------------
+# Composites
+# ----------------------------
+def sorted_percentile(sorted_block, lo, hi, q):
+    '''
+    q-th percentile (linear interpolation, like np.percentile) of rows lo:hi of every column
+    of a column-sorted block; lo and hi are per-column arrays.
+    '''
+    pos = lo + q / 100. * (hi - lo - 1)
+    below = np.floor(pos).astype(np.intp)
+    above = np.minimum(below + 1, hi - 1)
+    cols = np.arange(sorted_block.shape[1])
+    low_value = sorted_block[below, cols]
+    return low_value + (pos - below) * (sorted_block[above, cols] - low_value)
+
+
+def clipped_mean(sorted_block, n, sigma=3., max_iter=5):
+    '''
+    Mean of each column after iteratively rejecting values more than sigma standard deviations from
+    the median of what is left (astropy sigma_clip's defaults). sorted_block is sorted down each column
+    with its n finite values first. Since the survivors are always a contiguous run of the sorted column,
+    each pass is a median lookup, a mean and variance from cumulative sums, and two counts.
+    '''
+    lo = np.zeros_like(n)
+    hi = n.copy()
+    # Cumulative sums of the values relative to the median keep the variance accurate
+    median = sorted_percentile(sorted_block, lo, hi, 50.)
+    centered = np.nan_to_num(sorted_block - median)
+    s1 = np.zeros((len(sorted_block) + 1, sorted_block.shape[1]))
+    s2 = np.zeros_like(s1)
+    np.cumsum(centered, axis=0, out=s1[1:])
+    np.cumsum(centered ** 2, axis=0, out=s2[1:])
+    cols = np.arange(sorted_block.shape[1])
+
+    for _ in range(max_iter):
+        k = hi - lo
+        mean = (s1[hi, cols] - s1[lo, cols]) / k
+        std = np.sqrt(np.maximum((s2[hi, cols] - s2[lo, cols]) / k - mean ** 2, 0.))
+        center = sorted_percentile(sorted_block, lo, hi, 50.)
+        with np.errstate(invalid='ignore'):
+            new_lo = np.sum(sorted_block < center - sigma * std, axis=0)
+            new_hi = np.sum(sorted_block <= center + sigma * std, axis=0)
+        # Never clip a column down to nothing
+        empty = new_hi <= new_lo
+        new_lo[empty], new_hi[empty] = lo[empty], hi[empty]
+        if np.array_equal(new_lo, lo) and np.array_equal(new_hi, hi):
+            break
+        lo, hi = new_lo, new_hi
+    return (s1[hi, cols] - s1[lo, cols]) / (hi - lo) + median
+
+
+@profiling.profiled('composite')
+def composite(fluxes, statistics=('mean', 'median', 'clipped_mean'), percentiles=(), clip_sigma=3., clip_iter=5,
+              memory_mb=64, rows=None):
+    '''
+    Composite spectra of a (n_objects, n_pixels) array, typically SpectralCube.pixel_major() (a memory map).
+    The cube is read a block of pixel columns at a time, sized to about memory_mb, so every statistic
+    is exact (medians and percentiles see the whole column) while memory stays bounded. Each block is contiguous
+    on disk in the pixel-major copy; the row-major SpectralCube.fluxes works too, but reads a page of every row per block.
+    rows optionally selects the objects to stack (a boolean mask or indices).
+    Returns a dict: 'n' (spectra contributing to each pixel), each of statistics, and f'p{q}' per percentile.
+    '''
+    for name in statistics:
+        if name not in STATISTICS:
+            raise ValueError(f'Unknown statistic {name!r}, expected one of {STATISTICS}')
+    n_objects, n_pixels = fluxes.shape
+    if rows is not None:
+        rows = np.flatnonzero(rows) if np.asarray(rows).dtype == bool else np.asarray(rows)
+        n_objects = len(rows)
+    # The float64 block, its sorted copy and the clipped mean's cumulative sums and temporaries
+    block_pixels = max(1, int(memory_mb * 1024 ** 2 / (max(n_objects, 1) * 8 * 6)))
+
+    out = {'n': np.zeros(n_pixels, dtype=np.int64)}
+    for name in statistics:
+        out[name] = np.full(n_pixels, np.nan)
+    for q in percentiles:
+        out[f'p{q:g}'] = np.full(n_pixels, np.nan)
+
+    for lo in range(0, n_pixels, block_pixels):
+        hi = min(lo + block_pixels, n_pixels)
+        block = np.asarray(fluxes[:, lo:hi] if rows is None else fluxes[rows, lo:hi], dtype=np.float64)
+        finite = np.isfinite(block)
+        out['n'][lo:hi] = finite.sum(axis=0)
+        covered = out['n'][lo:hi] > 0
+        if not covered.any():
+            continue
+        cols = np.arange(lo, hi)[covered]
+        n = out['n'][cols]
+        # One sort per block (NaNs go last) gives the median, every percentile and the clipped mean
+        sorted_block = np.sort(block[:, covered], axis=0)
+        first = np.zeros_like(n)
+        for name in statistics:
+            if name == 'mean':
+                out[name][cols] = np.nanmean(sorted_block, axis=0)
+            elif name == 'median':
+                out[name][cols] = sorted_percentile(sorted_block, first, n, 50.)
+            elif name == 'std':
+                out[name][cols] = np.nanstd(sorted_block, axis=0)
+            else:
+                out[name][cols] = clipped_mean(sorted_block, n, clip_sigma, clip_iter)
+        for q in percentiles:
+            out[f'p{q:g}'][cols] = sorted_percentile(sorted_block, first, n, q)
+    return out
+
+
+def write_composite(filename, grid, result, rest_frame=False):
+    '''
+    Writes the composite in the same layout as the object files (title line, '# start', wavelength then flux),
+    so the GUI can open it: the first statistic is the flux column, the others and 'n' follow.
+    '''
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    columns = [name for name in result if name != 'n'] + ['n']
+    frame = 'Rest Wavelength' if rest_frame else 'Wavelength'
+    wavelengths = np.asarray(grid)
+    with open(filename, 'w', newline='') as f:
+        f.write(f"{frame} (Angstroms) " + ' '.join(columns) + "\n# start\n")
+        writer = csv.writer(f, delimiter=' ')
+        for i in range(grid.n):
+            if result['n'][i] == 0:
+                continue
+            writer.writerow([f'{wavelengths[i]:.4f}'] + [f'{result[name][i]:.6g}' for name in columns])
+
+
+# ----------------------------
+# Command line
+# ----------------------------
+def read_redshifts(path):
+    '''
+    Object -> z from a two column text file ('J1246 1.8385' per line; '#' comments).
+    '''
+    redshifts = {}
+    with open(path) as f:
+        for line in f:
+            tokens = line.split('#')[0].split()
+            if len(tokens) >= 2:
+                redshifts[tokens[0]] = float(tokens[1])
+    return redshifts
+
+
+def redshifts_from_db(path):
+    '''
+    Object -> median redshift of its automatically fit lines in a catalog_db SQLite catalog.
+    '''
+    import catalog_db
+    with catalog_db.CatalogStore(path) as store:
+        rows = store.query()
+    redshifts = {}
+    for name in np.unique(rows['object']):
+        z = rows['redshift'][(rows['object'] == name) & np.isfinite(rows['redshift'])]
+        if len(z):
+            redshifts[str(name)] = float(np.median(z))
+    return redshifts
+
+
+def main(argv=None):
+    import batch_reduce
+    parser = argparse.ArgumentParser(description="Stack many spectra into composites through a memory mapped cube.")
+    parser.add_argument('targets', nargs='*', help="directories of *_Object.csv files, or glob patterns")
+    parser.add_argument('--from-cube', help="compute composites from an existing cube instead of building one")
+    parser.add_argument('--cube', default=os.path.join(COMPOSITE_DIR, 'cube'), help="cube path (without .npy/.json)")
+    parser.add_argument('--rest', action='store_true', help="stack in the rest frame")
+    parser.add_argument('--redshifts', help="text file of 'object z' lines")
+    parser.add_argument('--db', help="take redshifts from a catalog_db SQLite catalog (auto fit lines)")
+    parser.add_argument('--grid', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'), help="common wavelength grid")
+    parser.add_argument('--step', type=float, help="grid step when the grid is chosen automatically")
+    parser.add_argument('--normalize', choices=['none', 'median', 'continuum'], default='median')
+    parser.add_argument('--mask', type=float, nargs=2, action='append', default=[], metavar=('LO', 'HI'),
+                        help="observed wavelength range to mask (repeatable)")
+    parser.add_argument('--statistics', nargs='+', default=['median', 'mean', 'clipped_mean'], choices=STATISTICS)
+    parser.add_argument('--percentiles', type=float, nargs='*', default=[16., 84.])
+    parser.add_argument('--clip-sigma', type=float, default=3.)
+    parser.add_argument('--memory', type=float, default=64., help="MB of cube to read at a time")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', default=os.path.join(COMPOSITE_DIR, 'Composite.csv'))
+    args = parser.parse_args(argv)
+
+    if args.from_cube:
+        cube = SpectralCube.open(args.from_cube)
+    else:
+        files = batch_reduce.find_spectrum_files(args.targets)
+        if not files:
+            print("No spectrum files found!")
+            return 1
+        redshifts = {}
+        if args.db:
+            redshifts.update(redshifts_from_db(args.db))
+        if args.redshifts:
+            redshifts.update(read_redshifts(args.redshifts))
+        if args.grid:
+            start, stop, step = args.grid
+            grid = spectrum.UniformGrid(start, step, int(np.floor((stop - start) / step)) + 1)
+        elif args.rest and len(redshifts) < len(files):
+            print("A rest frame stack of objects without known redshifts needs --grid START STOP STEP")
+            return 1
+        else:
+            grid = common_grid(files, args.step, args.rest, redshifts)
+        normalize = None if args.normalize == 'none' else args.normalize
+        cube, errors = build_cube(files, args.cube, grid, redshifts, args.rest, normalize, args.mask,
+                                  workers=args.workers)
+        for error in errors:
+            print(error)
+        print(f"{cube} -> {args.cube}.npy")
+
+    result = composite(cube.pixel_major(args.memory), args.statistics, args.percentiles, clip_sigma=args.clip_sigma, memory_mb=args.memory)
+    write_composite(args.output, cube.grid, result, cube.rest_frame)
+    print(f"Composite of {len(cube)} spectra ({int(result['n'].max())} at most per pixel) -> {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
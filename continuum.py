@@ -0,0 +1,370 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Robust continuum fitting.
+Every pixel goes through a sliding-window percentile prefilter first: the spectrum is cut into short
+blocks, each block is reduced to its percentile, and a running percentile over the neighbouring blocks
+gives one robust sample per block. Emission lines narrower than the window and isolated bad pixels
+don't survive that, and the cost is one sort of very short rows, so it's O(n) in practice.
+
+A smooth curve is then fit to those samples on a Legendre basis over wavelength scaled to [-1, 1]
+(or cubic B-splines), which stays well conditioned at any order, unlike polyfit on raw Angstroms.
+Samples more than upper_sigma above or lower_sigma below the fit are masked and the fit is repeated
+until the mask stops changing. Each pass is one masked least squares solve on a few hundred rows.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+from numpy.polynomial import legendre
+
+import spectrum
+# ----------------------------
+
+
+BASES = ('legendre', 'spline')
+BLOCKS_PER_WINDOW = 8
+EVAL_CHUNK = 1 << 16
+SPECTRA_CHUNK = 512
+
+
+class ContinuumFit():
+    '''
+    Everything define_continuum produces, kept together so the GUI can plot each stage:
+    - sample_wavelengths, sample_fluxes: the prefiltered samples (one per block)
+    - original_yfit: the first, low order fit at the samples, before any clipping
+    - wavelengths, fluxes: the samples that survived clipping
+    - continuum: the final fit at every pixel
+    - model: the final ContinuumModel, to evaluate the continuum anywhere
+    - mask: which samples were kept, n_iter: clipping passes, converged: whether the mask settled
+    '''
+
+    def __init__(self, sample_wavelengths, sample_fluxes, original_yfit, wavelengths, fluxes, continuum,
+                 model=None, mask=None, n_iter=0, converged=True):
+        self.sample_wavelengths = sample_wavelengths
+        self.sample_fluxes = sample_fluxes
+        self.original_yfit = original_yfit
+        self.wavelengths = wavelengths
+        self.fluxes = fluxes
+        self.continuum = continuum
+        self.model = model
+        self.mask = mask
+        self.n_iter = n_iter
+        self.converged = converged
+
+
+class ContinuumModel():
+    '''
+    A fitted continuum: basis coefficients over a wavelength domain mapped onto [-1, 1].
+    Calling it evaluates the continuum at any wavelengths without building a design matrix,
+    so it's cheap on multi-million pixel grids.
+    '''
+
+    def __init__(self, basis, coefficients, domain, knots=None):
+        self.basis = basis
+        self.coefficients = coefficients
+        self.domain = domain
+        self.knots = knots
+
+    def __call__(self, wavelengths):
+        # Chunked so the recurrence's temporaries stay in cache on long spectra
+        n = len(wavelengths)
+        out = np.empty(n)
+        spline = None
+        if self.basis == 'spline':
+            from scipy import interpolate  # only the spline basis needs scipy, so it isn't imported up front
+            spline = interpolate.BSpline(self.knots, self.coefficients, 3)
+        for i in range(0, n, EVAL_CHUNK):
+            x = scale_wavelengths(wavelengths[i:i + EVAL_CHUNK], self.domain)
+            out[i:i + EVAL_CHUNK] = spline(x) if spline is not None else legendre.legval(x, self.coefficients)
+        return out
+
+
+# ----------------------------
+# Prefilter
+# ----------------------------
+def good_pixels(fluxes):
+    '''
+    Pixels that carry data: finite and not exactly zero (the files pad missing pixels with 0).
+    '''
+    fluxes = np.asarray(fluxes)
+    return np.isfinite(fluxes) & (fluxes != 0)
+
+
+def _row_percentile(rows, q):
+    '''
+    Percentile of every row of a 2D array, ignoring NaNs. Complete rows go through np.percentile
+    (a partial sort, linear time); only rows with gaps are fully sorted.
+    Rows with no finite values give NaN. Returns (values, number of finite values per row).
+    '''
+    count = np.sum(np.isfinite(rows), axis=1)
+    values = np.full(len(rows), np.nan)
+    full = count == rows.shape[1]
+    if np.any(full):
+        values[full] = np.percentile(rows[full], q, axis=1)
+
+    partial = ~full & (count > 0)
+    if np.any(partial):
+        sorted_rows = np.sort(rows[partial], axis=1)
+        last = count[partial] - 1
+        pos = q / 100. * last
+        lo = np.floor(pos).astype(np.intp)
+        hi = np.minimum(lo + 1, last)
+        idx = np.arange(len(sorted_rows))
+        values[partial] = sorted_rows[idx, lo] + (pos - lo) * (sorted_rows[idx, hi] - sorted_rows[idx, lo])
+    return values, count
+
+
+def running_percentile(wavelengths, fluxes, window=200., q=50., mask=None, blocks_per_window=BLOCKS_PER_WINDOW):
+    '''
+    Sliding-window percentile of fluxes over window Angstroms, evaluated once per block of
+    window / blocks_per_window. Each block is reduced to its percentile and then a running percentile
+    is taken over the blocks_per_window (+1) neighbouring blocks, which approximates the exact
+    sliding percentile for a fraction of the cost. Pixels outside mask (default: good_pixels) are ignored.
+    fluxes can also be 2D, one spectrum per row on the shared wavelengths.
+    Returns (block centre wavelengths, percentiles, good pixel count) with NaN for empty windows.
+    '''
+    fluxes = np.asarray(fluxes, dtype=np.float64)
+    n = fluxes.shape[-1]
+    if mask is None:
+        mask = good_pixels(fluxes)
+    w0, w1 = float(wavelengths[0]), float(wavelengths[-1])
+    pixel = (w1 - w0) / max(n - 1, 1)
+    block = max(int(round(window / blocks_per_window / pixel)), 1)
+
+    rows = fluxes.reshape(-1, n)
+    n_rows = len(rows)
+    m = -(-n // block)
+    padded = np.full((n_rows, m * block), np.nan)
+    padded[:, :n] = np.where(np.reshape(mask, rows.shape), rows, np.nan)
+    block_values, block_count = _row_percentile(padded.reshape(n_rows * m, block), q)
+
+    # Running percentile over neighbouring blocks (edges padded with NaN so they only see real blocks)
+    half = blocks_per_window // 2
+    width = 2 * half + 1
+    block_values = np.pad(block_values.reshape(n_rows, m), ((0, 0), (half, half)), constant_values=np.nan)
+    neighbours = np.lib.stride_tricks.sliding_window_view(block_values, width, axis=1)
+    values, _ = _row_percentile(neighbours.reshape(n_rows * m, width), q)
+    block_count = np.pad(block_count.reshape(n_rows, m), ((0, 0), (half, half)))
+    count = np.lib.stride_tricks.sliding_window_view(block_count, width, axis=1).sum(axis=-1)
+
+    centres = np.minimum(np.arange(m) * block + (block - 1) / 2., n - 1)
+    if isinstance(wavelengths, spectrum.UniformGrid):
+        sample_wavelengths = wavelengths.start + wavelengths.step * centres
+    else:
+        sample_wavelengths = np.interp(centres, np.arange(n), np.asarray(wavelengths, dtype=np.float64))
+    shape = fluxes.shape[:-1] + (m,)
+    return sample_wavelengths, values.reshape(shape), count.reshape(shape)
+
+
+# ----------------------------
+# Basis and masked least squares
+# ----------------------------
+def scale_wavelengths(wavelengths, domain):
+    lo, hi = domain
+    return (np.asarray(wavelengths, dtype=np.float64) - lo) * (2. / (hi - lo)) - 1.
+
+
+def spline_knots(n_knots):
+    '''
+    Knot vector for cubic B-splines on [-1, 1] with n_knots evenly spaced interior knots.
+    '''
+    interior = np.linspace(-1, 1, n_knots + 2)[1:-1]
+    return np.concatenate([[-1.] * 4, interior, [1.] * 4])
+
+
+def design_matrix(x, basis='legendre', order=5, knots=None):
+    '''
+    Columns of the basis functions at scaled wavelengths x (in [-1, 1]).
+    '''
+    if basis == 'legendre':
+        return legendre.legvander(x, order)
+    if basis == 'spline':
+        from scipy import interpolate
+        return interpolate.BSpline.design_matrix(np.clip(x, -1, 1), knots, 3).toarray()
+    raise ValueError(f'Unknown basis {basis!r}, expected one of {BASES}')
+
+
+def masked_lstsq(design, y, mask, weights=None):
+    '''
+    Least squares coefficients using only the rows in mask, optionally weighted.
+    '''
+    a, b = design[mask], y[mask]
+    if weights is not None:
+        w = weights[mask]
+        a, b = a * w[:, None], b * w
+    return np.linalg.lstsq(a, b, rcond=None)[0]
+
+
+def sigma_clip_fit(design, y, mask, weights=None, upper_sigma=2.5, lower_sigma=3., max_iter=20):
+    '''
+    Fits, masks everything more than upper_sigma above / lower_sigma below the fit (sigma from the
+    median absolute deviation of the kept residuals) and refits, until the mask stops changing.
+    Rejected points can come back if a later fit moves towards them.
+    Returns (coefficients, kept mask, iterations, converged).
+    '''
+    valid = mask.copy()
+    kept = mask.copy()
+    for n_iter in range(1, max_iter + 1):
+        coefficients = masked_lstsq(design, y, kept, weights)
+        residuals = y - design @ coefficients
+        sigma = 1.4826 * np.median(np.abs(residuals[kept] - np.median(residuals[kept])))
+        if not sigma > 0:
+            return coefficients, kept, n_iter, True
+        new_kept = valid & (residuals <= upper_sigma * sigma) & (residuals >= -lower_sigma * sigma)
+        if new_kept.sum() <= design.shape[1]:
+            return coefficients, kept, n_iter, False
+        if np.array_equal(new_kept, kept):
+            return coefficients, kept, n_iter, True
+        kept = new_kept
+    return masked_lstsq(design, y, kept, weights), kept, max_iter, False
+
+
+# ----------------------------
+# Continuum
+# ----------------------------
+def fit_continuum(wavelengths, fluxes, window=200., percentile=50., first_order=3, final_order=5,
+                  upper_sigma=2.5, lower_sigma=3., max_iter=20, basis='legendre', n_knots=8, mask=None):
+    '''
+    Prefilters every pixel with a running percentile over window Angstroms, fits a first_order
+    Legendre polynomial to the samples (original_yfit), then sigma clips to convergence with the
+    final basis: Legendre of final_order, or cubic B-splines with n_knots interior knots.
+    Returns a ContinuumFit with the continuum at every pixel.
+    '''
+    sample_wavelengths, sample_fluxes, count = running_percentile(wavelengths, fluxes, window, percentile, mask)
+    valid = np.isfinite(sample_fluxes)
+    if valid.sum() <= max(first_order, final_order) + 1:
+        raise ValueError('Not enough good pixels to fit a continuum')
+
+    domain = (float(wavelengths[0]), float(wavelengths[-1]))
+    x = scale_wavelengths(sample_wavelengths, domain)
+    # Fluxes are ~1e-16, so fit in units of the median sample to keep the residual statistics sane
+    scale = np.median(np.abs(sample_fluxes[valid])) or 1.
+    y = np.where(valid, sample_fluxes / scale, 0.)
+    weights = np.sqrt(count.astype(np.float64))
+
+    first = design_matrix(x, 'legendre', first_order)
+    original_yfit = first @ masked_lstsq(first, y, valid, weights) * scale
+
+    knots = spline_knots(n_knots) if basis == 'spline' else None
+    design = design_matrix(x, basis, final_order, knots)
+    coefficients, kept, n_iter, converged = sigma_clip_fit(design, y, valid, weights, upper_sigma, lower_sigma, max_iter)
+
+    model = ContinuumModel(basis, coefficients * scale, domain, knots)
+    return ContinuumFit(sample_wavelengths, sample_fluxes, original_yfit, sample_wavelengths[kept], sample_fluxes[kept],
+                        model(wavelengths), model, kept, n_iter, converged)
+
+
+# ----------------------------
+# Many spectra on one grid
+# ----------------------------
+def batched_lstsq(q, y, w2):
+    '''
+    Weighted least squares for every row of y at once, against one shared design matrix given by
+    the orthonormal q of its reduced QR. w2 holds each row's squared weights, 0 where a sample is masked.
+    All N normal equations come out of a single matrix product, G[k] = sum_m w2[k, m] q[m]^T q[m],
+    and with orthonormal columns they stay well conditioned.
+    Returns the coefficients in the q basis (N x p), NaN for rows with too few samples to fit.
+    '''
+    p = q.shape[1]
+    outer = (q[:, :, None] * q[:, None, :]).reshape(len(q), p * p)
+    gram = (w2 @ outer).reshape(-1, p, p)
+    rhs = (w2 * y) @ q
+    ok = np.count_nonzero(w2, axis=1) > p
+    z = np.full((len(y), p), np.nan)
+    if np.any(ok):
+        try:
+            z[ok] = np.linalg.solve(gram[ok], rhs[ok][..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            # Some mask left a basis function with no support (e.g. a spline knot span inside a gap)
+            z[ok] = (np.linalg.pinv(gram[ok]) @ rhs[ok][..., None])[..., 0]
+    return z
+
+
+def sigma_clip_fits(q, y, valid, weights, upper_sigma=2.5, lower_sigma=3., max_iter=20):
+    '''
+    sigma_clip_fit for every row of y at once. Each pass refits only the spectra whose mask is still
+    changing, with one batched_lstsq, and clips all of them with whole-array operations.
+    Returns (q basis coefficients, kept masks, iterations, converged), one row/entry per spectrum.
+    '''
+    n_spectra, p = len(y), q.shape[1]
+    w2 = weights ** 2
+    kept = valid.copy()
+    z = np.full((n_spectra, p), np.nan)
+    n_iter = np.zeros(n_spectra, dtype=int)
+    converged = np.zeros(n_spectra, dtype=bool)
+    active = np.arange(n_spectra)
+
+    for iteration in range(1, max_iter + 1):
+        z[active] = batched_lstsq(q, y[active], w2[active] * kept[active])
+        n_iter[active] = iteration
+        residuals = y[active] - z[active] @ q.T
+        kept_residuals = np.where(kept[active], residuals, np.nan)
+        median, _ = _row_percentile(kept_residuals, 50.)
+        sigma = 1.4826 * _row_percentile(np.abs(kept_residuals - median[:, None]), 50.)[0]
+
+        new_kept = valid[active] & (residuals <= upper_sigma * sigma[:, None]) & (residuals >= -lower_sigma * sigma[:, None])
+        settled = ~(sigma > 0) | np.all(new_kept == kept[active], axis=1)
+        starved = ~settled & (new_kept.sum(axis=1) <= p)
+        converged[active[settled]] = True
+        moving = ~(settled | starved)
+        kept[active[moving]] = new_kept[moving]
+        active = active[moving]
+        if not len(active):
+            break
+    else:
+        z[active] = batched_lstsq(q, y[active], w2[active] * kept[active])
+
+    converged &= np.all(np.isfinite(z), axis=1)
+    return z, kept, n_iter, converged
+
+
+def fit_continua(wavelengths, fluxes, window=200., percentile=50., first_order=3, final_order=5,
+                 upper_sigma=2.5, lower_sigma=3., max_iter=20, basis='legendre', n_knots=8, mask=None):
+    '''
+    fit_continuum for many spectra on the same wavelength grid, fluxes being N x n (one spectrum per row).
+    The design matrix is built and QR factorised once, and every least squares solve and clipping pass
+    covers all N spectra at once, so thousands of continua cost about as much as a few single fits.
+    Returns a list of N ContinuumFits whose continua are rows of one N x n array.
+    Spectra with too few good pixels get a NaN continuum and converged=False instead of an error.
+    '''
+    n_spectra, n = np.shape(fluxes)
+    # Prefilter a few hundred spectra at a time so the float64 scratch copies stay small
+    values, counts = [], []
+    for i in range(0, n_spectra, SPECTRA_CHUNK):
+        chunk_mask = None if mask is None else mask[i:i + SPECTRA_CHUNK]
+        sample_wavelengths, chunk_values, chunk_count = running_percentile(wavelengths, fluxes[i:i + SPECTRA_CHUNK],
+                                                                           window, percentile, chunk_mask)
+        values.append(chunk_values)
+        counts.append(chunk_count)
+    sample_fluxes = np.concatenate(values)
+    valid = np.isfinite(sample_fluxes)
+
+    domain = (float(wavelengths[0]), float(wavelengths[-1]))
+    x = scale_wavelengths(sample_wavelengths, domain)
+    scale, _ = _row_percentile(np.where(valid, np.abs(sample_fluxes), np.nan), 50.)
+    scale[~(scale > 0)] = 1.
+    y = np.where(valid, sample_fluxes / scale[:, None], 0.)
+    weights = np.sqrt(np.concatenate(counts).astype(np.float64)) * valid
+
+    q, _ = np.linalg.qr(design_matrix(x, 'legendre', first_order))
+    original_yfit = batched_lstsq(q, y, weights ** 2) @ q.T * scale[:, None]
+
+    knots = spline_knots(n_knots) if basis == 'spline' else None
+    q, r = np.linalg.qr(design_matrix(x, basis, final_order, knots))
+    z, kept, n_iter, converged = sigma_clip_fits(q, y, valid, weights, upper_sigma, lower_sigma, max_iter)
+    coefficients = np.linalg.solve(r, z.T).T * scale[:, None]
+
+    # Every continuum on the full grid from one product per chunk of pixels
+    continua = np.empty((n_spectra, n))
+    for i in range(0, n, EVAL_CHUNK):
+        x_chunk = scale_wavelengths(wavelengths[i:i + EVAL_CHUNK], domain)
+        continua[:, i:i + EVAL_CHUNK] = coefficients @ design_matrix(x_chunk, basis, final_order, knots).T
+
+    return [ContinuumFit(sample_wavelengths, sample_fluxes[k], original_yfit[k], sample_wavelengths[kept[k]],
+                         sample_fluxes[k, kept[k]], continua[k], ContinuumModel(basis, coefficients[k], domain, knots),
+                         kept[k], int(n_iter[k]), bool(converged[k]))
+            for k in range(n_spectra)]
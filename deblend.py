@@ -0,0 +1,466 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Deblending: several Gaussians (plus an optional straight line for whatever the continuum fit left over)
+fit jointly over one window, for lines that sit on top of each other like Hb + [O III] or Ha + [N II].
+A single Gaussian fit to one of those gets dragged around by its neighbours.
+
+Components can be tied together through shared parameters:
+- velocity group: one shift v for the group, centre = rest (1 + z)(1 + v)
+- width group: one velocity width s for the group, sigma = rest (1 + z) s
+- amplitude group: one amplitude a for the group, each member's amplitude = ratio * a
+  (e.g. [O III] 4959 = 5007 / 2.98 from atomic physics)
+so a doublet costs three parameters instead of six, and its lines can't wander apart.
+Amplitudes are kept positive, shifts within MAX_SHIFT_KMS and widths under MAX_FWHM_KMS.
+
+The fit is Levenberg-Marquardt with the analytic Jacobian, and no finite differences (which would cost a
+full model evaluation per parameter). Each component is only evaluated within SUPPORT sigma of its centre, so
+its derivatives fill a narrow band of pixels; the Jacobian is built as a sparse matrix from those bands and
+pushed through the tying, so the work per iteration grows with the pixels each line covers rather than
+with K times the whole window.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+
+import spectrum
+import line_measure
+import noise as noise_module
+import profiling
+from spectral_core import SpectralLine, estimate_noise
+from redshift import C_KMS
+# ----------------------------
+
+
+# Components are evaluated out to this many sigma from their centres (exp(-32) beyond)
+SUPPORT = 8.
+# Widest line allowed: without a cap a very broad, negative Gaussian can trade off against the baseline
+MAX_FWHM_KMS = 20000.
+# Largest velocity shift from the starting redshift, which keeps weak lines from wandering out of the window
+MAX_SHIFT_KMS = 5000.
+
+
+class Component():
+    '''
+    One Gaussian of a blend.
+    - rest: rest wavelength (or, with z = 0, the observed wavelength to start from)
+    - velocity, width, amplitude: names of the groups it shares those parameters with (its own name if None)
+    - ratio: amplitude relative to its amplitude group
+    - fwhm_kms: starting width
+    '''
+
+    def __init__(self, name, rest, velocity=None, width=None, amplitude=None, ratio=1., fwhm_kms=2000.):
+        self.name = name
+        self.rest = rest
+        self.velocity = velocity or name
+        self.width = width or name
+        self.amplitude = amplitude or name
+        self.ratio = ratio
+        self.fwhm_kms = fwhm_kms
+
+    def __repr__(self):
+        # Also the fit_cache key of the component, so every field is in it
+        return (f'Component({self.name!r}, {self.rest!r}, velocity={self.velocity!r}, width={self.width!r}, '
+                f'amplitude={self.amplitude!r}, ratio={self.ratio!r}, fwhm_kms={self.fwhm_kms!r})')
+
+
+# Common blends in quasar spectra, rest (vacuum) wavelengths as in redshift.QUASAR_LINES.
+# The first component is the one clicked on. Narrow lines share one velocity and width.
+COMPLEXES = {
+    'Hb + [O III]': [
+        Component('[O III] 5007', 5008.24, velocity='narrow', width='narrow', amplitude='[O III]', fwhm_kms=500.),
+        Component('[O III] 4959', 4960.30, velocity='narrow', width='narrow', amplitude='[O III]', ratio=1 / 2.98,
+                  fwhm_kms=500.),
+        Component('Hb', 4862.68, fwhm_kms=4000.),
+        Component('Hb narrow', 4862.68, velocity='narrow', width='narrow', fwhm_kms=500.),
+    ],
+    'Ha + [N II]': [
+        Component('Ha', 6564.61, fwhm_kms=4000.),
+        Component('Ha narrow', 6564.61, velocity='narrow', width='narrow', fwhm_kms=500.),
+        Component('[N II] 6583', 6585.27, velocity='narrow', width='narrow', amplitude='[N II]', fwhm_kms=500.),
+        Component('[N II] 6548', 6549.86, velocity='narrow', width='narrow', amplitude='[N II]', ratio=1 / 3.05,
+                  fwhm_kms=500.),
+    ],
+    'Mg II': [
+        # The broad doublet is optically thick (about 1:1) and far narrower than the lines, so its ratio is held
+        Component('Mg II 2796', 2796.35, velocity='Mg II', width='Mg II', amplitude='Mg II', fwhm_kms=3000.),
+        Component('Mg II 2803', 2803.53, velocity='Mg II', width='Mg II', amplitude='Mg II', fwhm_kms=3000.),
+    ],
+}
+
+
+class BlendFit():
+    '''
+    - components: the Components that were fit
+    - params: (K, 3) amplitude, centre, sigma of every component; covariance: (K, 3, 3)
+    - coefficients / coefficient_covariance: the free (tied) parameters themselves
+    - baseline: (c0, c1) of the straight line c0 + c1 (x - x_mid), zeros without one
+    - z: the redshift the rest wavelengths were shifted by before fitting
+    - converged, chi2, n_iter
+    - xdata, ydata: the window that was fit (continuum subtracted)
+    '''
+
+    def __init__(self, components, params, covariance, coefficients, coefficient_covariance, baseline, x_mid, z,
+                 converged, chi2, n_iter, xdata, ydata):
+        self.components = components
+        self.params = params
+        self.covariance = covariance
+        self.coefficients = coefficients
+        self.coefficient_covariance = coefficient_covariance
+        self.baseline = baseline
+        self.x_mid = x_mid
+        self.z = z
+        self.converged = converged
+        self.chi2 = chi2
+        self.n_iter = n_iter
+        self.xdata = xdata
+        self.ydata = ydata
+
+    def component_profiles(self, x):
+        '''
+        (K, len(x)) array of every component's Gaussian.
+        '''
+        x = np.asarray(x, dtype=float)
+        a, mu, sigma = self.params[:, 0:1], self.params[:, 1:2], self.params[:, 2:3]
+        return a * np.exp(-((x - mu) / sigma) ** 2 / 2)
+
+    def baseline_at(self, x):
+        return self.baseline[0] + self.baseline[1] * (np.asarray(x, dtype=float) - self.x_mid)
+
+    def model(self, x):
+        return self.component_profiles(x).sum(axis=0) + self.baseline_at(x)
+
+
+# ----------------------------
+# Tying
+# ----------------------------
+def _groups(components, attribute):
+    '''
+    (K, G) membership matrix of the components in the groups named by attribute, and the group names.
+    '''
+    names = []
+    for c in components:
+        if getattr(c, attribute) not in names:
+            names.append(getattr(c, attribute))
+    matrix = np.zeros((len(components), len(names)))
+    for j, c in enumerate(components):
+        matrix[j, names.index(getattr(c, attribute))] = c.ratio if attribute == 'amplitude' else 1.
+    return matrix, names
+
+
+class _Ties():
+    '''
+    The layout of the free parameters: [amplitudes (M), velocities (G), widths (H), baseline (0 or 2)].
+    '''
+
+    def __init__(self, components, baseline):
+        self.amplitude, _ = _groups(components, 'amplitude')
+        self.velocity, _ = _groups(components, 'velocity')
+        self.width, _ = _groups(components, 'width')
+        self.m, self.g, self.h = self.amplitude.shape[1], self.velocity.shape[1], self.width.shape[1]
+        self.n_baseline = 2 if baseline else 0
+        self.n_params = self.m + self.g + self.h + self.n_baseline
+
+    def split(self, p):
+        m, g, h = self.m, self.g, self.h
+        return p[:m], p[m:m + g], p[m + g:m + g + h], p[m + g + h:]
+
+    def limit(self, p):
+        '''
+        Keeps amplitudes positive (these are emission lines), velocity shifts within MAX_SHIFT_KMS
+        and widths between 0 and MAX_FWHM_KMS.
+        '''
+        p = p.copy()
+        m, g, h = self.m, self.g, self.h
+        p[:m] = np.abs(p[:m])
+        p[m:m + g] = np.clip(p[m:m + g], -MAX_SHIFT_KMS / C_KMS, MAX_SHIFT_KMS / C_KMS)
+        p[m + g:m + g + h] = np.clip(np.abs(p[m + g:m + g + h]), 0., MAX_FWHM_KMS / C_KMS / 2.3548)
+        return p
+
+    def component_params(self, p, lam):
+        '''
+        Amplitude, centre and sigma of every component from the free parameters (lam = rest (1 + z)).
+        '''
+        a, v, s, _ = self.split(p)
+        return self.amplitude @ a, lam * (1 + self.velocity @ v), lam * np.abs(self.width @ s)
+
+    def transform(self, lam):
+        '''
+        (K, 3, P) derivatives of every component's (amplitude, centre, sigma) with respect to the free parameters.
+        The widths enter through |s|, and limit keeps s positive after every step, so the derivative is +lam.
+        '''
+        t = np.zeros((len(lam), 3, self.n_params))
+        m, g, h = self.m, self.g, self.h
+        t[:, 0, :m] = self.amplitude
+        t[:, 1, m:m + g] = lam[:, None] * self.velocity
+        t[:, 2, m + g:m + g + h] = lam[:, None] * self.width
+        return t
+
+
+def _profiles(x, p, ties, lam):
+    '''
+    Every component evaluated on its own support only (SUPPORT sigma either side of its centre), as (K, W)
+    arrays over the pixel indices cols, W being the widest support. Returns (cols, u, e, g, sigma).
+    '''
+    amplitude, mean, sigma = ties.component_params(p, lam)
+    n = len(x)
+    lo = np.searchsorted(x, mean - SUPPORT * sigma)
+    hi = np.searchsorted(x, mean + SUPPORT * sigma)
+    width = max(int((hi - lo).max()), 1)
+    cols = lo[:, None] + np.arange(width)
+    inside = cols < hi[:, None]
+    cols = np.minimum(cols, n - 1)
+    u = (x[cols] - mean[:, None]) / sigma[:, None]
+    e = np.where(inside, np.exp(-u ** 2 / 2), 0.)
+    return cols, u, e, amplitude[:, None] * e, sigma
+
+
+def _model(x, xc, p, ties, lam):
+    cols, _, _, g, _ = _profiles(x, p, ties, lam)
+    model = np.bincount(cols.ravel(), weights=g.ravel(), minlength=len(x))
+    if ties.n_baseline:
+        model += p[-2] + p[-1] * xc
+    return model
+
+
+def _model_jacobian(x, xc, p, ties, lam, transform):
+    '''
+    Model and sparse (pixels, P) Jacobian for the free parameters p.
+    transform is _transform_matrix(ties, lam).
+    '''
+    from scipy import sparse  # only deblending needs it, so it isn't imported up front
+    n, k = len(x), len(lam)
+    cols, u, e, g, sigma = _profiles(x, p, ties, lam)
+    model = np.bincount(cols.ravel(), weights=g.ravel(), minlength=n)
+    # Derivatives of each component's profile with respect to its own amplitude, centre and sigma,
+    # only non-zero on each component's support, then the baseline's two columns ...
+    d_mean = g * u / sigma[:, None]
+    data = np.stack([e, d_mean, d_mean * u], axis=1)
+    rows = np.broadcast_to(cols[:, None, :], data.shape).ravel()
+    columns = np.broadcast_to(3 * np.arange(k)[:, None, None] + np.arange(3)[None, :, None], data.shape).ravel()
+    data = data.ravel()
+    if ties.n_baseline:
+        model += p[-2] + p[-1] * xc
+        pixels = np.arange(n)
+        rows = np.concatenate([rows, pixels, pixels])
+        columns = np.concatenate([columns, np.full(n, 3 * k), np.full(n, 3 * k + 1)])
+        data = np.concatenate([data, np.ones(n), xc])
+    d = sparse.csr_matrix((data, (rows, columns)), shape=(n, transform.shape[0]))
+    # ... pushed through the tying to the free parameters
+    return model, d @ transform
+
+
+def _transform_matrix(ties, lam):
+    '''
+    Sparse (3K + baseline, P) matrix taking the Jacobian of every component's own parameters
+    (and the baseline) to the Jacobian of the free parameters.
+    '''
+    from scipy import sparse
+    t = ties.transform(lam).reshape(3 * len(lam), ties.n_params)
+    if ties.n_baseline:
+        baseline = np.zeros((2, ties.n_params))
+        baseline[:, -2:] = np.eye(2)
+        t = np.vstack([t, baseline])
+    return sparse.csr_matrix(t)
+
+
+def _normal_equations(jac, w, r):
+    wj = jac.multiply(w[:, None]).tocsr()
+    return (jac.T @ wj).toarray(), wj.T @ r
+
+
+# ----------------------------
+# Fitting
+# ----------------------------
+def initial_parameters(x, y, components, z, ties):
+    '''
+    Starting amplitudes from the residual at each group's lines (shared between components on the same line),
+    zero velocity shifts, widths from each component's fwhm_kms, and a flat zero baseline.
+    '''
+    rest = np.array([c.rest for c in components])
+    lam = rest * (1 + z)
+    height = np.interp(lam, x, y)
+    # Components on (almost) the same line, like broad and narrow Ha, split the height between them
+    overlapping = (np.abs(rest[:, None] - rest[None, :]) < 1.).sum(axis=1)
+    share = height / overlapping
+    with np.errstate(invalid='ignore', divide='ignore'):
+        per_group = np.where(ties.amplitude > 0, share[:, None] / ties.amplitude, np.nan)
+    a = np.nanmax(per_group, axis=0)
+    a = np.where(np.isfinite(a) & (a > 0), a, np.abs(y).max() / 10)
+    v = np.zeros(ties.g)
+    fwhm = np.array([c.fwhm_kms for c in components])
+    width_share = ties.width / ties.width.sum(axis=0)
+    s = (fwhm / C_KMS / 2.3548) @ width_share
+    return np.concatenate([a, v, s, np.zeros(ties.n_baseline)])
+
+
+@profiling.profiled('fit_blend')
+def fit_blend(x, y, components, z=0., weights=None, baseline=True, p0=None, max_iter=200, tol=1e-10, lam0=1e-3):
+    '''
+    Fits all the components to the continuum subtracted window (x, y) at once.
+    The rest wavelengths are shifted by z first (z = 0 if they are observed wavelengths already).
+    weights are 1/sigma^2 per pixel (default 1); baseline adds a straight line under the lines.
+    Returns a BlendFit, with the covariance scaled by the reduced chi^2 like fit_gaussians.
+    '''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    good = np.isfinite(x) & np.isfinite(y)
+    w = np.where(good, 1. if weights is None else np.asarray(weights, dtype=np.float64), 0.)
+    y = np.where(good, y, 0.)
+    ties = _Ties(components, baseline)
+    lam = np.array([c.rest for c in components], dtype=np.float64) * (1 + z)
+    x_mid = 0.5 * (x[good].min() + x[good].max()) if good.any() else 0.
+    # The baseline's slope is per (x - x_mid) / half span, which keeps the normal equations well scaled
+    half_span = max(0.5 * (x[good].max() - x[good].min()), 1e-12) if good.any() else 1.
+    xc = (x - x_mid) / half_span
+
+    # Fluxes of 1e-16 are scaled to order unity while fitting
+    scale = np.abs(y).max()
+    scale = scale if scale > 0 else 1.
+    yn = y / scale
+    p = initial_parameters(x, yn, components, z, ties) if p0 is None else np.array(p0, dtype=np.float64)
+
+    transform = _transform_matrix(ties, lam)
+
+    def chi2_of(params):
+        r = yn - _model(x, xc, params, ties, lam)
+        return np.dot(w * r, r)
+
+    lam_damp = lam0
+    converged = False
+    model, jac = _model_jacobian(x, xc, p, ties, lam, transform)
+    r = yn - model
+    chi2 = np.dot(w * r, r)
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        jtj, jtr = _normal_equations(jac, w, r)
+        diag = np.diagonal(jtj)
+        damped = jtj + np.diag(lam_damp * np.where(diag > 0, diag, 1.))
+        try:
+            step = np.linalg.solve(damped, jtr)
+        except np.linalg.LinAlgError:
+            step = np.linalg.lstsq(damped, jtr, rcond=None)[0]
+        trial = ties.limit(p + step)
+        trial_chi2 = chi2_of(trial)
+        if np.isfinite(trial_chi2) and trial_chi2 <= chi2:
+            rel = abs(chi2 - trial_chi2) <= tol * max(chi2, 1e-300)
+            small = np.all(np.abs(step) <= np.sqrt(tol) * (np.abs(p) + np.sqrt(tol)))
+            p, chi2 = trial, trial_chi2
+            model, jac = _model_jacobian(x, xc, p, ties, lam, transform)
+            r = yn - model
+            lam_damp /= 10.
+            if rel or small:
+                converged = True
+                break
+        else:
+            lam_damp *= 10.
+            if lam_damp > 1e12:
+                converged = True
+                break
+    # Covariance from the undamped normal equations at the solution
+    jtj, _ = _normal_equations(jac, w, r)
+    dof = max(int(good.sum()) - ties.n_params, 1)
+    # Inverted with every parameter scaled to unit diagonal, since velocities and amplitudes differ by orders of magnitude
+    diag = np.diagonal(jtj)
+    unit = 1 / np.sqrt(np.where(diag > 0, diag, 1.))
+    scaled = jtj * unit[:, None] * unit[None, :]
+    if np.all(np.isfinite(scaled)) and np.linalg.cond(scaled) < 1 / np.finfo(float).eps:
+        cov_n = np.linalg.inv(scaled) * unit[:, None] * unit[None, :] * chi2 / dof
+    else:
+        cov_n = np.full((ties.n_params, ties.n_params), np.inf)
+        converged = False
+
+    # Back to flux units: amplitudes and baseline scale with y, velocities and widths are dimensionless
+    units = np.ones(ties.n_params)
+    units[:ties.m] = scale
+    if ties.n_baseline:
+        units[-2:] = scale, scale / half_span
+    coefficients = p * units
+    coefficient_covariance = cov_n * units[:, None] * units[None, :]
+
+    amplitude, mean, sigma = ties.component_params(coefficients, lam)
+    params = np.stack([amplitude, mean, sigma], axis=1)
+    # Each component's (amplitude, centre, sigma) covariance, T C T^T, through the sparse transform
+    k = len(lam)
+    tc = np.asarray(transform @ coefficient_covariance)[:3 * k].reshape(k, 3, -1)
+    covariance = np.einsum('kip,kjp->kij', tc, ties.transform(lam))
+    baseline_params = coefficients[-2:] if ties.n_baseline else np.zeros(2)
+    converged = converged and bool(np.all(np.isfinite(params)))
+    return BlendFit(components, params, covariance, coefficients, coefficient_covariance, baseline_params, x_mid, z,
+                    converged, chi2 * scale ** 2, n_iter, x, y)
+
+
+# ----------------------------
+# From a spectrum
+# ----------------------------
+def blend_window(wavelengths, fluxes, continuum, components, z, noise=None):
+    '''
+    Pixel range (lo, hi inclusive) covering every component out to where the blend drops into the noise
+    (noise.line_bounds at each component's expected centre), and at least 3 starting sigma (fwhm_kms) either side,
+    so weak lines still get enough baseline to tell them from the straight line under them.
+    '''
+    if noise is None:
+        noise = noise_module.noise_map(wavelengths, fluxes)
+    centres = np.array([c.rest for c in components]) * (1 + z)
+    sigmas = centres * np.array([c.fwhm_kms for c in components]) / C_KMS / 2.3548
+    n = len(fluxes)
+    peaks = np.clip(spectrum.searchsorted(wavelengths, centres), 0, n - 1)
+    lo, hi = noise_module.line_bounds(fluxes - continuum, noise, peaks)
+    lo_wide = np.clip(spectrum.searchsorted(wavelengths, centres - 3 * sigmas), 0, n - 1)
+    hi_wide = np.clip(spectrum.searchsorted(wavelengths, centres + 3 * sigmas), 0, n - 1)
+    return int(min(lo.min(), lo_wide.min())), int(max(hi.max(), hi_wide.max()))
+
+
+@profiling.profiled('deblend')
+def deblend(wavelengths, fluxes, continuum, components, xclick=None, z=None, noise=None, baseline=True, cache=None):
+    '''
+    Deblends one complex of a spectrum. components is a list of Components or a key of COMPLEXES.
+    The redshift comes from z, or from xclick: the peak within 15 pixels of the click is taken to be
+    the first component. The window is blend_window's, and every pixel is weighted by the noise map
+    (noise, or estimate_noise through cache, a fit_cache.ResultCache, so it is worked out once per spectrum).
+    Returns (lines, fit): a SpectralLine per component (named, with rest wavelength and redshift,
+    flux and equivalent width errors from the tied covariance), or lines = [] if the fit didn't converge.
+    '''
+    if isinstance(components, str):
+        components = COMPLEXES[components]
+    if not isinstance(wavelengths, spectrum.UniformGrid):
+        wavelengths = np.asarray(wavelengths, dtype=float)
+    fluxes = np.asarray(fluxes, dtype=float)
+    continuum = np.asarray(continuum, dtype=float)
+    n = len(fluxes)
+    if noise is None:
+        noise = estimate_noise(wavelengths, fluxes, cache)
+    if z is None:
+        index = int(spectrum.searchsorted(wavelengths, float(xclick)))
+        cols = np.arange(max(index - 15, 0), min(index + 15, n))
+        peak = cols[np.argmax(fluxes[cols] - continuum[cols])]
+        z = float(spectrum.take(wavelengths, peak)) / components[0].rest - 1
+
+    lo, hi = blend_window(wavelengths, fluxes, continuum, components, z, noise)
+    cols = np.arange(lo, hi + 1)
+    x = spectrum.take(wavelengths, cols)
+    y = fluxes[cols] - continuum[cols]
+    with np.errstate(divide='ignore'):
+        weights = np.where(np.isfinite(noise[cols]) & (noise[cols] > 0), 1. / noise[cols] ** 2, 0.)
+    # Relative weights are all the fit needs, and keep it away from 1e32 sized numbers
+    weights = weights / weights.max() if weights.max() > 0 else None
+    fit = fit_blend(x, y, components, z=z, weights=weights, baseline=baseline)
+    if not fit.converged:
+        return [], fit
+
+    measured = line_measure.measure_lines(fit.params, wavelengths, continuum, fit.covariance)
+    with np.errstate(invalid='ignore'):
+        errors = np.sqrt(np.diagonal(fit.covariance, axis1=1, axis2=2))
+    lines = []
+    for j, c in enumerate(components):
+        amplitude, mean, _ = fit.params[j]
+        peak_flux = spectrum.interp(wavelengths, continuum, np.array([mean]))[0] + amplitude
+        lines.append(SpectralLine(wavelength=mean, params=fit.params[j], eq_wid=measured.eq_wid[j], max_flux=peak_flux,
+                                  total_flux=measured.flux[j], eq_wid_err=measured.eq_wid_err[j],
+                                  total_flux_err=measured.flux_err[j], name=c.name, rest_wav=c.rest,
+                                  redshift=mean / c.rest - 1, center_err=errors[j, 1], sigma_err=errors[j, 2]))
+    return lines, fit
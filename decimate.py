@@ -0,0 +1,79 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Level-of-detail decimation for plotting very long spectra.
+A min/max pyramid is built once per spectrum: level k keeps the minimum and maximum flux of every
+block of factor**k pixels. To draw a view, the coarsest level that still gives about two points per
+screen pixel is picked, and each visible block is drawn as a vertical min -> max stroke. Matplotlib
+then only ever gets a few thousand points no matter how long the spectrum is, and since every block
+keeps its extremes, no peak or dip ever disappears from the plot.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+
+import spectrum
+# ----------------------------
+
+
+class LODPyramid():
+    '''
+    Min/max pyramid over (wavelengths, fluxes).
+    wavelengths can be a spectrum.UniformGrid or an array; level 0 is the raw data itself.
+    '''
+
+    def __init__(self, wavelengths, fluxes, factor=4, min_blocks=256):
+        self.wavelengths = wavelengths
+        self.fluxes = np.asarray(fluxes)
+        self.factor = int(factor)
+        self.n = len(self.fluxes)
+
+        # levels[k] = (block minima, block maxima) for k >= 1. Block wavelengths are looked up
+        # at render time, which only ever touches a few thousand of them.
+        self.levels = [None]
+        lo = hi = self.fluxes
+        while len(lo) > min_blocks:
+            starts = np.arange(0, len(lo), self.factor)
+            lo = np.minimum.reduceat(lo, starts)
+            hi = np.maximum.reduceat(hi, starts)
+            self.levels.append((lo, hi))
+
+    @property
+    def nbytes(self):
+        return sum(lo.nbytes + hi.nbytes for lo, hi in self.levels[1:])
+
+    def level_for(self, n_visible, max_points):
+        '''
+        Coarsest level needed so n_visible pixels come out as at most max_points points (two per block).
+        '''
+        if n_visible <= max_points:
+            return 0
+        level = int(np.ceil(np.log(2. * n_visible / max_points) / np.log(self.factor)))
+        return min(level, len(self.levels) - 1)
+
+    def render(self, xlo, xhi, max_points):
+        '''
+        (x, y) to plot for the wavelength range xlo..xhi with roughly max_points points.
+        One pixel either side of the range is included so lines run off the edge of the axes.
+        '''
+        i0 = max(int(spectrum.searchsorted(self.wavelengths, xlo)) - 1, 0)
+        i1 = min(int(spectrum.searchsorted(self.wavelengths, xhi)) + 1, self.n)
+        level = self.level_for(i1 - i0, max_points)
+        if level == 0:
+            return np.asarray(self.wavelengths[i0:i1], dtype=float), self.fluxes[i0:i1]
+
+        block = self.factor ** level
+        lo, hi = self.levels[level]
+        b0, b1 = i0 // block, -(-i1 // block)
+        xs = np.repeat(spectrum.take(self.wavelengths, np.arange(b0, b1) * block), 2)
+        ys = np.empty(2 * (b1 - b0), dtype=lo.dtype)
+        ys[0::2] = lo[b0:b1]
+        ys[1::2] = hi[b0:b1]
+        return xs, ys
+
+    def render_all(self, max_points):
+        return self.render(-np.inf, np.inf, max_points)
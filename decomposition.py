@@ -0,0 +1,384 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Eigenspectra of many quasars, for classifying spectral types (goal 4 of the proposal).
+The spectra are continuum normalized and resampled onto one grid by composite.py (a memory mapped
+SpectralCube, built from the same reader and continuum fit the GUI uses), then decomposed with an
+incremental PCA that only ever holds one chunk of spectra:
+
+1. one pass counts the objects covering each pixel and accumulates the mean spectrum; pixels covered by
+   fewer than min_coverage of the objects are dropped, and gaps in the rest are filled with the mean
+2. one pass updates the eigenspectra chunk by chunk: the current components (scaled by their singular values),
+   the new centred chunk and a mean correction row are stacked and re-decomposed with one thin SVD
+   (Ross et al. 2008, as in scikit-learn's IncrementalPCA)
+3. one pass projects every object onto the top components
+
+Each pass is linear in the number of objects and memory is bounded by the chunk size.
+The coefficients are what classification works on: k-means classes, and nearest neighbours
+(objects with the most similar spectra) by distance between coefficient vectors.
+
+    >>> python decomposition.py --cube Composites/cube --components 8 --classes 4
+    >>> python decomposition.py "Example Object Files" --components 5 --neighbours J1246
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import sys
+import csv
+import argparse
+
+import numpy as np
+
+import spectrum
+import composite
+import profiling
+# ----------------------------
+
+
+DECOMPOSITION_DIR = './Composites/'
+
+
+class EigenModel():
+    '''
+    The result of an incremental PCA.
+    - grid: the cube's spectrum.UniformGrid; pixels: boolean mask of the grid pixels used
+    - mean: mean spectrum over the used pixels; components: (k, pixels) eigenspectra, orthonormal
+    - singular_values, explained_variance, explained_variance_ratio: per component
+    - n_objects: how many spectra went in
+    '''
+
+    def __init__(self, grid, pixels, mean, components, singular_values, explained_variance, total_variance, n_objects):
+        self.grid = grid
+        self.pixels = pixels
+        self.mean = mean
+        self.components = components
+        self.singular_values = singular_values
+        self.explained_variance = explained_variance
+        self.total_variance = total_variance
+        self.n_objects = n_objects
+
+    def __repr__(self):
+        ratio = self.explained_variance_ratio
+        return (f'EigenModel({len(self.components)} components of {int(self.pixels.sum())} pixels from {self.n_objects} '
+                f'objects, {ratio.sum():.1%} of the variance)')
+
+    @property
+    def explained_variance_ratio(self):
+        return self.explained_variance / self.total_variance if self.total_variance > 0 else np.zeros(len(self.components))
+
+    def fill(self, rows):
+        '''
+        The used pixels of rows (n, grid pixels), with gaps filled from the mean spectrum.
+        '''
+        x = np.asarray(rows, dtype=np.float64)[:, self.pixels]
+        return np.where(np.isfinite(x), x, self.mean)
+
+    def transform(self, rows):
+        '''
+        Coefficients (n, k) of rows on the components.
+        '''
+        return (self.fill(rows) - self.mean) @ self.components.T
+
+    def reconstruct(self, coefficients):
+        '''
+        Spectra (on the used pixels) rebuilt from coefficients.
+        '''
+        return self.mean + np.asarray(coefficients) @ self.components
+
+    def save(self, path):
+        np.savez(path, start=self.grid.start, step=self.grid.step, n=self.grid.n, pixels=self.pixels, mean=self.mean,
+                 components=self.components, singular_values=self.singular_values,
+                 explained_variance=self.explained_variance, total_variance=self.total_variance, n_objects=self.n_objects)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            grid = spectrum.UniformGrid(float(data['start']), float(data['step']), int(data['n']))
+            return cls(grid, data['pixels'], data['mean'], data['components'], data['singular_values'],
+                       data['explained_variance'], float(data['total_variance']), int(data['n_objects']))
+
+
+# ----------------------------
+# Incremental PCA
+# ----------------------------
+def _chunks(n, chunk):
+    for lo in range(0, n, chunk):
+        yield lo, min(lo + chunk, n)
+
+
+def coverage_and_mean(fluxes, chunk=1000):
+    '''
+    First pass: objects with data in each pixel, the mean of those values, and whether each object has any data.
+    '''
+    n_objects, n_pixels = fluxes.shape
+    counts = np.zeros(n_pixels, dtype=np.int64)
+    sums = np.zeros(n_pixels)
+    has_data = np.zeros(n_objects, dtype=bool)
+    for lo, hi in _chunks(n_objects, chunk):
+        block = np.asarray(fluxes[lo:hi], dtype=np.float64)
+        finite = np.isfinite(block)
+        counts += finite.sum(axis=0)
+        sums += np.where(finite, block, 0.).sum(axis=0)
+        has_data[lo:hi] = finite.any(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return counts, sums / counts, has_data
+
+
+def _svd_flip(u, vt):
+    '''
+    Makes the largest entry of each component positive, so the signs don't flip from run to run.
+    '''
+    signs = np.sign(vt[np.arange(len(vt)), np.argmax(np.abs(vt), axis=1)])
+    signs[signs == 0] = 1
+    return u * signs, vt * signs[:, None]
+
+
+class IncrementalPCA():
+    '''
+    PCA updated one chunk of rows at a time; only the k components and per-pixel statistics are kept.
+    partial_fit(x) with x (m, p) complete rows; the first call needs m >= k.
+    '''
+
+    def __init__(self, n_components):
+        self.n_components = n_components
+        self.n_seen = 0
+        self.mean = None
+        self.m2 = None
+        self.components = None
+        self.singular_values = None
+
+    def partial_fit(self, x):
+        m = len(x)
+        if m == 0:
+            return self
+        batch_mean = x.mean(axis=0)
+        centred = x - batch_mean
+        batch_m2 = np.sum(centred ** 2, axis=0)
+        if self.n_seen == 0:
+            stacked = centred
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            n_total = self.n_seen + m
+            delta = self.mean - batch_mean
+            correction = np.sqrt(self.n_seen * m / n_total) * delta
+            stacked = np.vstack([self.singular_values[:, None] * self.components, centred, correction])
+            self.m2 = self.m2 + batch_m2 + delta ** 2 * self.n_seen * m / n_total
+            self.mean = self.mean + (batch_mean - self.mean) * m / n_total
+        u, s, vt = np.linalg.svd(stacked, full_matrices=False)
+        u, vt = _svd_flip(u, vt)
+        self.n_seen += m
+        self.components = vt[:self.n_components]
+        self.singular_values = s[:self.n_components]
+        return self
+
+    @property
+    def explained_variance(self):
+        return self.singular_values ** 2 / max(self.n_seen - 1, 1)
+
+    @property
+    def total_variance(self):
+        return float(self.m2.sum() / max(self.n_seen - 1, 1))
+
+
+@profiling.profiled('fit_eigenspectra')
+def fit_eigenspectra(fluxes, n_components=10, chunk=1000, min_coverage=0.9):
+    '''
+    Eigenspectra of the rows of fluxes (n_objects, n_pixels), e.g. a SpectralCube's memory map,
+    streamed chunk rows at a time. Pixels covered by fewer than min_coverage of the objects are left out,
+    and objects without any data are skipped. Returns an EigenModel.
+    '''
+    counts, mean, has_data = coverage_and_mean(fluxes, chunk)
+    n_used = int(has_data.sum())
+    pixels = counts >= max(1, min_coverage * n_used)
+    if not pixels.any():
+        raise ValueError(f'no pixel is covered by {min_coverage:.0%} of the spectra; lower min_coverage')
+    n_components = min(n_components, n_used, int(pixels.sum()))
+    if n_components < 1:
+        raise ValueError('no spectra with data to decompose')
+    # Every chunk after the first can be any size, the first needs at least n_components rows
+    chunk = max(chunk, n_components)
+
+    filler = EigenModel(None, pixels, mean[pixels], None, None, None, 0., 0)
+    pca = IncrementalPCA(n_components)
+    rows = np.flatnonzero(has_data)
+    for lo, hi in _chunks(len(rows), chunk):
+        pca.partial_fit(filler.fill(fluxes[rows[lo:hi]]))
+    # The model's mean is the PCA's running mean (of the filled rows), which is what the components are relative to
+    return EigenModel(None, pixels, pca.mean, pca.components, pca.singular_values, pca.explained_variance,
+                      pca.total_variance, pca.n_seen)
+
+
+@profiling.profiled('project')
+def project(model, fluxes, chunk=1000):
+    '''
+    Coefficients (n_objects, k) of every row on the model's components, plus the fraction of each
+    spectrum's energy (relative to the mean) the components miss, and the fraction of used pixels with data.
+    Objects without data get NaN.
+    '''
+    n_objects = fluxes.shape[0]
+    k = len(model.components)
+    coefficients = np.full((n_objects, k), np.nan)
+    residual = np.full(n_objects, np.nan)
+    coverage = np.zeros(n_objects)
+    for lo, hi in _chunks(n_objects, chunk):
+        block = np.asarray(fluxes[lo:hi], dtype=np.float64)[:, model.pixels]
+        finite = np.isfinite(block)
+        coverage[lo:hi] = finite.mean(axis=1)
+        ok = finite.any(axis=1)
+        centred = np.where(finite, block, model.mean)[ok] - model.mean
+        c = centred @ model.components.T
+        coefficients[lo:hi][ok] = c
+        energy = np.sum(centred ** 2, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            residual[lo:hi][ok] = np.where(energy > 0, 1 - np.sum(c ** 2, axis=1) / energy, 0.)
+    return coefficients, residual, coverage
+
+
+# ----------------------------
+# Classification
+# ----------------------------
+def kmeans(coefficients, n_classes, seed=0, max_iter=100):
+    '''
+    k-means on the coefficient vectors (k-means++ start). Rows with NaNs get class -1.
+    Returns (labels, centres).
+    '''
+    rng = np.random.default_rng(seed)
+    ok = np.all(np.isfinite(coefficients), axis=1)
+    x = coefficients[ok]
+    n_classes = min(n_classes, len(x))
+    centres = [x[rng.integers(len(x))]]
+    for _ in range(1, n_classes):
+        d2 = np.min(((x[:, None, :] - np.array(centres)[None]) ** 2).sum(axis=2), axis=1)
+        total = d2.sum()
+        centres.append(x[rng.choice(len(x), p=d2 / total)] if total > 0 else x[rng.integers(len(x))])
+    centres = np.array(centres)
+    labels = np.zeros(len(x), dtype=np.intp)
+    for i in range(max_iter):
+        distances = (x ** 2).sum(axis=1)[:, None] - 2 * x @ centres.T + (centres ** 2).sum(axis=1)[None]
+        new_labels = np.argmin(distances, axis=1)
+        if i and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        for j in range(n_classes):
+            members = labels == j
+            if members.any():
+                centres[j] = x[members].mean(axis=0)
+    out = np.full(len(coefficients), -1, dtype=np.intp)
+    out[ok] = labels
+    return out, centres
+
+
+def nearest(coefficients, query, n=5, exclude=None):
+    '''
+    Indices and distances of the n rows of coefficients closest to the query vector
+    (exclude: an index to leave out, e.g. the query object itself).
+    '''
+    d2 = np.sum((coefficients - np.asarray(query)) ** 2, axis=1)
+    d2[~np.isfinite(d2)] = np.inf
+    if exclude is not None:
+        d2[exclude] = np.inf
+    n = min(n, int(np.isfinite(d2).sum()))
+    idx = np.argpartition(d2, n - 1)[:n] if n < len(d2) else np.arange(len(d2))
+    idx = idx[np.argsort(d2[idx])][:n]
+    return idx, np.sqrt(d2[idx])
+
+
+# ----------------------------
+# Output
+# ----------------------------
+def write_eigenspectra(filename, model):
+    '''
+    The mean spectrum and eigenspectra in the object file layout (wavelength, then the mean as the flux),
+    so the GUI can open them.
+    '''
+    wavelengths = np.asarray(model.grid)[model.pixels]
+    names = ['mean'] + [f'eigen{i + 1}' for i in range(len(model.components))]
+    with open(filename, 'w', newline='') as f:
+        f.write("Wavelength (Angstroms) " + ' '.join(names) + "\n# start\n")
+        writer = csv.writer(f, delimiter=' ')
+        for i, w in enumerate(wavelengths):
+            writer.writerow([f'{w:.4f}', f'{model.mean[i]:.6g}'] + [f'{c:.6g}' for c in model.components[:, i]])
+
+
+def write_coefficients(filename, names, coefficients, residual, coverage, labels):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=' ')
+        writer.writerow(['Object', 'Class', 'Coverage', 'Residual'] + [f'c{i + 1}' for i in range(coefficients.shape[1])])
+        for name, label, cov, res, c in zip(names, labels, coverage, residual, coefficients):
+            writer.writerow([name, label, f'{cov:.3f}', f'{res:.4g}'] + [f'{v:.6g}' for v in c])
+
+
+def main(argv=None):
+    import batch_reduce
+    parser = argparse.ArgumentParser(description="Eigenspectra, classes and nearest neighbours of many quasar spectra.")
+    parser.add_argument('targets', nargs='*', help="spectrum files to build a continuum normalized cube from (or use --cube)")
+    parser.add_argument('--cube', default=os.path.join(DECOMPOSITION_DIR, 'cube'),
+                        help="composite.py cube to decompose, or where to build one from the targets")
+    parser.add_argument('--rest', action='store_true', help="build the cube in the rest frame (needs --grid)")
+    parser.add_argument('--grid', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'))
+    parser.add_argument('--redshifts', help="text file of 'object z' lines for --rest")
+    parser.add_argument('--components', type=int, default=10)
+    parser.add_argument('--chunk', type=int, default=1000, help="spectra per chunk (bounds the memory)")
+    parser.add_argument('--min-coverage', type=float, default=0.9,
+                        help="fraction of objects that must cover a pixel for it to be used")
+    parser.add_argument('--classes', type=int, default=4, help="k-means classes on the coefficients")
+    parser.add_argument('--neighbours', nargs='*', default=[], help="print the objects most similar to these")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', default=os.path.join(DECOMPOSITION_DIR, 'Eigenspectra'),
+                        help="prefix for the .npz model, eigenspectra and coefficient files")
+    args = parser.parse_args(argv)
+
+    if args.targets:
+        files = batch_reduce.find_spectrum_files(args.targets)
+        if not files:
+            print("No spectrum files found!")
+            return 1
+        redshifts = composite.read_redshifts(args.redshifts) if args.redshifts else {}
+        if args.grid:
+            start, stop, step = args.grid
+            grid = spectrum.UniformGrid(start, step, int(np.floor((stop - start) / step)) + 1)
+        elif args.rest:
+            print("A rest frame cube needs --grid START STOP STEP")
+            return 1
+        else:
+            grid = composite.common_grid(files)
+        cube, errors = composite.build_cube(files, args.cube, grid, redshifts, args.rest, 'continuum', workers=args.workers)
+        for error in errors:
+            print(error)
+    else:
+        cube = composite.SpectralCube.open(args.cube)
+
+    model = fit_eigenspectra(cube.fluxes, args.components, args.chunk, args.min_coverage)
+    model.grid = cube.grid
+    coefficients, residual, coverage = project(model, cube.fluxes, args.chunk)
+    labels, _ = kmeans(coefficients, args.classes)
+
+    directory = os.path.dirname(args.output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    model.save(args.output + '.npz')
+    write_eigenspectra(args.output + '.csv', model)
+    write_coefficients(args.output + ' Coefficients.csv', cube.names, coefficients, residual, coverage, labels)
+
+    print(model)
+    print('Explained variance: ' + ', '.join(f'{r:.1%}' for r in model.explained_variance_ratio))
+    for label in np.unique(labels[labels >= 0]):
+        members = [name for name, l in zip(cube.names, labels) if l == label]
+        print(f"Class {label}: {len(members)} objects ({', '.join(members[:8])}{', ...' if len(members) > 8 else ''})")
+    for name in args.neighbours:
+        if name not in cube.names:
+            print(f"{name} is not in the cube")
+            continue
+        i = cube.names.index(name)
+        idx, distances = nearest(coefficients, coefficients[i], n=5, exclude=i)
+        print(f"Most similar to {name}: " + ', '.join(f'{cube.names[j]} ({d:.3g})' for j, d in zip(idx, distances)))
+    print(f"Model, eigenspectra and coefficients -> {args.output}.npz / .csv / ' Coefficients.csv'")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
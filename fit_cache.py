@@ -0,0 +1,224 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Content-addressed cache for continuum and line fits.
+A result is stored under a hash of everything that went into it: the function's name, the bytes of
+every input array (flux, continuum, ...) and every parameter. Nothing is ever invalidated explicitly;
+changing an input or a parameter just produces a different key. Since line fits take the continuum
+array as an input, changing a continuum option gives a new continuum and therefore new line keys,
+while changing only a line option leaves every cached continuum valid.
+
+Results live in an in-memory LRU for the session and, optionally, in a directory of pickles with a
+size cap (least recently used files are deleted first), shared between the GUI, batch runs and worker
+processes. Both layers store pickled bytes, so a caller mutating a returned object can't change the cache.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import spectrum
+# ----------------------------
+
+
+CACHE_DIR_NAME = '.fit_cache'
+# Bump whenever a cached function changes what it returns, so stale pickles on disk are never used
+CACHE_VERSION = 4
+
+
+# ----------------------------
+# Keys
+# ----------------------------
+def _update(h, value):
+    '''
+    Feeds value into the hash h: arrays by dtype, shape and raw bytes, containers recursively, the rest by repr.
+    '''
+    if isinstance(value, spectrum.UniformGrid):
+        h.update(repr(('UniformGrid', value.start, value.step, value.n)).encode())
+    elif isinstance(value, np.ndarray):
+        h.update(repr(('ndarray', value.dtype.str, value.shape)).encode())
+        h.update(memoryview(np.ascontiguousarray(value)).cast('B'))
+    elif isinstance(value, (list, tuple)):
+        h.update(f'{type(value).__name__}{len(value)}('.encode())
+        for item in value:
+            _update(h, item)
+        h.update(b')')
+    elif isinstance(value, dict):
+        _update(h, sorted(value.items()))
+    else:
+        h.update(repr(value).encode())
+        h.update(b';')
+
+
+def cache_key(*parts):
+    '''
+    Hex digest of the parts (arrays, UniformGrids, numbers, strings, and lists/tuples/dicts of them).
+    '''
+    h = hashlib.blake2b(digest_size=20)
+    _update(h, (CACHE_VERSION,) + parts)
+    return h.hexdigest()
+
+
+# ----------------------------
+# Cache
+# ----------------------------
+class ResultCache():
+    '''
+    In-memory LRU of up to max_items results, backed by directory (if given) holding at most max_bytes.
+    Counters: hits (from memory), disk_hits, misses, evictions (files removed from disk).
+    Safe to share between threads; several processes can share the directory.
+    '''
+
+    def __init__(self, directory=None, max_items=256, max_bytes=512 * 1024 ** 2):
+        self.directory = directory
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evictions = 0
+        self._disk_bytes = None
+
+    def __repr__(self):
+        return f'ResultCache({self.summary()})'
+
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def summary(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        rate = (self.hits + self.disk_hits) / lookups if lookups else 0.
+        return (f'{self.hits} memory hits, {self.disk_hits} disk hits, {self.misses} misses '
+                f'({rate:.0%} hit rate), {self.evictions} evicted')
+
+    def call(self, name, fn, *args, **kwargs):
+        '''
+        fn(*args, **kwargs), unless a result for the same name, args and kwargs is already cached.
+        '''
+        key = cache_key(name, args, kwargs)
+        found, value = self.get(key)
+        if found:
+            return value
+        value = fn(*args, **kwargs)
+        self.put(key, value)
+        return value
+
+    def get(self, key):
+        '''
+        Returns (found, value).
+        '''
+        with self.lock:
+            blob = self.memory.get(key)
+            if blob is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+        if blob is None:
+            blob = self._read_disk(key)
+            with self.lock:
+                if blob is None:
+                    self.misses += 1
+                    return False, None
+                self.disk_hits += 1
+            self._remember(key, blob)
+        return True, pickle.loads(blob)
+
+    def put(self, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, blob)
+        self._write_disk(key, blob)
+
+    def clear(self):
+        '''
+        Empties the in-memory layer only; the disk store is left for other sessions.
+        '''
+        with self.lock:
+            self.memory.clear()
+
+    def _remember(self, key, blob):
+        with self.lock:
+            self.memory[key] = blob
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
+
+    # ----------------------------
+    # Disk store
+    # ----------------------------
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pkl')
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                blob = f.read()
+            # The modification time doubles as the last-used time for eviction
+            os.utime(path)
+        except OSError:
+            return None
+        return blob
+
+    def _write_disk(self, key, blob):
+        '''
+        Atomic write, then eviction if the store is over max_bytes. Failures just mean no disk cache.
+        '''
+        if self.directory is None:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        with self.lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self.disk_usage()
+            else:
+                self._disk_bytes += len(blob)
+            if self._disk_bytes > self.max_bytes:
+                self._evict()
+
+    def disk_usage(self):
+        if self.directory is None or not os.path.isdir(self.directory):
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith('.pkl'))
+
+    def _evict(self):
+        '''
+        Deletes the least recently used files until the store is back under 90% of max_bytes.
+        Rescans the directory, since other processes may have been writing to it too.
+        '''
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.pkl'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        target = 0.9 * self.max_bytes
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._disk_bytes = total
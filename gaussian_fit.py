@@ -0,0 +1,247 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Batched Gaussian fitting.
+Instead of one scipy curve_fit call per line (finite difference Jacobians, stddev=1 starting guess),
+this fits many (x, residual) windows at once with a Levenberg-Marquardt loop written entirely in
+NumPy array operations, using the analytic derivatives of Eq.gaussian:
+
+    g     = A exp(-(x - mu)^2 / 2 sigma^2)
+    dg/dA     = g / A
+    dg/dmu    = g (x - mu) / sigma^2
+    dg/dsigma = g (x - mu)^2 / sigma^3
+
+Windows can be given as padded 2D arrays with a mask, or as ragged lists (see pad_windows).
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+# ----------------------------
+
+
+class GaussianFitResult():
+    '''
+    Results for m windows, all as arrays:
+    - params: (m, 3) amplitude, mean, stddev
+    - covariance: (m, 3, 3), scaled by the reduced chi^2 like curve_fit does by default
+    - converged: (m,) bool
+    - chi2: (m,) weighted sum of squared residuals
+    - n_iter: (m,) iterations used
+    '''
+
+    def __init__(self, params, covariance, converged, chi2, n_iter):
+        self.params = params
+        self.covariance = covariance
+        self.converged = converged
+        self.chi2 = chi2
+        self.n_iter = n_iter
+
+    def __len__(self):
+        return len(self.params)
+
+    @property
+    def errors(self):
+        return np.sqrt(np.abs(np.diagonal(self.covariance, axis1=1, axis2=2)))
+
+
+# ----------------------------
+# Model
+# ----------------------------
+def gaussian(x, amplitude, mean, stddev):
+    '''
+    Eq.gaussian, broadcasting over leading dimensions of the parameters.
+    '''
+    return amplitude * np.exp(-((x - mean) / stddev) ** 2 / 2)
+
+
+def gaussian_jacobian(x, amplitude, mean, stddev):
+    '''
+    Returns (model, jacobian) with jacobian[..., k, :] = d model_k / d(amplitude, mean, stddev).
+    '''
+    u = (x - mean) / stddev
+    e = np.exp(-u ** 2 / 2)
+    model = amplitude * e
+    jac = np.empty(x.shape + (3,))
+    jac[..., 0] = e
+    jac[..., 1] = model * u / stddev
+    jac[..., 2] = model * u ** 2 / stddev
+    return model, jac
+
+
+# ----------------------------
+# Window handling
+# ----------------------------
+def pad_windows(xs, ys, weights=None):
+    '''
+    Packs ragged lists of 1D windows into padded (m, k) arrays.
+    Returns (x, y, mask) or (x, y, mask, weights) if weights were given.
+    Padding repeats each window's last x so the model stays finite there; the mask keeps it out of the fit.
+    '''
+    lengths = np.array([len(x) for x in xs])
+    m, k = len(xs), (lengths.max() if len(xs) else 0)
+    mask = np.arange(k)[None, :] < lengths[:, None]
+    x = np.zeros((m, k))
+    y = np.zeros((m, k))
+    w = np.zeros((m, k)) if weights is not None else None
+    for i in range(m):
+        n = lengths[i]
+        x[i, :n] = xs[i]
+        x[i, n:] = xs[i][-1] if n else 0.
+        y[i, :n] = ys[i]
+        if w is not None:
+            w[i, :n] = weights[i]
+    if w is not None:
+        return x, y, mask, w
+    return x, y, mask
+
+
+def initial_guess(x, y, mask):
+    '''
+    Starting parameters for each window: the peak height, its position, and a width from
+    the second moment of the positive part of the profile (instead of a fixed stddev of 1).
+    '''
+    yy = np.where(mask, y, -np.inf)
+    peak = np.argmax(yy, axis=1)
+    rows = np.arange(len(y))
+    amplitude = y[rows, peak]
+    mean = x[rows, peak]
+
+    pos = np.where(mask, np.clip(y, 0, None), 0.)
+    total = pos.sum(axis=1)
+    safe = np.where(total > 0, total, 1.)
+    var = (pos * (x - mean[:, None]) ** 2).sum(axis=1) / safe
+
+    # Half the window is a hard ceiling, a pixel is the floor
+    dx = np.abs(np.diff(x, axis=1))
+    pixel = np.where(mask[:, 1:], dx, np.inf).min(axis=1) if x.shape[1] > 1 else np.ones(len(x))
+    pixel = np.where(np.isfinite(pixel) & (pixel > 0), pixel, 1.)
+    span = np.where(mask, x, -np.inf).max(axis=1) - np.where(mask, x, np.inf).min(axis=1)
+    stddev = np.clip(np.sqrt(var), pixel, np.maximum(span / 2, pixel))
+    stddev = np.where(total > 0, stddev, pixel)
+    return np.stack([amplitude, mean, stddev], axis=1)
+
+
+# ----------------------------
+# Fitting
+# ----------------------------
+def _normal_equations(x, y, w, params):
+    model, jac = gaussian_jacobian(x, params[:, 0:1], params[:, 1:2], params[:, 2:3])
+    r = (y - model)
+    wj = jac * w[..., None]
+    # Batched matmul rather than einsum: without optimize, einsum loops over the (m, k, 3, 3) products ~10x slower
+    jtj = np.matmul(wj.transpose(0, 2, 1), jac)
+    jtr = np.matmul(r[:, None, :], wj)[:, 0]
+    chi2 = np.einsum('mk,mk->m', w * r, r)
+    return jtj, jtr, chi2
+
+
+def _chi2(x, y, w, params):
+    r = y - gaussian(x, params[:, 0:1], params[:, 1:2], params[:, 2:3])
+    return np.einsum('mk,mk->m', w * r, r)
+
+
+def fit_gaussians(x, y, mask=None, p0=None, weights=None, max_iter=200, tol=1e-10, lam0=1e-3):
+    '''
+    Fits a Gaussian to every row of the (m, k) arrays x and y at once.
+    mask marks valid pixels, weights are 1/sigma^2 per pixel (default 1).
+    p0 is an optional (m, 3) array of starting parameters, otherwise initial_guess is used.
+
+    Every window is shifted/scaled to order unity internally so fluxes of 1e-16 and wavelengths
+    of 5000 don't wreck the conditioning of the 3x3 normal equations.
+    Returns a GaussianFitResult.
+    '''
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    m, k = y.shape
+    x = np.broadcast_to(x, (m, k))
+    mask = np.ones((m, k), dtype=bool) if mask is None else np.broadcast_to(np.asarray(mask, dtype=bool), (m, k))
+    w = np.where(mask, 1. if weights is None else np.broadcast_to(weights, (m, k)), 0.)
+    mask = mask & np.isfinite(y) & np.isfinite(x)
+    w = np.where(mask, w, 0.)
+    y = np.where(mask, y, 0.)
+
+    p = initial_guess(x, y, mask) if p0 is None else np.array(np.broadcast_to(p0, (m, 3)), dtype=np.float64)
+
+    # Normalise each window
+    x0 = p[:, 1].copy()
+    xs = np.where(p[:, 2] > 0, np.abs(p[:, 2]), 1.)
+    ys = np.abs(y).max(axis=1)
+    ys = np.where(ys > 0, ys, 1.)
+    xn = (x - x0[:, None]) / xs[:, None]
+    yn = y / ys[:, None]
+    pn = np.stack([p[:, 0] / ys, (p[:, 1] - x0) / xs, p[:, 2] / xs], axis=1)
+
+    lam = np.full(m, lam0)
+    converged = np.zeros(m, dtype=bool)
+    n_iter = np.zeros(m, dtype=int)
+    active = np.arange(m)
+    chi2 = _chi2(xn, yn, w, pn)
+
+    # A diverging trial step (e.g. a noise realisation that has lost the line) can overflow; it's then
+    # rejected by the isfinite check below, so those warnings are just noise
+    with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+        for it in range(max_iter):
+            if len(active) == 0:
+                break
+            xa, ya, wa, pa = xn[active], yn[active], w[active], pn[active]
+            jtj, jtr, chi2_a = _normal_equations(xa, ya, wa, pa)
+
+            # Marquardt damping on the diagonal
+            diag = np.diagonal(jtj, axis1=1, axis2=2)
+            damped = jtj + (lam[active, None] * np.where(diag > 0, diag, 1.))[:, :, None] * np.eye(3)
+            try:
+                step = np.linalg.solve(damped, jtr[..., None])[..., 0]
+            except np.linalg.LinAlgError:
+                step = np.einsum('mij,mj->mi', np.linalg.pinv(damped), jtr)
+
+            trial = pa + step
+            trial[:, 2] = np.abs(trial[:, 2])
+            trial_chi2 = _chi2(xa, ya, wa, trial)
+            better = np.isfinite(trial_chi2) & (trial_chi2 <= chi2_a)
+
+            pn[active[better]] = trial[better]
+            chi2[active[better]] = trial_chi2[better]
+            lam[active] = np.where(better, lam[active] / 10., lam[active] * 10.)
+            n_iter[active] += 1
+
+            # Converged when an accepted step barely changes chi^2 or the parameters,
+            # or when no amount of damping finds a better step (we're sitting in the minimum)
+            rel = np.abs(chi2_a - trial_chi2) <= tol * np.maximum(chi2_a, 1e-300)
+            small = np.all(np.abs(step) <= np.sqrt(tol) * (np.abs(pa) + np.sqrt(tol)), axis=1)
+            done = (better & (rel | small)) | (lam[active] > 1e12)
+            converged[active[done]] = True
+            active = active[~done]
+
+    # Covariance from the undamped normal equations at the solution, scaled like curve_fit
+    jtj, _, chi2 = _normal_equations(xn, yn, w, pn)
+    dof = np.maximum(mask.sum(axis=1) - 3, 1)
+    cov_n = np.full((m, 3, 3), np.inf)
+    good = np.all(np.isfinite(jtj), axis=(1, 2))
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        # Singular matrices have an infinite condition number
+        good[good] = np.linalg.cond(jtj[good]) < 1 / np.finfo(float).eps
+    if np.any(good):
+        cov_n[good] = np.linalg.inv(jtj[good]) * (chi2[good] / dof[good])[:, None, None]
+
+    scale = np.stack([ys, xs, xs], axis=1)
+    params = np.stack([pn[:, 0] * ys, pn[:, 1] * xs + x0, pn[:, 2] * xs], axis=1)
+    covariance = cov_n * scale[:, :, None] * scale[:, None, :]
+    chi2 = chi2 * ys ** 2
+    converged &= np.all(np.isfinite(params), axis=1) & good
+    return GaussianFitResult(params, covariance, converged, chi2, n_iter)
+
+
+def fit_gaussian_windows(xs, ys, weights=None, p0=None, **kwargs):
+    '''
+    Ragged version of fit_gaussians: xs and ys are lists of 1D windows of any length.
+    '''
+    if weights is None:
+        x, y, mask = pad_windows(xs, ys)
+        w = None
+    else:
+        x, y, mask, w = pad_windows(xs, ys, weights)
+    return fit_gaussians(x, y, mask=mask, p0=p0, weights=w, **kwargs)
@@ -0,0 +1,149 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Non-destructive spectrum history, for undo / redo / revert to original.
+Smoothing used to overwrite the loaded arrays, so getting the raw data back meant reopening the file.
+Instead, every transform (smooth, clip, subtract continuum, ...) makes a Step holding its result, on top
+of the untouched original:
+
+    original -> smooth -> clip -> ...
+                           ^ current
+
+Every array in the history is made read-only when it goes in, so steps can share memory freely:
+a transform that leaves the wavelengths alone hands the same UniformGrid / array to the next step,
+and anything that wants to change a step's data has to make its own copy (copy on write).
+Undo, redo and revert only move a cursor along the list, so they are instant and copy nothing.
+At most depth steps are kept on top of the original; past that the oldest go first.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+# ----------------------------
+
+
+DEFAULT_DEPTH = 20
+
+
+def read_only(values):
+    '''
+    A read-only view of an array (no copy); anything else, like a UniformGrid, is already immutable.
+    '''
+    if isinstance(values, np.ndarray):
+        values = values.view()
+        values.flags.writeable = False
+    return values
+
+
+class Step():
+    '''
+    One state of the spectrum:
+    - name, options: the transform that made it and what it was given ('original' for the loaded data)
+    - wavelengths, fluxes: its read-only data
+    - continuum: a continuum fit defined on this step, kept so undo and redo bring it back too
+    '''
+
+    __slots__ = ('name', 'options', 'wavelengths', 'fluxes', 'continuum')
+
+    def __init__(self, name, wavelengths, fluxes, options=None):
+        self.name = name
+        self.options = options or {}
+        self.wavelengths = read_only(wavelengths)
+        self.fluxes = read_only(fluxes)
+        self.continuum = None
+
+    def __repr__(self):
+        options = ', '.join(f'{key}=array[{len(value)}]' if isinstance(value, np.ndarray) else f'{key}={value!r}'
+                            for key, value in self.options.items())
+        return f'{self.name}({options})' if options else self.name
+
+    @property
+    def nbytes(self):
+        return self.fluxes.nbytes + getattr(self.wavelengths, 'nbytes', 0)
+
+
+class SpectrumHistory():
+    '''
+    The original spectrum plus up to depth transformed steps, with a cursor on the current one.
+    '''
+
+    def __init__(self, wavelengths, fluxes, depth=DEFAULT_DEPTH):
+        if depth < 1:
+            raise ValueError(f'history depth must be at least 1, not {depth}')
+        self.depth = depth
+        self.original = Step('original', wavelengths, fluxes)
+        self.steps = [self.original]
+        self.position = 0
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __repr__(self):
+        return ' -> '.join(f'[{step!r}]' if i == self.position else repr(step) for i, step in enumerate(self.steps))
+
+    @property
+    def current(self):
+        return self.steps[self.position]
+
+    @property
+    def nbytes(self):
+        '''
+        Memory held by the history, counting arrays shared between steps once.
+        '''
+        seen = {}
+        for step in self.steps:
+            for values in (step.wavelengths, step.fluxes):
+                if isinstance(values, np.ndarray):
+                    base = values.base if values.base is not None else values
+                    seen[id(base)] = base.nbytes
+        return sum(seen.values())
+
+    def apply(self, name, transform, **options):
+        '''
+        Runs transform(wavelengths, fluxes, **options) -> (wavelengths, fluxes) on the current step
+        and makes the result the new current step. Anything that could have been redone is dropped.
+        If the transform raises, the history is left as it was.
+        '''
+        wavelengths, fluxes = transform(self.current.wavelengths, self.current.fluxes, **options)
+        return self.push(name, wavelengths, fluxes, options)
+
+    def push(self, name, wavelengths, fluxes, options=None):
+        '''
+        Adds already computed data as the new current step, e.g. a step read back from a session file.
+        '''
+        step = Step(name, wavelengths, fluxes, options)
+        del self.steps[self.position + 1:]
+        self.steps.append(step)
+        # Keep the original and the newest depth steps
+        del self.steps[1:max(len(self.steps) - self.depth, 1)]
+        self.position = len(self.steps) - 1
+        return step
+
+    @property
+    def can_undo(self):
+        return self.position > 0
+
+    @property
+    def can_redo(self):
+        return self.position < len(self.steps) - 1
+
+    def undo(self):
+        '''
+        Steps back one transform (past the oldest kept step this is the original). Returns the current step.
+        '''
+        self.position = max(self.position - 1, 0)
+        return self.current
+
+    def redo(self):
+        self.position = min(self.position + 1, len(self.steps) - 1)
+        return self.current
+
+    def revert(self):
+        '''
+        Back to the original data. The steps are kept, so redo walks forward through them again.
+        '''
+        self.position = 0
+        return self.current
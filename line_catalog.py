@@ -0,0 +1,288 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Columnar line catalogs.
+A catalog is one numpy structured array with a row per line (LINE_DTYPE): the measurements, their errors
+and the three Gaussian parameters (with errors on the centre and width), but not the sampled fit curve,
+which can always be rebuilt from them. That's 300 bytes a line, so millions of lines across a survey fit comfortably in memory.
+
+CatalogWriter streams rows out as they come, to two formats at once:
+- a space delimited .csv, header written once and rows appended after it
+- a binary columnar directory (.cols): one raw file per column that rows are appended to,
+  plus schema.json with the column types and the row count. read_columns memory-maps it back.
+Every write only touches the new rows and flushes, so saving is cheap, safe to repeat, and never
+loses what was written before.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import csv
+import json
+
+import numpy as np
+# ----------------------------
+
+
+# (column, dtype, header in the .csv)
+COLUMNS = [
+    ('object', 'U32', 'Object'),
+    ('name', 'U16', 'Line'),
+    ('rest_wav', 'f8', 'Rest Wavelength (Angstroms)'),
+    ('redshift', 'f8', 'Redshift'),
+    ('wavelength', 'f8', 'Wavelength (Angstroms)'),
+    ('eq_wid', 'f8', 'Equivalent Width'),
+    ('eq_wid_err', 'f8', 'Equivalent Width Error'),
+    ('peak_flux', 'f8', 'Peak Flux'),
+    ('total_flux', 'f8', 'Total Flux'),
+    ('total_flux_err', 'f8', 'Total Flux Error'),
+    ('amplitude', 'f8', 'Gaussian Amplitude'),
+    ('center', 'f8', 'Gaussian Center'),
+    ('center_err', 'f8', 'Gaussian Center Error'),
+    ('sigma', 'f8', 'Gaussian Sigma'),
+    ('sigma_err', 'f8', 'Gaussian Sigma Error'),
+    # 0 when the errors come from the fit covariance, else how many Monte Carlo realisations they come from
+    ('n_realisations', 'i4', 'Error Realisations'),
+]
+LINE_DTYPE = np.dtype([(column, dtype) for column, dtype, _ in COLUMNS])
+HEADERS = [header for _, _, header in COLUMNS]
+
+
+def _value(x):
+    return np.nan if x is None else x
+
+
+def line_row(line, object_name=''):
+    '''
+    One LINE_DTYPE record from a spectral_core.SpectralLine (missing values become NaN / '').
+    '''
+    amplitude, center, sigma = line.params
+    return (object_name, line.name, _value(line.rest_wav), _value(line.redshift), line.line_wav,
+            line.equivalent_width, _value(line.equivalent_width_err), line.max_flux, line.total_flux,
+            _value(line.total_flux_err), amplitude, center, _value(line.center_err), sigma, _value(line.sigma_err),
+            line.n_realisations)
+
+
+def lines_to_rows(lines, object_name=''):
+    return np.array([line_row(line, object_name) for line in lines], dtype=LINE_DTYPE)
+
+
+def merge_rows(rows, new_rows):
+    '''
+    rows with new_rows added, where a new row replaces the old rows it is a refit of: named lines (found
+    automatically or deblended) replace old rows of the same name, and unnamed (clicked) lines replace old unnamed
+    rows whose centre is within the new fit's sigma of theirs. Returns a new array, old rows first.
+    '''
+    if not len(rows) or not len(new_rows):
+        return np.concatenate([rows, new_rows])
+    named = new_rows['name'] != ''
+    stale = (rows['name'] != '') & np.isin(rows['name'], new_rows['name'][named])
+    clicked = new_rows[~named]
+    if len(clicked):
+        near = np.abs(rows['center'][:, None] - clicked['center'][None, :]) <= np.abs(clicked['sigma'])[None, :]
+        stale |= (rows['name'] == '') & near.any(axis=1)
+    return np.concatenate([rows[~stale], new_rows])
+
+
+# ----------------------------
+# In-memory catalog
+# ----------------------------
+class LineCatalog():
+    '''
+    Growable structured array of lines. Appending is amortised O(1) (capacity doubles),
+    rows is a view of the filled part, and columns are plain float arrays, e.g. catalog['eq_wid'].
+    '''
+
+    def __init__(self, capacity=64):
+        self._data = np.zeros(capacity, dtype=LINE_DTYPE)
+        self._n = 0
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, key):
+        return self.rows[key]
+
+    @property
+    def rows(self):
+        return self._data[:self._n]
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes
+
+    def _reserve(self, extra):
+        needed = self._n + extra
+        if needed > len(self._data):
+            grown = np.zeros(max(needed, 2 * len(self._data)), dtype=LINE_DTYPE)
+            grown[:self._n] = self.rows
+            self._data = grown
+
+    def extend_rows(self, rows):
+        rows = np.asarray(rows, dtype=LINE_DTYPE)
+        self._reserve(len(rows))
+        self._data[self._n:self._n + len(rows)] = rows
+        self._n += len(rows)
+
+    def append(self, line, object_name=''):
+        self._reserve(1)
+        self._data[self._n] = line_row(line, object_name)
+        self._n += 1
+
+    def extend(self, lines, object_name=''):
+        self.extend_rows(lines_to_rows(lines, object_name))
+
+    def clear(self):
+        self._n = 0
+
+
+# ----------------------------
+# Streaming writer
+# ----------------------------
+def _csv_cell(value):
+    if isinstance(value, float) and np.isnan(value):
+        return ''
+    return value
+
+
+class CatalogWriter():
+    '''
+    Append-only writer for path + '.csv' and path + '.cols/'. Without append, existing files are
+    replaced when the writer is created; after that every write() adds rows to the end.
+    Either format can be switched off with csv_output / columnar.
+    '''
+
+    def __init__(self, path, append=False, csv_output=True, columnar=True):
+        self.path = path
+        self.csv_path = path + '.csv' if csv_output else None
+        self.columns_dir = path + '.cols' if columnar else None
+        self.rows_written = 0
+        self._csv = None
+        self._columns = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if self.csv_path is not None:
+            fresh = not append or _csv_header(self.csv_path) != HEADERS
+            self._csv = open(self.csv_path, 'w' if fresh else 'a', newline='')
+            self._csv_writer = csv.writer(self._csv, delimiter=' ')
+            if fresh:
+                self._csv_writer.writerow(HEADERS)
+                self._csv.flush()
+        if self.columns_dir is not None:
+            os.makedirs(self.columns_dir, exist_ok=True)
+            schema = _read_schema(self.columns_dir) if append and os.path.exists(_schema_path(self.columns_dir)) else None
+            # Files from an older set of columns can't be appended to, so they start over
+            compatible = schema is not None and schema['columns'] == [[column, dtype] for column, dtype, _ in COLUMNS]
+            existing = schema['rows'] if compatible else 0
+            mode = 'ab' if existing else 'wb'
+            # Trim anything past the recorded row count (a write that died half way)
+            self._columns = {}
+            for column, dtype, _ in COLUMNS:
+                f = open(os.path.join(self.columns_dir, f'{column}.bin'), mode)
+                f.truncate(existing * np.dtype(dtype).itemsize)
+                f.seek(0, os.SEEK_END)
+                self._columns[column] = f
+            self._columnar_rows = existing
+            self._write_schema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, rows):
+        '''
+        Appends rows (LINE_DTYPE records, or SpectralLines via lines_to_rows) and flushes them to disk.
+        '''
+        rows = np.asarray(rows, dtype=LINE_DTYPE)
+        if not len(rows):
+            return
+        if self._csv is not None:
+            self._csv_writer.writerows([_csv_cell(value) for value in row] for row in rows.tolist())
+            self._csv.flush()
+        if self._columns is not None:
+            for column, f in self._columns.items():
+                f.write(np.ascontiguousarray(rows[column]).tobytes())
+                f.flush()
+            self._columnar_rows += len(rows)
+            self._write_schema()
+        self.rows_written += len(rows)
+
+    def _write_schema(self):
+        schema = {'columns': [[column, dtype] for column, dtype, _ in COLUMNS], 'rows': self._columnar_rows}
+        tmp = _schema_path(self.columns_dir) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(schema, f)
+        os.replace(tmp, _schema_path(self.columns_dir))
+
+    def close(self):
+        if self._csv is not None:
+            self._csv.close()
+            self._csv = None
+        if self._columns is not None:
+            for f in self._columns.values():
+                f.close()
+            self._columns = None
+
+
+# ----------------------------
+# Reading
+# ----------------------------
+def _csv_header(csv_path):
+    try:
+        with open(csv_path, newline='') as f:
+            return next(csv.reader(f, delimiter=' '), None)
+    except OSError:
+        return None
+
+
+def _schema_path(columns_dir):
+    return os.path.join(columns_dir, 'schema.json')
+
+
+def _read_schema(columns_dir):
+    with open(_schema_path(columns_dir)) as f:
+        return json.load(f)
+
+
+def read_columns(columns_dir, mmap=True):
+    '''
+    The columns of a .cols directory as a dict of arrays (memory maps unless mmap=False).
+    Only the rows recorded in schema.json are returned, so a half finished write is never seen.
+    '''
+    schema = _read_schema(columns_dir)
+    n = schema['rows']
+    columns = {}
+    for column, dtype in schema['columns']:
+        path = os.path.join(columns_dir, f'{column}.bin')
+        if n == 0:
+            columns[column] = np.zeros(0, dtype=dtype)
+        elif mmap:
+            columns[column] = np.memmap(path, dtype=dtype, mode='r', shape=(n,))
+        else:
+            columns[column] = np.fromfile(path, dtype=dtype, count=n)
+    return columns
+
+
+def read_catalog(columns_dir):
+    '''
+    A .cols directory back as a LineCatalog.
+    '''
+    columns = read_columns(columns_dir, mmap=False)
+    n = len(next(iter(columns.values()))) if columns else 0
+    rows = np.zeros(n, dtype=LINE_DTYPE)
+    for column in LINE_DTYPE.names:
+        if column in columns:
+            rows[column] = columns[column]
+    catalog = LineCatalog(max(n, 1))
+    catalog.extend_rows(rows)
+    return catalog
@@ -0,0 +1,110 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Monte Carlo errors for line measurements.
+The covariance errors from the fit assume the chi^2 surface is a nice paraboloid, which it isn't for weak lines.
+Here every fit window is perturbed with N realisations of its own noise (from noise.noise_map) and refit, and the
+spread of the refits gives the errors: half the distance between the 15.9th and 84.1th percentiles (1 sigma for
+a Gaussian) of the centre, width, total flux and equivalent width.
+
+The noise map only sees pixel to pixel scatter, and on resampled spectra (neighbouring pixels correlated) it comes
+out well under the real residuals around a fit. So, like the covariance errors (scaled by the reduced chi^2, as
+curve_fit does), each line's noise is scaled by sqrt(reduced chi^2) of its best fit against that noise before
+drawing the realisations, and the two kinds of errors agree where the fit is well behaved.
+
+All the realisations of all the lines are one batch for gaussian_fit.fit_gaussians, started from the best fit,
+and measured together by line_measure, so 1000 realisations of a line is a single (1000, pixels) array fit rather
+than 1000 separate fits. Lines are done a few at a time so the arrays stay around MAX_ELEMENTS values.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+
+import gaussian_fit
+import line_measure
+import profiling
+# ----------------------------
+
+
+PERCENTILES = (15.865, 84.135)
+MAX_ELEMENTS = 2_000_000
+
+
+class MonteCarloErrors():
+    '''
+    Arrays of length m (one entry per line), NaN for lines with no converged realisations:
+    - center_err, sigma_err, flux_err, eq_wid_err: half the 15.9 - 84.1 percentile range
+    - low, high: (m, 4) those percentiles of (center, sigma, flux, eq_wid) themselves
+    - n_converged: realisations that converged, per line
+    - noise_scale: what each line's noise map was scaled by, sqrt(reduced chi^2) of its best fit
+    '''
+
+    def __init__(self, low, high, n_converged, noise_scale):
+        self.low = low
+        self.high = high
+        self.n_converged = n_converged
+        self.noise_scale = noise_scale
+        half = (high - low) / 2
+        self.center_err, self.sigma_err, self.flux_err, self.eq_wid_err = half.T
+
+    def __len__(self):
+        return len(self.n_converged)
+
+
+def reduced_chi2_scale(xdata, ydata, mask, params, noise):
+    '''
+    sqrt(reduced chi^2) of every line's best fit against the noise map, over its unmasked pixels with a noise value.
+    Lines where it can't be worked out (too few pixels, no noise) get 1, i.e. the noise map as it is.
+    '''
+    residual = ydata - gaussian_fit.gaussian(xdata, params[:, 0:1], params[:, 1:2], params[:, 2:3])
+    usable = mask & np.isfinite(residual) & np.isfinite(noise) & (noise > 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        chi2 = np.sum(np.where(usable, residual / noise, 0.) ** 2, axis=1)
+    dof = usable.sum(axis=1) - 3
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.sqrt(chi2 / dof)
+    return np.where((dof > 0) & np.isfinite(scale) & (scale > 0), scale, 1.)
+
+
+@profiling.profiled('monte_carlo_errors')
+def monte_carlo_errors(xdata, ydata, mask, params, noise, wavelengths, continuum, n_realisations=500, seed=0):
+    '''
+    xdata, ydata, mask: the (m, k) continuum subtracted windows that were fit, padded and masked like fit_gaussians takes them
+    params: (m, 3) the best fits, used as every realisation's starting point
+    noise: (m, k) 1 sigma noise of every window pixel, scaled per line by sqrt(reduced chi^2) of its best fit
+    wavelengths, continuum: the whole spectrum, for the equivalent widths
+    The same seed always gives the same errors. Returns a MonteCarloErrors.
+    '''
+    xdata = np.atleast_2d(xdata)
+    m, k = xdata.shape
+    rng = np.random.default_rng(seed)
+    noise_scale = reduced_chi2_scale(xdata, ydata, mask, params, noise)
+    low = np.full((m, 4), np.nan)
+    high = np.full((m, 4), np.nan)
+    n_converged = np.zeros(m, dtype=np.intp)
+    per_chunk = max(1, MAX_ELEMENTS // max(n_realisations * k, 1))
+    for lo in range(0, m, per_chunk):
+        hi = min(lo + per_chunk, m)
+        lines = hi - lo
+        # Every line's window repeated n_realisations times, with fresh noise on each copy
+        x = np.repeat(xdata[lo:hi], n_realisations, axis=0)
+        sigma = np.where(np.isfinite(noise[lo:hi]), noise[lo:hi], 0.) * noise_scale[lo:hi, None]
+        y = (ydata[lo:hi, None, :] + sigma[:, None, :] * rng.standard_normal((lines, n_realisations, k))).reshape(-1, k)
+        window_mask = np.repeat(mask[lo:hi], n_realisations, axis=0)
+        p0 = np.repeat(params[lo:hi], n_realisations, axis=0)
+        result = gaussian_fit.fit_gaussians(x, y, mask=window_mask, p0=p0)
+
+        flux, _ = line_measure.line_flux(result.params)
+        eq_wid, _ = line_measure.equivalent_width(result.params, wavelengths, continuum)
+        values = np.stack([result.params[:, 1], np.abs(result.params[:, 2]), flux, eq_wid], axis=1)
+        values[~result.converged] = np.nan
+        values = values.reshape(lines, n_realisations, 4)
+        n_converged[lo:hi] = np.sum(result.converged.reshape(lines, n_realisations), axis=1)
+        ok = n_converged[lo:hi] > 0
+        if ok.any():
+            low[lo:hi][ok], high[lo:hi][ok] = np.nanpercentile(values[ok], PERCENTILES, axis=1)
+    return MonteCarloErrors(low, high, n_converged, noise_scale)
@@ -0,0 +1,108 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Line measurements straight from the Gaussian fit parameters.
+fit_spectral_line used to sample the fit on the window pixels, integrate it with Simpson's rule and
+divide by the continuum at the peak. That truncates any line wider than the window and assumes a
+flat continuum. Here:
+
+- Total flux is analytic, F = A sigma sqrt(2 pi), with its error propagated from the fit covariance.
+- Equivalent width is EW = integral of g(lambda) / C(lambda) over the whole profile, against the
+  full continuum model, done with Gauss-Hermite quadrature. The Gaussian weight is absorbed by the
+  quadrature, so a handful of nodes per line is exact for a flat continuum and very close otherwise,
+  and every line in a catalog is measured at once as an (m, n_nodes) array.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+
+import spectrum
+# ----------------------------
+
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+N_NODES = 24
+
+
+class LineMeasurements():
+    '''
+    Arrays of length m (one entry per line):
+    - flux, flux_err: total line flux (erg/s/cm2)
+    - eq_wid, eq_wid_err: equivalent width (Angstroms)
+    '''
+
+    def __init__(self, flux, flux_err, eq_wid, eq_wid_err):
+        self.flux = flux
+        self.flux_err = flux_err
+        self.eq_wid = eq_wid
+        self.eq_wid_err = eq_wid_err
+
+    def __len__(self):
+        return len(self.flux)
+
+
+def _propagate(gradient, covariance):
+    '''
+    sqrt(g^T C g) for every line; gradient is (m, 3) and covariance (m, 3, 3).
+    '''
+    var = np.einsum('mi,mij,mj->m', gradient, covariance, gradient)
+    return np.sqrt(np.where(var >= 0, var, np.nan))
+
+
+def line_flux(params, covariance=None):
+    '''
+    Total flux of each Gaussian in params (m, 3) = (amplitude, mean, stddev).
+    Returns (flux, flux_err); flux_err is None without a covariance.
+    '''
+    params = np.atleast_2d(params)
+    amplitude, stddev = params[:, 0], np.abs(params[:, 2])
+    flux = amplitude * stddev * SQRT_2PI
+    if covariance is None:
+        return flux, None
+    gradient = np.stack([stddev * SQRT_2PI, np.zeros_like(flux), amplitude * SQRT_2PI], axis=1)
+    return flux, _propagate(gradient, np.reshape(covariance, (-1, 3, 3)))
+
+
+def equivalent_width(params, wavelengths, continuum, covariance=None, n_nodes=N_NODES):
+    '''
+    EW = integral g(lambda) / C(lambda) d lambda for each Gaussian in params (m, 3).
+    wavelengths/continuum describe the continuum model on the spectrum's pixels
+    (wavelengths may be a spectrum.UniformGrid). With lambda = mu + sqrt(2) sigma t:
+
+        EW = sqrt(2) A sigma  sum_j w_j / C(mu + sqrt(2) sigma t_j)
+
+    and the derivatives with respect to (A, mu, sigma) come out of the same nodes, which gives the error.
+    Returns (eq_wid, eq_wid_err); eq_wid_err is None without a covariance.
+    '''
+    params = np.atleast_2d(params)
+    amplitude, mean, stddev = params[:, 0], params[:, 1], np.abs(params[:, 2])
+    t, w = np.polynomial.hermite.hermgauss(n_nodes)
+
+    nodes = mean[:, None] + np.sqrt(2) * stddev[:, None] * t[None, :]
+    inv_c = 1. / spectrum.interp(wavelengths, continuum, nodes)
+
+    s0 = inv_c @ w
+    eq_wid = np.sqrt(2) * amplitude * stddev * s0
+    if covariance is None:
+        return eq_wid, None
+
+    s1 = inv_c @ (w * t)
+    s2 = inv_c @ (w * t ** 2)
+    gradient = np.stack([np.sqrt(2) * stddev * s0,
+                         2 * amplitude * s1,
+                         2 * np.sqrt(2) * amplitude * s2], axis=1)
+    return eq_wid, _propagate(gradient, np.reshape(covariance, (-1, 3, 3)))
+
+
+def measure_lines(params, wavelengths, continuum, covariance=None, n_nodes=N_NODES):
+    '''
+    Flux and equivalent width (with errors if a covariance is given) for every line at once.
+    Returns a LineMeasurements.
+    '''
+    flux, flux_err = line_flux(params, covariance)
+    eq_wid, eq_wid_err = equivalent_width(params, wavelengths, continuum, covariance, n_nodes)
+    return LineMeasurements(flux, flux_err, eq_wid, eq_wid_err)
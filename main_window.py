@@ -0,0 +1,815 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+The GUI's main window. Everything Qt lives here and in plot_canvas / qt_tasks; interactive_plot.main() is the only
+thing that imports it, so importing interactive_plot doesn't pull in PyQt5 or the matplotlib Qt backend.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import numpy as np
+import traceback
+
+from PyQt5 import QtWidgets
+from PyQt5.QtWidgets import QPushButton, QFileDialog
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+
+import spectral_core
+import redshift
+import deblend
+import resample
+import noise
+import history
+import session
+import fit_cache
+import line_catalog
+import catalog_db
+import profiling
+from spectral_core import Eq
+from qt_tasks import TaskRunner
+from plot_canvas import MplCanvas
+# ----------------------------
+
+
+# ----------------------------
+# Main window class
+# ----------------------------
+class MainWindow(QtWidgets.QMainWindow):
+
+    def __init__(self, *args, **kwargs):
+        '''
+        Initialize the window along with corresponding buttons
+        '''
+        super(MainWindow, self).__init__(*args, **kwargs)
+        
+        # Data storage
+        self.object_name = ''
+        self.filename = ''
+        
+        self.spectrum = None
+        self.wavelengths = []
+        self.fluxes = []
+        
+        # Every transform of the loaded spectrum (smooth, clip, subtract continuum) as an undoable step
+        # on top of the untouched original; self.wavelengths / self.fluxes are always the current step's
+        self.history = None
+        self.history_depth = history.DEFAULT_DEPTH
+        
+        # Every other object opened this session, as session.SessionObjects, so switching back (or saving
+        # the session) keeps their data and continua; their lines stay in self.line_catalog
+        self.session_objects = {}
+        
+        self.continuum_wavelengths = []
+        self.continuum_fluxes = []
+        
+        self.continuum_fit = []
+        
+        self.xclick = 0.
+        self.yclick = 0.
+        
+        # Every fitted line as one row of a columnar catalog, and a streaming writer per object
+        # that remembers how many of that object's rows are already on disk
+        self.line_catalog = line_catalog.LineCatalog()
+        self.catalog_writers = {}
+        self.catalog_saved = 0
+        self.catalog_store = None
+        
+        
+        # Some booleans to keep track of whether things have been done
+        self.file_is_loaded = False
+        self.continuum_is_calculated = False
+        self.fitting_line = False
+        self.deblending = False
+        
+        
+        # Set up canvas
+        self.canvas = MplCanvas(self, width=5, height=4, dpi=100)
+        
+        self.canvas.axes.plot([0,1,2,3,4], [10,1,20,3,40], label = f"Some random data\n\nLoad in a file!")
+        self.canvas.axes.set_xlabel("some random data")
+        self.canvas.axes.legend()
+        
+        self.setWindowTitle("Spectrum Viewer")
+        self.setGeometry(100, 100, 800, 600)
+        
+        
+        # Buttons
+        toolbar = NavigationToolbar(self.canvas, self)
+        
+        self.open_file_button = QPushButton("Open File", self)
+        self.open_file_button.clicked.connect(self.open_file)
+        self.open_file_button.setGeometry(170, 10, 80, 30)
+        
+        self.def_cont_button = QPushButton("Define Continuum", self)
+        self.def_cont_button.clicked.connect(self.define_continuum)
+        self.def_cont_button.setGeometry(170, 10, 80, 30)
+        
+        # Continuum options: running median window, final polynomial order, and clip thresholds above/below the fit
+        self.continuum_window = QtWidgets.QDoubleSpinBox(self)
+        self.continuum_window.setRange(10., 5000.)
+        self.continuum_window.setValue(200.)
+        self.continuum_window.setPrefix("window ")
+        self.continuum_window.setSuffix(" A")
+        
+        self.continuum_order = QtWidgets.QSpinBox(self)
+        self.continuum_order.setRange(1, 20)
+        self.continuum_order.setValue(5)
+        self.continuum_order.setPrefix("order ")
+        
+        self.continuum_upper = QtWidgets.QDoubleSpinBox(self)
+        self.continuum_upper.setRange(0.5, 10.)
+        self.continuum_upper.setValue(2.5)
+        self.continuum_upper.setPrefix("clip +")
+        self.continuum_upper.setSuffix(" sigma")
+        
+        self.continuum_lower = QtWidgets.QDoubleSpinBox(self)
+        self.continuum_lower.setRange(0.5, 10.)
+        self.continuum_lower.setValue(3.)
+        self.continuum_lower.setPrefix("clip -")
+        self.continuum_lower.setSuffix(" sigma")
+        
+        self.fit_line_button = QPushButton("Fit Spectral Line", self)
+        self.fit_line_button.clicked.connect(self.toggle_fit_spectral_line)
+        self.fit_line_button.setGeometry(170, 10, 80, 30)
+        
+        # Monte Carlo errors: refit every line with this many noise realisations (0 keeps the covariance errors)
+        self.mc_realisations = QtWidgets.QSpinBox(self)
+        self.mc_realisations.setRange(0, 10000)
+        self.mc_realisations.setSingleStep(100)
+        self.mc_realisations.setValue(0)
+        self.mc_realisations.setPrefix("MC errors ")
+        self.mc_realisations.setSpecialValueText("covariance errors")
+        
+        # Deblend mode: the next click lands on the first line of the chosen complex, and all its lines are fit together
+        self.deblend_button = QPushButton("Deblend Lines", self)
+        self.deblend_button.clicked.connect(self.toggle_deblend)
+        self.deblend_button.setGeometry(170, 10, 80, 30)
+        
+        self.deblend_complex = QtWidgets.QComboBox(self)
+        for name, components in deblend.COMPLEXES.items():
+            self.deblend_complex.addItem(f"{name} (click {components[0].name})", name)
+        
+        self.auto_lines_button = QPushButton("Find Redshift && Fit Lines", self)
+        self.auto_lines_button.clicked.connect(self.auto_fit_lines)
+        self.auto_lines_button.setGeometry(170, 10, 80, 30)
+        
+        self.smooth_button = QPushButton("Smooth", self)
+        self.smooth_button.clicked.connect(self.smooth)
+        self.smooth_button.setGeometry(170, 10, 80, 30)
+        
+        # Smoothing options: kernel, its width in pixels, and how many pixels to rebin into one
+        self.smooth_kernel = QtWidgets.QComboBox(self)
+        for text, kernel in (("No kernel", None), ("Gaussian", 'gaussian'), ("Boxcar", 'boxcar'), ("Savitzky-Golay", 'savgol')):
+            self.smooth_kernel.addItem(text, kernel)
+        self.smooth_kernel.setCurrentIndex(1)
+        
+        self.smooth_width = QtWidgets.QDoubleSpinBox(self)
+        self.smooth_width.setRange(0.5, 1000.)
+        self.smooth_width.setValue(3.)
+        self.smooth_width.setPrefix("width ")
+        self.smooth_width.setSuffix(" px")
+        
+        self.smooth_factor = QtWidgets.QDoubleSpinBox(self)
+        self.smooth_factor.setRange(1., 100.)
+        self.smooth_factor.setValue(2.)
+        self.smooth_factor.setPrefix("rebin x")
+        
+        # Haircut clip: cosmic rays and other spikes up to a few pixels wide (noise.clip_spikes)
+        self.clip_button = QPushButton("Clip Spikes", self)
+        self.clip_button.clicked.connect(self.clip_spikes)
+        self.clip_button.setGeometry(170, 10, 80, 30)
+        
+        self.clip_sigma = QtWidgets.QDoubleSpinBox(self)
+        self.clip_sigma.setRange(1., 100.)
+        self.clip_sigma.setValue(5.)
+        self.clip_sigma.setPrefix("above ")
+        self.clip_sigma.setSuffix(" sigma")
+        
+        self.clip_width = QtWidgets.QSpinBox(self)
+        self.clip_width.setRange(1, 50)
+        self.clip_width.setValue(3)
+        self.clip_width.setPrefix("up to ")
+        self.clip_width.setSuffix(" px")
+        
+        # How many transform steps Undo can go back through (history.SpectrumHistory depth)
+        self.history_depth_box = QtWidgets.QSpinBox(self)
+        self.history_depth_box.setRange(1, 1000)
+        self.history_depth_box.setValue(self.history_depth)
+        self.history_depth_box.setPrefix("keep ")
+        self.history_depth_box.setSuffix(" steps")
+        self.history_depth_box.valueChanged.connect(self.set_history_depth)
+        
+        self.subtract_continuum_button = QPushButton("Subtract Continuum", self)
+        self.subtract_continuum_button.clicked.connect(self.subtract_continuum)
+        self.subtract_continuum_button.setGeometry(170, 10, 80, 30)
+        
+        self.undo_button = QPushButton("Undo", self)
+        self.undo_button.clicked.connect(self.undo)
+        self.undo_button.setGeometry(170, 10, 80, 30)
+        
+        self.redo_button = QPushButton("Redo", self)
+        self.redo_button.clicked.connect(self.redo)
+        self.redo_button.setGeometry(170, 10, 80, 30)
+        
+        self.revert_button = QPushButton("Revert to Original", self)
+        self.revert_button.clicked.connect(self.revert)
+        self.revert_button.setGeometry(170, 10, 80, 30)
+        for button in (self.undo_button, self.redo_button, self.revert_button):
+            button.setEnabled(False)
+        
+        self.line_catalog_button = QPushButton("Print Line Catalog - (View Data Before Saving File and Closing Program)", self)
+        self.line_catalog_button.clicked.connect(self.print_line_catalog)
+        self.line_catalog_button.setGeometry(170, 10, 80, 30)
+        
+        self.save_line_catalog_button = QPushButton("Save Line Catalog", self)
+        self.save_line_catalog_button.clicked.connect(self.save_line_catalog)
+        self.save_line_catalog_button.setGeometry(170, 10, 80, 30)
+        
+        # Sessions: every object's data, continuum and lines in one file (session.py), to carry on later or in batch_reduce
+        self.save_session_button = QPushButton("Save Session", self)
+        self.save_session_button.clicked.connect(self.save_session)
+        self.save_session_button.setGeometry(170, 10, 80, 30)
+        
+        self.open_session_button = QPushButton("Open Session", self)
+        self.open_session_button.clicked.connect(self.open_session)
+        self.open_session_button.setGeometry(170, 10, 80, 30)
+        
+        self.object_list = QtWidgets.QComboBox(self)
+        self.object_list.setToolTip("Switch between the objects opened this session")
+        self.object_list.activated.connect(self.switch_object)
+        
+        self.canvas.mpl_connect('button_press_event', self.on_click)
+        
+        
+        # Continuum and line fits are cached on disk, keyed on the data and options that went into them,
+        # so reopening an object and redoing the same fits is instant
+        self.cache = fit_cache.ResultCache(directory=fit_cache.CACHE_DIR_NAME)
+        
+        # Heavy fits run in the background, with a busy bar and a cancel button while anything is queued
+        self.tasks = TaskRunner(self)
+        self.tasks.pending_changed.connect(self.show_progress)
+        
+        self.progress_bar = QtWidgets.QProgressBar(self)
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.setVisible(False)
+        
+        self.progress_label = QtWidgets.QLabel("", self)
+        
+        self.cancel_button = QPushButton("Cancel", self)
+        self.cancel_button.clicked.connect(self.cancel_tasks)
+        self.cancel_button.setEnabled(False)
+        
+        layout = QtWidgets.QVBoxLayout()
+        layout.addWidget(toolbar)
+        file_row = QtWidgets.QHBoxLayout()
+        file_row.addWidget(self.open_file_button, stretch=1)
+        file_row.addWidget(self.object_list)
+        file_row.addWidget(self.open_session_button)
+        file_row.addWidget(self.save_session_button)
+        layout.addLayout(file_row)
+        
+        continuum_row = QtWidgets.QHBoxLayout()
+        continuum_row.addWidget(self.def_cont_button, stretch=1)
+        continuum_row.addWidget(self.continuum_window)
+        continuum_row.addWidget(self.continuum_order)
+        continuum_row.addWidget(self.continuum_upper)
+        continuum_row.addWidget(self.continuum_lower)
+        layout.addLayout(continuum_row)
+        
+        smooth_row = QtWidgets.QHBoxLayout()
+        smooth_row.addWidget(self.smooth_button, stretch=1)
+        smooth_row.addWidget(self.smooth_kernel)
+        smooth_row.addWidget(self.smooth_width)
+        smooth_row.addWidget(self.smooth_factor)
+        layout.addLayout(smooth_row)
+        
+        clip_row = QtWidgets.QHBoxLayout()
+        clip_row.addWidget(self.clip_button, stretch=1)
+        clip_row.addWidget(self.clip_sigma)
+        clip_row.addWidget(self.clip_width)
+        clip_row.addWidget(self.subtract_continuum_button, stretch=1)
+        layout.addLayout(clip_row)
+        
+        history_row = QtWidgets.QHBoxLayout()
+        history_row.addWidget(self.undo_button)
+        history_row.addWidget(self.redo_button)
+        history_row.addWidget(self.revert_button)
+        history_row.addWidget(self.history_depth_box)
+        layout.addLayout(history_row)
+        
+        fit_row = QtWidgets.QHBoxLayout()
+        fit_row.addWidget(self.fit_line_button, stretch=1)
+        fit_row.addWidget(self.mc_realisations)
+        layout.addLayout(fit_row)
+        
+        deblend_row = QtWidgets.QHBoxLayout()
+        deblend_row.addWidget(self.deblend_button, stretch=1)
+        deblend_row.addWidget(self.deblend_complex)
+        layout.addLayout(deblend_row)
+        
+        layout.addWidget(self.auto_lines_button)
+        layout.addWidget(self.line_catalog_button)
+        layout.addWidget(self.save_line_catalog_button)
+        
+        progress_row = QtWidgets.QHBoxLayout()
+        progress_row.addWidget(self.progress_label)
+        progress_row.addWidget(self.progress_bar)
+        progress_row.addWidget(self.cancel_button)
+        layout.addLayout(progress_row)
+        
+        layout.addWidget(self.canvas)
+
+        widget = QtWidgets.QWidget()
+        widget.setLayout(layout)
+        self.setCentralWidget(widget)
+        self.show()
+    
+        
+    
+    def read_csv(filename):
+        return spectral_core.read_spectrum(filename)
+    
+    
+    
+    def open_file(self):
+        '''
+        Open a csv file!
+        File conventions should have a title line, then two columns with a space as a delimiter - one for wavelength and one for flux.
+        
+        Future Work:
+        - This should be adaptable to many more filetypes such as fits files and more general csv files. Currently it really only takes the csv filetypes that are provided.
+        '''
+        filename, _ = QFileDialog.getOpenFileName(self, "Open Spectrum", "", "CSV files (*.csv)")
+        if filename:
+            # Anything still running belongs to the old spectrum
+            self.tasks.cancel_all()
+            self.continuum_is_calculated = False
+            self.continuum_fit = []
+            self.stash_object()
+            self.file_is_loaded = True
+            self.filename = filename
+            self.object_name = spectral_core.object_name_from_path(filename)
+            # Reopening a file starts that object afresh
+            self.session_objects.pop(self.object_name, None)
+            self.spectrum = spectral_core.load_spectrum(filename)
+            self.history = history.SpectrumHistory(self.spectrum.wavelengths, self.spectrum.fluxes, depth=self.history_depth)
+            self.show_step(self.history.current)
+            self.update_object_list()
+            
+            
+    def define_continuum(self):
+        '''
+        This function takes a running median of every pixel over the chosen window (200 Angstroms by default)
+        and fits a third order polynomial to those samples, shown in red.
+        It then removes every sample more than the chosen number of sigma above or below a higher order fit,
+        refitting until nothing changes. Removed samples are shown in red.
+        The remaining samples and the final fit are shown in green. See continuum.py.
+        
+        The fit itself runs in the background; show_continuum plots it once it's done.
+        '''
+        if not self.file_is_loaded:
+            print("Load a file in!!")
+            return
+        self.tasks.submit(spectral_core.define_continuum, self.wavelengths, self.fluxes,
+                          window=self.continuum_window.value(), final_order=self.continuum_order.value(),
+                          upper_sigma=self.continuum_upper.value(), lower_sigma=self.continuum_lower.value(),
+                          cache=self.cache, on_result=self.show_continuum, label="Fitting continuum")
+        
+        
+    def show_continuum(self, fit):
+        '''
+        Plots a finished spectral_core.ContinuumFit and keeps it for line fitting.
+        '''
+        try:
+            self.continuum_wavelengths, self.continuum_fluxes = fit.wavelengths, fit.fluxes
+            self.continuum_fit = fit.continuum
+            self.history.current.continuum = fit
+
+            self.canvas.show_continuum(fit, self.wavelengths)
+            self.continuum_is_calculated = True
+        except:
+            if not self.file_is_loaded:
+                print("Load a file in!!")
+            else:
+                traceback.print_exc()
+                
+    
+    def smooth(self):
+        '''
+        Smooths the spectrum with the kernel and width picked next to the button,
+        then rebins it by the chosen factor with a flux conserving resampler (resample.py).
+        The result is a new step in the history (history.py), so Undo or Revert to Original gets the data back.
+        The continuum no longer matches the new pixels, so it has to be defined again.
+        '''
+        self.transform('smooth', resample.smooth_and_rebin, kernel=self.smooth_kernel.currentData(),
+                       width=self.smooth_width.value(), factor=self.smooth_factor.value())
+        
+        
+    def clip_spikes(self):
+        '''
+        Haircut clip: runs of pixels more than the chosen number of sigma away from a wide running median, and no
+        longer than the chosen number of pixels, are bridged with a straight line (noise.clip_spikes).
+        Cosmic rays and sky residuals go; emission lines are wider and stay. Undoable like Smooth.
+        '''
+        self.transform('clip', noise.clip_spikes, sigma=self.clip_sigma.value(), max_width=self.clip_width.value())
+        
+        
+    def subtract_continuum(self):
+        '''
+        Replaces the spectrum with the spectrum minus the continuum fit, to look at the lines on their own.
+        Undo brings back the spectrum and its continuum.
+        '''
+        if not self.continuum_is_calculated:
+            print("Make sure to define your continuum!")
+            return
+        self.transform('subtract continuum', spectral_core.subtract_continuum, continuum=self.continuum_fit)
+        
+        
+    def transform(self, name, fn, **options):
+        '''
+        Applies fn to the current spectrum as a new history step and shows it.
+        '''
+        if not self.file_is_loaded:
+            print("Load a file in!!")
+            return
+        try:
+            self.show_step(self.history.apply(name, fn, **options))
+        except:
+            traceback.print_exc()
+            
+            
+    def undo(self):
+        if self.history is not None and self.history.can_undo:
+            self.show_step(self.history.undo())
+            
+            
+    def redo(self):
+        if self.history is not None and self.history.can_redo:
+            self.show_step(self.history.redo())
+            
+            
+    def revert(self):
+        '''
+        Back to the spectrum as loaded, instantly and without rereading the file. Redo steps forward again.
+        '''
+        if self.history is not None and self.history.can_undo:
+            self.show_step(self.history.revert())
+
+
+    def set_history_depth(self, depth):
+        '''
+        New undo depth, for this spectrum's history and every one opened after it.
+        A smaller depth drops the oldest steps the next time a transform is applied, not straight away.
+        '''
+        self.history_depth = depth
+        if self.history is not None:
+            self.history.depth = depth
+
+
+    def show_step(self, step):
+        '''
+        Makes a history step the current spectrum: plots it, and brings back the continuum defined on it, if any.
+        Nothing is copied; the arrays are the step's own read-only ones.
+        '''
+        # Pending fits were started on another step's arrays
+        self.tasks.cancel_all()
+        self.wavelengths, self.fluxes = step.wavelengths, step.fluxes
+        self.canvas.show_spectrum(self.wavelengths, self.fluxes, title=f'{self.object_name}',
+                                  color=None if step is self.history.original else 'blue')
+        self.continuum_is_calculated = False
+        self.continuum_fit = []
+        if step.continuum is not None:
+            self.show_continuum(step.continuum)
+        self.undo_button.setEnabled(self.history.can_undo)
+        self.redo_button.setEnabled(self.history.can_redo)
+        self.revert_button.setEnabled(self.history.can_undo)
+    
+    
+    def on_click(self, event):
+        if event.button == 1 and event.inaxes:
+            self.xclick, self.yclick = event.xdata, event.ydata
+            try:
+                if self.fitting_line:
+                    MainWindow.fit_spectral_line(self)
+                elif self.deblending:
+                    MainWindow.deblend_lines(self)
+            except:
+                if not self.file_is_loaded:
+                    print("Load a file in!!")
+                elif not self.continuum_is_calculated:
+                    print("Make sure to define your continuum!")
+                else:
+                    traceback.print_exc()
+                    
+
+    def toggle_fit_spectral_line(self):
+        self.fitting_line = True        
+        self.deblending = False
+        
+    
+    def fit_spectral_line(self):
+        '''
+        This function first finds the maximum flux value within a set range of where you click to fit in order to define the peak of the spectral line.
+        It is a bit of a narrow range, so be fairly precise when you're identifying a line!
+        The algorithm then subtracts the continuum around the peak, out to where the line falls back into the noise
+        (from a per-pixel noise map, see noise.py), and leaves us with the residuals, plotted in dotted red.
+        We then fit a Gaussian to the residual data.
+        
+        After fitting the Gaussian, the total flux is calculated analytically from the fit parameters,
+        and the equivalent width integrates the Gaussian over the full continuum fit (see line_measure.py).
+        Both carry errors propagated from the fit covariance, or, with the MC errors box next to the button above 0,
+        errors from refitting that many noise realisations of the window (see line_errors.py), which hold up
+        better for weak lines. The centre and width get errors too.
+        
+        The fit runs in the background, so several clicks can queue up; show_spectral_line plots each one as it finishes.
+
+        '''
+        if not self.file_is_loaded:
+            print("Load a file in!!")
+            return
+        if not self.continuum_is_calculated:
+            print("Make sure to define your continuum!")
+            return
+        
+        self.tasks.submit(spectral_core.fit_spectral_line, self.wavelengths, self.fluxes, self.continuum_fit, self.xclick,
+                          realisations=self.mc_realisations.value(), cache=self.cache, on_result=self.show_spectral_line,
+                          label=f"Fitting line near {self.xclick:.1f}")
+        self.fitting_line = False
+        
+        
+    def show_spectral_line(self, result):
+        '''
+        Adds a finished line fit to the catalog and plots it.
+        '''
+        line, xdata, cont_subtracted_fluxes = result
+        self.line_catalog.append(line, self.object_name)
+
+               
+        # Plotting!
+        self.canvas.add_line_fit(xdata, line.profile(xdata), cont_subtracted_fluxes, label=f'Line {line.line_wav}')
+        
+        
+    def toggle_deblend(self):
+        self.deblending = True
+        self.fitting_line = False
+        
+        
+    def deblend_lines(self):
+        '''
+        Fits every line of the complex picked next to the button at once (see deblend.py), for lines that overlap,
+        like Hb and [O III] or Ha and [N II]. Click on the first line named in the list; the redshift comes from its peak.
+        Doublets share their velocity and width, and the [O III] and [N II] doublets keep their atomic flux ratios.
+        The total fit and each component are plotted, and every component goes into the catalog with its name.
+        '''
+        if not self.file_is_loaded:
+            print("Load a file in!!")
+            return
+        if not self.continuum_is_calculated:
+            print("Make sure to define your continuum!")
+            return
+        
+        name = self.deblend_complex.currentData()
+        self.tasks.submit(deblend.deblend, self.wavelengths, self.fluxes, self.continuum_fit, name, xclick=self.xclick,
+                          cache=self.cache, on_result=self.show_deblended, label=f"Deblending {name}")
+        self.deblending = False
+        
+        
+    def show_deblended(self, result):
+        '''
+        Adds the components of a finished deblend to the catalog and plots the blend and its components.
+        '''
+        lines, fit = result
+        if not lines:
+            print("Deblending did not converge, try clicking closer to the line peak")
+            return
+        self.canvas.add_line_fit(fit.xdata, fit.model(fit.xdata), fit.ydata, label='Blend')
+        for line, profile in zip(lines, fit.component_profiles(fit.xdata)):
+            self.line_catalog.append(line, self.object_name)
+            self.canvas.add_line_fit(fit.xdata, profile + fit.baseline_at(fit.xdata), None, label=f'{line.name} {line.line_wav:.1f}')
+        
+        
+    def auto_fit_lines(self):
+        '''
+        Finds the redshift by cross-correlating the continuum subtracted spectrum with a template of
+        the strong quasar emission lines (see redshift.py), then fits every line expected at that
+        redshift in one go. Each line lands in the catalog with its name, rest wavelength and redshift.
+        '''
+        if not self.file_is_loaded:
+            print("Load a file in!!")
+            return
+        if not self.continuum_is_calculated:
+            print("Make sure to define your continuum!")
+            return
+        
+        self.tasks.submit(redshift.auto_fit_lines, self.wavelengths, self.fluxes, self.continuum_fit, cache=self.cache,
+                          realisations=self.mc_realisations.value(), on_result=self.show_auto_lines, label="Finding redshift")
+        
+        
+    def show_auto_lines(self, result):
+        '''
+        Adds and plots every line auto_fit_lines found.
+        '''
+        z_result, lines, windows, failed = result
+        print(f"{self.object_name}: {z_result.describe()}, {len(lines)} lines fit")
+        if z_result.problem:
+            print(f"- no lines kept, {z_result.problem}")
+        for name, observed, reason in failed:
+            print(f"- {name} near {observed:.1f} skipped: {reason}")
+        for line, (xdata, cont_subtracted_fluxes) in zip(lines, windows):
+            self.line_catalog.append(line, self.object_name)
+            self.canvas.add_line_fit(xdata, line.profile(xdata), cont_subtracted_fluxes, label=f'{line.name} {line.line_wav}')
+        
+        
+    def show_progress(self, pending, label):
+        self.progress_bar.setVisible(pending > 0)
+        self.cancel_button.setEnabled(pending > 0)
+        self.progress_label.setText(f"{label} ({pending} queued)" if pending else "")
+        
+        
+    def cancel_tasks(self):
+        self.tasks.cancel_all()
+        
+        
+    def print_line_catalog(self):
+        print('-----------')
+        for line in self.line_catalog:
+            print(f"\nObject:       {line['object']}")
+            print("Wavelength:  ", line['wavelength'], "(Angstroms)")
+            print("- Centre:    ", line['center'], "+/-", line['center_err'], "(Angstroms)")
+            print("- Sigma:     ", line['sigma'], "+/-", line['sigma_err'], "(Angstroms)")
+            if line['name']:
+                print("- Line:      ", line['name'], f"(rest {line['rest_wav']}, z = {line['redshift']:.4f})")
+            print("- Max Flux:  ", line['peak_flux'], "(erg/s/cm2/A)")
+            print("- Tot. Flux: ", line['total_flux'], "+/-", line['total_flux_err'], "(erg/s/cm2)")
+            print("- Eq. Width: ", line['eq_wid'], "+/-", line['eq_wid_err'], "(Angstroms)")
+            if line['n_realisations']:
+                print("- Errors from", line['n_realisations'], "Monte Carlo realisations")
+        print('-----------')
+        print(f'Fit cache: {self.cache.summary()}')
+        # Started with QUASAR_PROFILE set: time spent per stage so far (fits, redraws, ...)
+        if profiling.enabled():
+            print(profiling.summary_table(profiling.events()))
+            
+            
+    def save_line_catalog(self):
+        '''
+        Saves the emission line data to './Line Catalogs/<object> Line Catalog.csv', plus a binary columnar
+        copy in '<object> Line Catalog.cols' (see line_catalog.py).
+        The lines also go into the SQLite catalog './Line Catalogs/line_catalog.sqlite' for queries across
+        objects (see catalog_db.py); the first save of an object this session replaces what was stored for it before.
+        Only lines added since the last save are written, so this can be pressed any number of times
+        and the window stays open.
+        '''
+        if self.catalog_store is None:
+            self.catalog_store = catalog_db.CatalogStore(catalog_db.DEFAULT_DB)
+        new_rows = self.line_catalog.rows[self.catalog_saved:]
+        for object_name in np.unique(new_rows['object']):
+            object_rows = new_rows[new_rows['object'] == object_name]
+            if object_name not in self.catalog_writers:
+                self.catalog_writers[object_name] = line_catalog.CatalogWriter(spectral_core.catalog_path(object_name))
+                self.catalog_store.replace_object(object_name, object_rows)
+            else:
+                self.catalog_store.insert(object_rows)
+            writer = self.catalog_writers[object_name]
+            writer.write(object_rows)
+            print(f"{object_name}: saved {len(object_rows)} new lines ({writer.rows_written} total) to {writer.csv_path}")
+        self.catalog_saved += len(new_rows)
+
+        
+        
+    def close_catalog_writers(self):
+        '''
+        Closes every object's open catalog files, so the next save of each starts its catalog afresh.
+        '''
+        for writer in self.catalog_writers.values():
+            writer.close()
+        self.catalog_writers = {}
+        
+        
+    def snapshot(self):
+        '''
+        The object on screen as a session.SessionObject: its original and current data, and the continuum on the current step.
+        Nothing is copied, the history's read-only arrays are shared.
+        '''
+        return session.SessionObject.from_history(self.object_name, self.history, filename=self.filename)
+    
+    
+    def stash_object(self):
+        '''
+        Keeps the object on screen in self.session_objects before another one replaces it.
+        '''
+        if self.file_is_loaded:
+            self.session_objects[self.object_name] = self.snapshot()
+            
+            
+    def update_object_list(self):
+        names = sorted(set(self.session_objects) | {self.object_name})
+        self.object_list.clear()
+        self.object_list.addItems(names)
+        self.object_list.setCurrentIndex(names.index(self.object_name))
+        
+        
+    def switch_object(self, index):
+        name = self.object_list.itemText(index)
+        if name != self.object_name and name in self.session_objects:
+            self.stash_object()
+            self.show_object(self.session_objects.pop(name))
+            
+            
+    def show_object(self, obj):
+        '''
+        Puts a session.SessionObject on screen as it was left: its history (original plus current data), its continuum,
+        and the Gaussians of its lines in the catalog.
+        '''
+        self.tasks.cancel_all()
+        self.file_is_loaded = True
+        self.object_name, self.filename = obj.name, obj.filename
+        self.spectrum = None
+        self.history = obj.to_history(self.history_depth)
+        self.show_step(self.history.current)
+        rows = self.line_catalog.rows
+        for row in rows[rows['object'] == obj.name]:
+            x = np.linspace(row['center'] - 4 * row['sigma'], row['center'] + 4 * row['sigma'], 200)
+            label = f"{row['name']} {row['wavelength']:.1f}" if row['name'] else f"Line {row['wavelength']}"
+            self.canvas.add_line_fit(x, Eq.gaussian(x, row['amplitude'], row['center'], row['sigma']), None, label=label)
+        self.update_object_list()
+        
+        
+    def write_session(self, path):
+        '''
+        Writes every object of this session (the one on screen first) and the whole line catalog to path.
+        '''
+        objects = [self.snapshot()] if self.file_is_loaded else []
+        objects += [obj for name, obj in self.session_objects.items() if name != self.object_name]
+        rows = self.line_catalog.rows
+        with session.SessionWriter(path) as writer:
+            for obj in objects:
+                obj.lines = rows[rows['object'] == obj.name]
+                writer.add(obj)
+            writer.add_lines(rows[~np.isin(rows['object'], [obj.name for obj in objects])])
+        print(f"Saved {len(objects)} objects and {len(rows)} lines to {path}")
+        
+        
+    def save_session(self):
+        '''
+        Saves the session: every object opened so far (as loaded, as it is now, and its continuum) and every fitted line,
+        in one binary file (session.py). Open Session picks up from it, and batch_reduce takes it as a target.
+        '''
+        if not self.file_is_loaded and not len(self.line_catalog):
+            print("Nothing to save yet!")
+            return
+        os.makedirs(session.SESSION_DIR, exist_ok=True)
+        default = os.path.join(session.SESSION_DIR, f'{self.object_name or "Session"}{session.SESSION_SUFFIX}')
+        path, _ = QFileDialog.getSaveFileName(self, "Save Session", default, "Sessions (*.npz)")
+        if path:
+            if not path.endswith(session.SESSION_SUFFIX):
+                path += session.SESSION_SUFFIX
+            self.write_session(path)
+            
+            
+    def open_session(self):
+        '''
+        Opens a saved session: its objects join this one (the first goes on screen, the list next to Open File switches),
+        and its lines replace any lines of the same objects in the catalog. Nothing is reread or refit; the arrays are
+        memory mapped straight out of the file.
+        The next Save Line Catalog writes each of those objects' catalogs out in full.
+        '''
+        path, _ = QFileDialog.getOpenFileName(self, "Open Session", session.SESSION_DIR, "Sessions (*.npz)")
+        if not path:
+            return
+        try:
+            opened = session.load_session(path)
+        except (OSError, ValueError, KeyError):
+            traceback.print_exc()
+            return
+        self.stash_object()
+        self.session_objects.update((obj.name, obj) for obj in opened)
+        
+        rows = self.line_catalog.rows
+        catalog = line_catalog.LineCatalog()
+        catalog.extend_rows(rows[~np.isin(rows['object'], opened.names)])
+        catalog.extend_rows(opened.lines)
+        self.line_catalog = catalog
+        self.catalog_saved = 0
+        self.close_catalog_writers()
+        print(f"Opened {opened}")
+        if len(opened):
+            self.show_object(self.session_objects.pop(str(opened.names[0])))
+            
+            
+    def closeEvent(self, event):
+        '''
+        Closing the window saves the session to './Sessions/Last Session.npz' first, so nothing is lost.
+        '''
+        if self.file_is_loaded:
+            self.tasks.cancel_all()
+            try:
+                self.write_session(os.path.join(session.SESSION_DIR, session.LAST_SESSION_NAME))
+            except OSError:
+                traceback.print_exc()
+        self.close_catalog_writers()
+        super(MainWindow, self).closeEvent(event)
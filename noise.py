@@ -0,0 +1,163 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Per-pixel noise maps, and line boundaries found from them.
+fit_spectral_line used to fit 50 pixels either side of every peak, which pulls unrelated data into narrow
+lines and cuts the wings off broad ones. Instead, the noise is estimated once per spectrum and every line is
+fit out to where its continuum subtracted flux falls back into the noise.
+
+The noise comes from second differences (the DER_SNR estimator of Stoehr et al. 2008):
+
+    noise = 1.482602 / sqrt(6) * median |2 f_i - f_(i-2) - f_(i+2)|
+
+over a running window (continuum.running_percentile), so it follows the noise across the spectrum.
+Smooth structure, including broad emission lines and the continuum, barely changes second differences,
+so the estimate doesn't need the continuum and isn't inflated by the lines it's used to measure.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import warnings
+
+import numpy as np
+
+import continuum as continuum_module
+import profiling
+# ----------------------------
+
+
+DER_SNR_SCALE = 1.482602 / np.sqrt(6.)
+
+
+# ----------------------------
+# Noise
+# ----------------------------
+@profiling.profiled('noise_map')
+def noise_map(wavelengths, fluxes, window=100.):
+    '''
+    1 sigma noise at every pixel, from the running median (over window Angstroms) of the second differences.
+    Pixels without data (continuum.good_pixels) are left out of the estimate but still get a value.
+    wavelengths may be a spectrum.UniformGrid. Returns a float64 array like fluxes.
+    '''
+    fluxes = np.asarray(fluxes, dtype=np.float64)
+    n = len(fluxes)
+    good = continuum_module.good_pixels(fluxes)
+    second = np.full(n, np.nan)
+    usable = np.zeros(n, dtype=bool)
+    if n > 4:
+        second[2:-2] = np.abs(2 * fluxes[2:-2] - fluxes[:-4] - fluxes[4:])
+        usable[2:-2] = good[2:-2] & good[:-4] & good[4:]
+    centres, medians, _ = continuum_module.running_percentile(wavelengths, second, window=window, q=50., mask=usable)
+    known = np.isfinite(medians)
+    if not known.any():
+        return np.full(n, np.nan)
+    return DER_SNR_SCALE * np.interp(np.asarray(wavelengths, dtype=np.float64), centres[known], medians[known])
+
+
+# ----------------------------
+# Line boundaries
+# ----------------------------
+def _next_true(mask):
+    '''
+    For every pixel, the first index at or after it where mask is True (len(mask) if none).
+    '''
+    n = len(mask)
+    return np.minimum.accumulate(np.where(mask, np.arange(n), n)[::-1])[::-1]
+
+
+def _previous_true(mask):
+    '''
+    For every pixel, the last index at or before it where mask is True (-1 if none).
+    '''
+    return np.maximum.accumulate(np.where(mask, np.arange(len(mask)), -1))
+
+
+def line_bounds(residual, noise, peaks, threshold=1., run=3, pad=0.5, min_half=8, max_half=400):
+    '''
+    Fit windows for lines peaking at the pixel indices peaks, given the continuum subtracted flux and noise maps.
+    Each side of a line ends where the residual has stayed below threshold * noise for run pixels in a row
+    (so single noise dips inside a line don't cut it short), and is then widened by pad times its length
+    to give the fit some baseline. Every side is kept between min_half and max_half pixels.
+    All the lines are found at once with two prefix scans over the spectrum, no per-line searching.
+    Returns (lo, hi): first and last pixel of each window, inclusive.
+    '''
+    residual = np.asarray(residual, dtype=np.float64)
+    peaks = np.atleast_1d(np.asarray(peaks, dtype=np.intp))
+    n = len(residual)
+    with np.errstate(invalid='ignore'):
+        # NaN residuals or noise count as quiet, so a line never runs across missing data
+        quiet = ~(residual > threshold * noise)
+    # quiet_run[i]: pixels i .. i + run - 1 are all quiet
+    padded = np.concatenate([quiet, np.ones(run - 1, dtype=bool)])
+    quiet_run = np.lib.stride_tricks.sliding_window_view(padded, run).all(axis=1)
+
+    # Right side: the line's last pixel is just before the next quiet run; left side: just after the previous one
+    ends = _next_true(quiet_run)[np.minimum(peaks + 1, n - 1)] - 1
+    starts_run = np.concatenate([np.zeros(run - 1, dtype=bool), quiet_run[:n - run + 1]])
+    starts = _previous_true(starts_run)[np.maximum(peaks - 1, 0)] + 1
+
+    left = np.clip(np.ceil((peaks - starts) * (1 + pad)), min_half, max_half).astype(np.intp)
+    right = np.clip(np.ceil((ends - peaks) * (1 + pad)), min_half, max_half).astype(np.intp)
+    return np.maximum(peaks - left, 0), np.minimum(peaks + right, n - 1)
+
+
+# ----------------------------
+# Spike clipping
+# ----------------------------
+def _run_lengths(mask):
+    '''
+    For every pixel, the length of the run of True values it belongs to (0 where mask is False).
+    '''
+    edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    lengths = np.zeros(len(mask), dtype=np.intp)
+    lengths[mask] = np.repeat(ends - starts, ends - starts)
+    return lengths
+
+
+@profiling.profiled('clip_spikes')
+def clip_spikes(wavelengths, fluxes, sigma=5., max_width=3, window=100., baseline_width=41):
+    '''
+    "Haircut" clip of spikes (cosmic rays, sky line residuals) no more than max_width pixels wide.
+    Every pixel is compared to the median of the baseline_width pixels around it (at least 8 * max_width + 1),
+    far wider than any spike, and the noise is the robust scatter around that median (1.4826 times its running
+    median absolute deviation over window Angstroms). Unlike noise_map's pixel to pixel estimate, that scatter
+    includes the correlation between neighbouring pixels of resampled spectra, so it isn't underestimated.
+    Only runs of at most max_width pixels more than sigma times the noise from the median, and from a straight line
+    across them, are clipped, and they are replaced by that straight line. Emission lines, however narrow and strong,
+    stand out over more pixels than that and are left alone.
+    Returns (wavelengths, fluxes) like resample.smooth_and_rebin; nothing passed in is modified.
+    '''
+    fluxes = np.asarray(fluxes, dtype=np.float64)
+    half = max(int(baseline_width) // 2, 4 * int(max_width))
+    if len(fluxes) <= 2 * half:
+        return wavelengths, fluxes
+    good = continuum_module.good_pixels(fluxes)
+    padded = np.pad(np.where(good, fluxes, np.nan), half, constant_values=np.nan)
+    with np.errstate(invalid='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN neighbourhoods
+        baseline = np.nanmedian(np.lib.stride_tricks.sliding_window_view(padded, 2 * half + 1), axis=1)
+        deviation = np.abs(fluxes - baseline)
+        centres, mad, _ = continuum_module.running_percentile(wavelengths, deviation, window=window, q=50.,
+                                                              mask=good & np.isfinite(deviation))
+        known = np.isfinite(mad)
+        if not known.any():
+            return wavelengths, fluxes
+        scatter = 1.4826 * np.interp(np.asarray(wavelengths, dtype=np.float64), centres[known], mad[known])
+        outlying = good & (deviation > sigma * scatter)
+    candidates = outlying & (_run_lengths(outlying) <= max_width)
+    if not candidates.any():
+        return wavelengths, fluxes
+    # A short run still has to stand out from the pixels either side of it, so noise on top of a line's peak
+    # (where the wide median sits a little low) isn't mistaken for a spike
+    keep = good & ~candidates
+    index = np.arange(len(fluxes))
+    bridged = np.interp(index[candidates], index[keep], fluxes[keep])
+    spikes = np.zeros(len(fluxes), dtype=bool)
+    spikes[candidates] = np.abs(fluxes[candidates] - bridged) > sigma * scatter[candidates]
+    clipped = fluxes.copy()
+    clipped[spikes] = bridged[spikes[candidates]]
+    return wavelengths, clipped
@@ -0,0 +1,301 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+The matplotlib canvas embedded in the GUI.
+It keeps one persistent set of artists (spectrum, continuum samples and fits, line fits and residuals)
+and updates them with set_data/set_segments instead of clearing the axes and plotting new lines.
+The spectrum is static and gets cached as a background; the overlays are drawn as animated artists
+and blitted on top. Only the newest line fit is animated: when the next one arrives, the previous fit is painted
+into the cached background once and joins the static 'fits' / 'residuals' collections, so a refresh draws one
+fit however long the catalog is, and adding the 200th line costs about the same as adding the first.
+Every refresh is timed into frame_times.
+
+Spectra longer than LOD_THRESHOLD pixels are drawn through a decimate.LODPyramid: only about two
+points per screen pixel of the current x-range are handed to matplotlib, refreshed on every zoom/pan.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import time
+from collections import deque
+
+import numpy as np
+
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+
+import decimate
+import profiling
+# ----------------------------
+
+
+LOD_THRESHOLD = 20000
+
+
+# ----------------------------
+# Canvas class
+# ----------------------------
+class MplCanvas(FigureCanvasQTAgg):
+
+    def __init__(self, parent=None, width=5, height=4, dpi=100):
+        fig = Figure(figsize=(width, height), dpi=dpi)
+        self.axes = fig.add_subplot(111)
+        super(MplCanvas, self).__init__(fig)
+
+        self.spectrum_line = None
+        self.zero_line = None
+        self.lod = None
+        self.overlays = {}
+        self.legend = None
+        self.fit_labels = []
+        # The newest fit as (fit segment, residual segment or None, colour) and everything settled before it,
+        # kept in plain lists: reading a LineCollection back costs O(catalog) per call
+        self._newest = None
+        self._settled = {'fits': ([], []), 'residuals': ([], [])}
+        self._settled_stale = False
+        self._background = None
+        self.frame_times = deque(maxlen=1000)
+        self.mpl_connect('draw_event', self._on_draw)
+
+    # ----------------------------
+    # Spectrum (static background)
+    # ----------------------------
+    def show_spectrum(self, wavelengths, fluxes, title='', color=None):
+        '''
+        Shows a new spectrum, dropping every overlay.
+        The first call clears whatever placeholder was on the axes; after that the same Line2D is reused.
+        '''
+        # Big spectra get a min/max pyramid, built once here; the full-range render still holds the global extremes
+        self.lod = decimate.LODPyramid(wavelengths, fluxes) if len(fluxes) > LOD_THRESHOLD else None
+        if self.lod is not None:
+            wavelengths, fluxes = self.lod.render_all(self._max_points())
+        else:
+            wavelengths = np.asarray(wavelengths)
+
+        if self.spectrum_line is None:
+            self.axes.cla()
+            self.spectrum_line, = self.axes.plot(wavelengths, fluxes)
+            self.zero_line = self.axes.axhline(0, color='black')
+            self.axes.set_xlabel("Wavelength (Angstroms)")
+            self.axes.set_ylabel("Flux (erg/s/cm2/A)")
+            self._make_overlays()
+            self.axes.callbacks.connect('xlim_changed', self._on_xlim_changed)
+        else:
+            self.spectrum_line.set_data(wavelengths, fluxes)
+        self.spectrum_line.set_color(color if color is not None else 'C0')
+        self.axes.set_title(title)
+        self.clear_overlays(refresh=False)
+
+        # Overlays never move the limits, that's what keeps the cached background valid
+        self.axes.set_autoscale_on(True)
+        self.axes.relim(visible_only=True)
+        self.axes.autoscale_view()
+        self.axes.set_autoscale_on(False)
+        self.full_redraw()
+
+    def _max_points(self):
+        '''
+        About two points per screen pixel across the axes.
+        '''
+        return max(int(2 * self.axes.bbox.width), 200)
+
+    def _on_xlim_changed(self, axes):
+        '''
+        Zoom/pan: re-render the decimated spectrum for the new x-range before the redraw happens.
+        '''
+        if self.lod is None:
+            return
+        xlo, xhi = sorted(axes.get_xlim())
+        self.spectrum_line.set_data(*self.lod.render(xlo, xhi, self._max_points()))
+
+    def _make_overlays(self):
+        '''
+        Creates the (empty) overlay artists once.
+        '''
+        ax = self.axes
+        self.overlays = {
+            'samples': ax.plot([], [], 'o', color='red', animated=True)[0],
+            'kept': ax.plot([], [], 'o', color='green', animated=True)[0],
+            'original_fit': ax.plot([], [], '-', color='red', label='Original Continuum Fit', animated=True)[0],
+            'continuum': ax.plot([], [], '-', color='green', label='Final Continuum Fit', animated=True)[0],
+            # Every line fit but the newest, drawn into the background
+            'fits': ax.add_collection(LineCollection([], linestyles='--'), autolim=False),
+            'residuals': ax.add_collection(LineCollection([], linestyles='--', colors='red'), autolim=False),
+            'new_fit': ax.add_collection(LineCollection([], linestyles='--', animated=True), autolim=False),
+            'new_residuals': ax.add_collection(LineCollection([], linestyles='--', colors='red', animated=True),
+                                               autolim=False),
+        }
+
+    # ----------------------------
+    # Overlays
+    # ----------------------------
+    def show_continuum(self, fit, wavelengths):
+        '''
+        Draws a spectral_core.ContinuumFit: red samples and first fit, green kept samples and final fit.
+        '''
+        self.overlays['samples'].set_data(fit.sample_wavelengths, fit.sample_fluxes)
+        self.overlays['kept'].set_data(fit.wavelengths, fit.fluxes)
+        self.overlays['original_fit'].set_data(fit.sample_wavelengths, fit.original_yfit)
+        self.overlays['continuum'].set_data(np.asarray(wavelengths), fit.continuum)
+        self._update_legend()
+        self.refresh()
+
+    def add_line_fit(self, xdata, fit_y, residuals, label):
+        '''
+        Appends one fitted line (dashed) and its continuum subtracted residuals (dashed red).
+        residuals=None adds only the fit, e.g. for the components of a blend whose residuals are already shown.
+        The previous newest fit is settled into the background first, so only this one is redrawn on every refresh.
+        '''
+        self._settle_newest()
+        fit = np.column_stack([xdata, fit_y])
+        resid = None if residuals is None else np.column_stack([xdata, residuals])
+        color = f'C{(len(self.fit_labels) + 1) % 10}'
+        self._newest = (fit, resid, color)
+        self.overlays['new_fit'].set_segments([fit])
+        self.overlays['new_fit'].set_color(color)
+        self.overlays['new_residuals'].set_segments([] if resid is None else [resid])
+
+        self.fit_labels.append(label)
+        self._update_legend()
+        self.refresh()
+
+    def _settle_newest(self):
+        '''
+        Moves the newest fit (and its residuals) into the static collections and paints it into the cached
+        background, without a full draw: restore the background, draw just that fit on it, and copy it back.
+        The static collections themselves are only brought up to date before the next full draw (see draw).
+        '''
+        if self._newest is None:
+            return
+        new_fit, new_residuals = self.overlays['new_fit'], self.overlays['new_residuals']
+        if self._background is not None:
+            self.restore_region(self._background)
+            self.figure.draw_artist(new_residuals)
+            self.figure.draw_artist(new_fit)
+            self._background = self.copy_from_bbox(self.figure.bbox)
+        fit, resid, color = self._newest
+        self._settled['fits'][0].append(fit)
+        self._settled['fits'][1].append(color)
+        if resid is not None:
+            self._settled['residuals'][0].append(resid)
+            self._settled['residuals'][1].append('red')
+        self._settled_stale = True
+        self._newest = None
+        new_fit.set_segments([])
+        new_residuals.set_segments([])
+
+    def _sync_settled(self):
+        if not self._settled_stale:
+            return
+        for name, (segments, colors) in self._settled.items():
+            self.overlays[name].set_segments(segments)
+            if colors:
+                self.overlays[name].set_colors(colors)
+        self._settled_stale = False
+
+    def clear_overlays(self, refresh=True):
+        for name in ('samples', 'kept', 'original_fit', 'continuum'):
+            self.overlays[name].set_data([], [])
+        # Settled fits are part of the background, so removing them needs a full draw
+        settled = bool(self._settled['fits'][0] or self._settled['residuals'][0])
+        self._newest = None
+        self._settled = {'fits': ([], []), 'residuals': ([], [])}
+        self._settled_stale = False
+        for name in ('fits', 'residuals', 'new_fit', 'new_residuals'):
+            self.overlays[name].set_segments([])
+        self.fit_labels = []
+        self._update_legend()
+        if refresh:
+            self.full_redraw() if settled else self.refresh()
+
+    def _update_legend(self):
+        '''
+        A fixed handful of entries, so the legend doesn't grow with the catalog.
+        '''
+        if self.legend is not None:
+            self.legend.remove()
+            self.legend = None
+        handles = [self.overlays[name] for name in ('original_fit', 'continuum') if len(self.overlays[name].get_xdata())]
+        if self.fit_labels:
+            fits = self.overlays['new_fit']
+            n = len(self.fit_labels)
+            fits.set_label(f'{self.fit_labels[-1]}' if n == 1 else f'{n} line fits (latest: {self.fit_labels[-1]})')
+            handles.append(fits)
+        if handles:
+            self.legend = self.axes.legend(handles=handles)
+            self.legend.set_animated(True)
+
+    # ----------------------------
+    # Drawing
+    # ----------------------------
+    def _animated_artists(self):
+        artists = [artist for artist in self.overlays.values() if artist.get_animated()]
+        if self.legend is not None:
+            artists.append(self.legend)
+        return artists
+
+    def _draw_overlays(self):
+        for artist in self._animated_artists():
+            self.figure.draw_artist(artist)
+
+    def _on_draw(self, event):
+        '''
+        Any full draw (first show, zoom, pan, resize) recaptures the background and paints the overlays on top.
+        '''
+        self._background = self.copy_from_bbox(self.figure.bbox)
+        self._draw_overlays()
+
+    def draw(self):
+        '''
+        Every full draw (ours, Qt paint events, draw_idle) comes through here, so settled fits are synced first.
+        '''
+        self._sync_settled()
+        super(MplCanvas, self).draw()
+
+    def full_redraw(self):
+        t0 = time.perf_counter()
+        with profiling.stage('canvas.draw'):
+            self.draw()
+        self.frame_times.append(time.perf_counter() - t0)
+
+    def refresh(self):
+        '''
+        Repaints only the overlays over the cached background.
+        '''
+        if self._background is None:
+            self.full_redraw()
+            return
+        t0 = time.perf_counter()
+        with profiling.stage('canvas.blit'):
+            self.restore_region(self._background)
+            self._draw_overlays()
+            self.blit(self.figure.bbox)
+        self.frame_times.append(time.perf_counter() - t0)
+
+    def print_figure(self, *args, **kwargs):
+        '''
+        savefig (and the toolbar's save button) skips animated artists, so they are made
+        ordinary artists for the duration of the save.
+        '''
+        self._sync_settled()
+        artists = self._animated_artists()
+        for artist in artists:
+            artist.set_animated(False)
+        try:
+            return super(MplCanvas, self).print_figure(*args, **kwargs)
+        finally:
+            for artist in artists:
+                artist.set_animated(True)
+
+    def frame_time_stats(self):
+        '''
+        Summary of the recorded refreshes in milliseconds.
+        '''
+        if not self.frame_times:
+            return {'frames': 0, 'last_ms': 0., 'mean_ms': 0., 'max_ms': 0.}
+        times = np.array(self.frame_times) * 1e3
+        return {'frames': len(times), 'last_ms': times[-1], 'mean_ms': times.mean(), 'max_ms': times.max()}
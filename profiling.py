@@ -0,0 +1,264 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Stage-level profiling: the main stages (load, continuum, line fits, redshift, catalog writes, redraws)
+are wrapped in stage() / @profiled, which record wall time, CPU time of the running thread,
+memory allocated (optional, through tracemalloc) and the object being worked on.
+summarize() / summary_table() aggregate the events per stage, and write_trace() exports them as Chrome trace-event JSON,
+so a whole batch can be inspected on a timeline (chrome://tracing or https://ui.perfetto.dev).
+
+Profiling is off unless switched on, and then a stage costs one global lookup. To switch it on:
+- set QUASAR_PROFILE=1 (summary printed at exit) or QUASAR_PROFILE=trace.json (summary and trace),
+  with QUASAR_PROFILE_MEMORY=1 to track allocations as well, or
+- batch_reduce.py --profile trace.json [--profile-memory], or
+- profiling.enable() from code.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import tracemalloc
+# ----------------------------
+
+
+_profiler = None
+
+
+class Profiler():
+    '''
+    Collects one event per finished stage: (name, object, start, wall seconds, cpu seconds, peak bytes, pid, tid).
+    start is seconds since the epoch, so events from several processes line up on one timeline.
+    '''
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.events = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def start(self, name, object_name):
+        stack = self._stack()
+        if object_name is None and stack:
+            object_name = stack[-1][1]
+        frame = [name, object_name, time.time(), time.perf_counter(), time.thread_time(), 0, 0]
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # The parent's peak so far is folded in before resetting it for this stage
+            if stack:
+                stack[-1][6] = max(stack[-1][6], peak - stack[-1][5])
+            tracemalloc.reset_peak()
+            frame[5] = current
+        stack.append(frame)
+
+    def stop(self):
+        stack = self._stack()
+        name, object_name, start, t0, cpu0, mem0, peak_bytes = stack.pop()
+        wall = time.perf_counter() - t0
+        cpu = time.thread_time() - cpu0
+        if self.memory:
+            _, peak = tracemalloc.get_traced_memory()
+            peak_bytes = max(peak_bytes, peak - mem0)
+            if stack:
+                stack[-1][6] = max(stack[-1][6], peak - stack[-1][5])
+        with self.lock:
+            self.events.append((name, object_name, start, wall, cpu, peak_bytes, os.getpid(), threading.get_ident()))
+
+    def take_events(self):
+        '''
+        Returns the events recorded so far and forgets them (batch workers hand theirs back with each job).
+        '''
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+
+class _Stage():
+    __slots__ = ('profiler', 'name', 'object_name')
+
+    def __init__(self, profiler, name, object_name):
+        self.profiler = profiler
+        self.name = name
+        self.object_name = object_name
+
+    def __enter__(self):
+        self.profiler.start(self.name, self.object_name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.stop()
+
+
+class _NullStage():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+
+_NULL_STAGE = _NullStage()
+
+
+# ----------------------------
+# Instrumentation
+# ----------------------------
+def stage(name, object_name=None):
+    '''
+    with profiling.stage('fit_lines', object_name): ...
+    Nested stages inherit the object of the stage around them.
+    '''
+    if _profiler is None:
+        return _NULL_STAGE
+    return _Stage(_profiler, name, object_name)
+
+
+def profiled(name):
+    '''
+    Decorator version of stage() for a whole function.
+    '''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return fn(*args, **kwargs)
+            profiler.start(name, None)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.stop()
+        return wrapper
+    return decorate
+
+
+def enable(memory=False):
+    '''
+    Starts recording (a no-op if already on). Returns the Profiler.
+    '''
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(memory=memory)
+    return _profiler
+
+
+def disable():
+    '''
+    Stops recording and returns the events collected.
+    '''
+    global _profiler
+    profiler, _profiler = _profiler, None
+    if profiler is None:
+        return []
+    if profiler.memory:
+        tracemalloc.stop()
+    return profiler.take_events()
+
+
+def enabled():
+    return _profiler is not None
+
+
+def tracing_memory():
+    return _profiler is not None and _profiler.memory
+
+
+def take_events():
+    return _profiler.take_events() if _profiler is not None else []
+
+
+def add_events(events):
+    '''
+    Merges events recorded elsewhere (e.g. in a worker process) into this process's profiler.
+    '''
+    if _profiler is not None:
+        with _profiler.lock:
+            _profiler.events.extend(events)
+
+
+def events():
+    return list(_profiler.events) if _profiler is not None else []
+
+
+# ----------------------------
+# Reports
+# ----------------------------
+def summarize(events):
+    '''
+    Per stage: count, objects, total / mean wall ms, total CPU ms and the largest peak allocation.
+    Returns a list of dicts sorted by total wall time.
+    '''
+    stages = {}
+    for name, object_name, _, wall, cpu, peak_bytes, _, _ in events:
+        s = stages.setdefault(name, {'stage': name, 'count': 0, 'objects': set(), 'wall_ms': 0., 'cpu_ms': 0., 'max_peak_mb': 0.})
+        s['count'] += 1
+        if object_name is not None:
+            s['objects'].add(object_name)
+        s['wall_ms'] += wall * 1e3
+        s['cpu_ms'] += cpu * 1e3
+        s['max_peak_mb'] = max(s['max_peak_mb'], peak_bytes / 1024 ** 2)
+    rows = sorted(stages.values(), key=lambda s: -s['wall_ms'])
+    for s in rows:
+        s['objects'] = len(s['objects'])
+        s['mean_ms'] = s['wall_ms'] / s['count']
+    return rows
+
+
+def summary_table(events):
+    from prettytable import PrettyTable
+    table = PrettyTable()
+    table.field_names = ['Stage', 'Calls', 'Objects', 'Wall (ms)', 'Mean (ms)', 'CPU (ms)', 'Peak alloc (MB)']
+    for s in summarize(events):
+        table.add_row([s['stage'], s['count'], s['objects'], f"{s['wall_ms']:.1f}", f"{s['mean_ms']:.2f}",
+                       f"{s['cpu_ms']:.1f}", f"{s['max_peak_mb']:.1f}"])
+    table.align['Stage'] = 'l'
+    return table
+
+
+def write_trace(path, events):
+    '''
+    Chrome trace-event JSON: one complete ('X') event per stage, one row per process and thread.
+    '''
+    origin = min((start for _, _, start, *_ in events), default=0.)
+    trace = []
+    for name, object_name, start, wall, cpu, peak_bytes, pid, tid in events:
+        args = {'cpu_ms': round(cpu * 1e3, 3)}
+        if object_name is not None:
+            args['object'] = object_name
+        if peak_bytes:
+            args['peak_kb'] = round(peak_bytes / 1024, 1)
+        trace.append({'name': name, 'cat': 'stage', 'ph': 'X', 'ts': (start - origin) * 1e6, 'dur': wall * 1e6,
+                      'pid': pid, 'tid': tid, 'args': args})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def _report_at_exit(trace_path):
+    collected = disable()
+    if not collected:
+        return
+    print(summary_table(collected))
+    if trace_path:
+        write_trace(trace_path, collected)
+        print(f"Profile trace -> {trace_path}")
+
+
+_setting = os.environ.get('QUASAR_PROFILE', '')
+if _setting and _setting != '0':
+    enable(memory=os.environ.get('QUASAR_PROFILE_MEMORY', '') not in ('', '0'))
+    atexit.register(_report_at_exit, _setting if _setting.endswith('.json') else None)
@@ -0,0 +1,124 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Background tasks for the GUI.
+Continuum and line fits used to run right on the Qt event loop, so a slow fit froze the window.
+A TaskRunner hands them to a QThreadPool instead and posts the results back to the main thread
+through signals, where the plotting happens. Anything still queued can be cancelled outright;
+a task that is already running (NumPy/SciPy can't be interrupted half way) finishes, but its result is dropped.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import threading
+import traceback
+
+from PyQt5 import QtCore
+# ----------------------------
+
+
+class TaskSignals(QtCore.QObject):
+    '''
+    QRunnables can't emit signals themselves, so each task carries one of these.
+    '''
+    finished = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+    done = QtCore.pyqtSignal()
+
+
+class Task(QtCore.QRunnable):
+    '''
+    Runs fn(*args, **kwargs) on a pool thread.
+    '''
+
+    def __init__(self, fn, *args, label='', **kwargs):
+        super(Task, self).__init__()
+        self.setAutoDelete(False)
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.label = label
+        self.signals = TaskSignals()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        try:
+            if not self.cancelled:
+                result = self.fn(*self.args, **self.kwargs)
+                if not self.cancelled:
+                    self.signals.finished.emit(result)
+        except Exception:
+            if not self.cancelled:
+                self.signals.failed.emit(traceback.format_exc())
+        finally:
+            self.signals.done.emit()
+
+
+class TaskRunner(QtCore.QObject):
+    '''
+    Owns the thread pool and keeps track of what's outstanding.
+    pending_changed(n, label) fires whenever a task is queued or finishes, for progress indicators.
+    '''
+    pending_changed = QtCore.pyqtSignal(int, str)
+
+    def __init__(self, parent=None, max_threads=None):
+        super(TaskRunner, self).__init__(parent)
+        self.pool = QtCore.QThreadPool(self)
+        if max_threads is not None:
+            self.pool.setMaxThreadCount(max_threads)
+        self.tasks = []
+
+    @property
+    def pending(self):
+        return len(self.tasks)
+
+    def submit(self, fn, *args, on_result=None, on_error=None, label='', **kwargs):
+        '''
+        Queues fn(*args, **kwargs). on_result(result) / on_error(traceback_string) are called on the GUI thread.
+        Returns the Task, which can be cancelled on its own.
+        '''
+        task = Task(fn, *args, label=label, **kwargs)
+        # The signals are queued, so a result emitted just before cancel() can still arrive afterwards:
+        # check again on delivery, so nothing from a cancelled task ever reaches the callbacks
+        if on_result is not None:
+            task.signals.finished.connect(lambda result: None if task.cancelled else on_result(result))
+        on_error = on_error if on_error is not None else print
+        task.signals.failed.connect(lambda error: None if task.cancelled else on_error(error))
+        task.signals.done.connect(lambda: self._forget(task))
+        self.tasks.append(task)
+        self.pool.start(task)
+        self._announce()
+        return task
+
+    def cancel_all(self):
+        '''
+        Drops every outstanding task. Queued ones never start; running ones have their results ignored,
+        including results that were already emitted but not yet delivered.
+        '''
+        for task in list(self.tasks):
+            task.cancel()
+            if self.pool.tryTake(task):
+                self._forget(task)
+        self._announce()
+
+    def wait(self, msecs=-1):
+        return self.pool.waitForDone(msecs)
+
+    def _forget(self, task):
+        if task in self.tasks:
+            self.tasks.remove(task)
+            self._announce()
+
+    def _announce(self):
+        label = self.tasks[0].label if self.tasks else ''
+        self.pending_changed.emit(len(self.tasks), label)
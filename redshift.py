@@ -0,0 +1,275 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Automatic redshift and emission line finding.
+A template of the strong quasar emission lines is built on a log-wavelength grid, where a redshift
+is just a shift: ln(lambda_obs) = ln(lambda_rest) + ln(1 + z). The continuum-subtracted spectrum is
+put on the same log grid and cross-correlated with the template by FFT, so every trial redshift is
+tested at once in O(N log N). The highest correlation peak gives z, and every line expected at that
+redshift becomes a fit window for spectral_core.fit_spectral_lines, with no clicking needed.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+
+import spectral_core
+import profiling
+# ----------------------------
+
+
+# Rest (vacuum) wavelengths in Angstroms and rough relative strengths in a quasar composite
+# (after Vanden Berk et al. 2001).
+QUASAR_LINES = {
+    'Lya': (1215.67, 100.),
+    'N V': (1240.14, 2.5),
+    'Si IV': (1399.8, 8.),
+    'C IV': (1549.06, 25.),
+    'He II': (1640.42, 0.5),
+    'C III]': (1908.73, 16.),
+    'Mg II': (2798.75, 14.),
+    '[O II]': (3728.48, 0.4),
+    'Hd': (4102.89, 0.9),
+    'Hg': (4341.68, 2.6),
+    'Hb': (4862.68, 8.6),
+    '[O III] 4959': (4960.30, 1.3),
+    '[O III] 5007': (5008.24, 3.9),
+    'Ha': (6564.61, 31.),
+}
+
+C_KMS = 299792.458
+# How far (in km/s) a fit's centre may sit from where its line is expected before it counts as some other feature
+MAX_SHIFT_KMS = 3000.
+# Below this best / second best peak ratio the redshift is a coin toss, and no lines are fit at it
+MIN_PEAK_RATIO = 1.2
+
+
+class RedshiftResult():
+    '''
+    - z: best redshift
+    - significance: peak height in units of the cross-correlation's robust scatter
+    - peak_ratio: best peak / best peak at a clearly different redshift (>1, bigger is less ambiguous)
+    - confidence: how far the best peak stands above that second one, in the same units, i.e.
+      significance * (1 - 1 / peak_ratio). A strong peak with an equally strong rival scores about 0.
+    - alternative_z: where that second peak is
+    - z_grid, ccf: the whole cross-correlation, for plotting
+    - problem: why auto_fit_lines didn't trust this redshift ('' if it did)
+    '''
+
+    def __init__(self, z, significance, peak_ratio, alternative_z, z_grid, ccf):
+        self.z = z
+        self.significance = significance
+        self.peak_ratio = peak_ratio
+        self.confidence = significance * (1 - 1 / peak_ratio) if peak_ratio > 0 else 0.
+        self.alternative_z = alternative_z
+        self.z_grid = z_grid
+        self.ccf = ccf
+        self.problem = ''
+
+    def __repr__(self):
+        return f'RedshiftResult(z={self.z:.4f}, confidence={self.confidence:.1f}, peak_ratio={self.peak_ratio:.2f})'
+
+    def describe(self):
+        '''
+        One line for logs and summaries.
+        '''
+        alternative = f', next best z = {self.alternative_z:.4f}' if np.isfinite(self.alternative_z) else ''
+        return f'z = {self.z:.4f} (confidence {self.confidence:.1f}, peak ratio {self.peak_ratio:.2f}{alternative})'
+
+
+# ----------------------------
+# Log-wavelength grid and template
+# ----------------------------
+def log_grid(wavelengths):
+    '''
+    Uniform ln(lambda) grid over the spectrum, with the step set by the finest pixel (in ln lambda).
+    Returns (ln_start, d_ln, n).
+    '''
+    w = np.asarray(wavelengths, dtype=np.float64)
+    d_ln = np.min(np.diff(np.log(w)))
+    ln_start = np.log(w[0])
+    n = int(np.floor((np.log(w[-1]) - ln_start) / d_ln)) + 1
+    return ln_start, d_ln, n
+
+
+def line_template(ln_start, d_ln, n, lines=None, fwhm_kms=3000.):
+    '''
+    Sum of Gaussians (in ln lambda) of width fwhm_kms at each line's rest wavelength, weighted by strength.
+    '''
+    lines = QUASAR_LINES if lines is None else lines
+    rest = np.log(np.array([w for w, _ in lines.values()]))
+    strength = np.array([s for _, s in lines.values()])
+    sigma = fwhm_kms / C_KMS / (2 * np.sqrt(2 * np.log(2)))
+    ln_w = ln_start + d_ln * np.arange(n)
+    return (strength[:, None] * np.exp(-0.5 * ((ln_w[None, :] - rest[:, None]) / sigma) ** 2)).sum(axis=0)
+
+
+def prepare_spectrum(wavelengths, fluxes, continuum):
+    '''
+    Continuum-normalised line signal (f - c) / c on the native grid, with bad pixels
+    (zero flux, non-positive continuum, non-finite values) set to 0 so they don't correlate.
+    '''
+    fluxes = np.asarray(fluxes, dtype=np.float64)
+    continuum = np.asarray(continuum, dtype=np.float64)
+    good = (fluxes != 0) & (continuum > 0) & np.isfinite(fluxes) & np.isfinite(continuum)
+    signal_ = np.zeros_like(fluxes)
+    signal_[good] = fluxes[good] / continuum[good] - 1
+    # Absorption and sky residuals shouldn't drive the match, and neither should single crazy pixels
+    return np.clip(signal_, 0, 10)
+
+
+# ----------------------------
+# Cross-correlation
+# ----------------------------
+@profiling.profiled('find_redshift')
+def find_redshift(wavelengths, fluxes, continuum, z_min=0., z_max=5., lines=None, fwhm_kms=3000.,
+                  min_separation_kms=10000.):
+    '''
+    FFT cross-correlation of the continuum-subtracted spectrum against the line template.
+    Returns a RedshiftResult.
+    '''
+    w = np.asarray(wavelengths, dtype=np.float64)
+    ln_start, d_ln, n = log_grid(w)
+    ln_w = ln_start + d_ln * np.arange(n)
+    data = np.interp(ln_w, np.log(w), prepare_spectrum(w, fluxes, continuum))
+    data -= data.mean()
+
+    # The template has to cover every rest wavelength the spectrum can see over the z range
+    t_start = ln_start - np.log1p(z_max)
+    t_n = int(np.ceil((ln_w[-1] - np.log1p(z_min) - t_start) / d_ln)) + 1
+    template = line_template(t_start, d_ln, t_n, lines, fwhm_kms)
+    template -= template.mean()
+
+    # At lag L data[i] lines up with template[i - L], i.e. ln(1 + z) = ln_start - t_start + L * d_ln
+    from scipy import signal  # imported on first use, as in resample.convolve
+    ccf = signal.correlate(data, template, mode='full', method='fft')
+    lags = signal.correlation_lags(len(data), len(template), mode='full')
+    z_grid = np.expm1(ln_start - t_start + lags * d_ln)
+    keep = (z_grid >= z_min) & (z_grid <= z_max)
+    z_grid, ccf = z_grid[keep], ccf[keep]
+    order = np.argsort(z_grid)
+    z_grid, ccf = z_grid[order], ccf[order]
+
+    best = int(np.argmax(ccf))
+    z = z_grid[best]
+    # Parabolic refinement of the peak
+    if 0 < best < len(ccf) - 1:
+        y0, y1, y2 = ccf[best - 1], ccf[best], ccf[best + 1]
+        denom = y0 - 2 * y1 + y2
+        if denom < 0:
+            frac = 0.5 * (y0 - y2) / denom
+            z = z_grid[best] + frac * (z_grid[best + 1] - z_grid[best - 1]) / 2
+
+    med = np.median(ccf)
+    scatter = 1.4826 * np.median(np.abs(ccf - med))
+    significance = (ccf[best] - med) / scatter if scatter > 0 else np.inf
+
+    # Second best peak at a clearly different redshift
+    far = np.abs(np.log1p(z_grid) - np.log1p(z_grid[best])) > min_separation_kms / C_KMS
+    if np.any(far):
+        alt = np.argmax(np.where(far, ccf, -np.inf))
+        alternative_z = z_grid[alt]
+        peak_ratio = (ccf[best] - med) / (ccf[alt] - med) if ccf[alt] > med else np.inf
+    else:
+        alternative_z, peak_ratio = np.nan, np.inf
+    return RedshiftResult(float(z), float(significance), float(peak_ratio), float(alternative_z), z_grid, ccf)
+
+
+# ----------------------------
+# Expected lines
+# ----------------------------
+def expected_lines(z, wavelengths, lines=None, margin=20.):
+    '''
+    Lines that land inside the spectrum (at least margin Angstroms from either end) at redshift z.
+    Returns a list of (name, rest_wavelength, observed_wavelength).
+    '''
+    lines = QUASAR_LINES if lines is None else lines
+    lo, hi = wavelengths[0] + margin, wavelengths[-1] - margin
+    found = []
+    for name, (rest, _) in lines.items():
+        observed = rest * (1 + z)
+        if lo <= observed <= hi:
+            found.append((name, rest, observed))
+    return found
+
+
+def check_line_fits(expected, lines, max_shift_kms=MAX_SHIFT_KMS):
+    '''
+    Which of the fits to the expected lines (name, rest_wavelength, observed_wavelength) really are those lines.
+    The peak search and window of a weak line can walk onto a strong neighbour (N V onto Lya), giving the same fit
+    twice under two names, so a fit is rejected if it didn't converge, if its centre is more than max_shift_kms from
+    where its line is expected, if its centre is closer to another expected line, or if it found the same peak as
+    another line that fits it better.
+    Returns (keep, reasons): a bool per line, and why each rejected one was rejected ('' for kept lines).
+    '''
+    observed = np.array([obs for _, _, obs in expected])
+    keep = np.array([line is not None for line in lines])
+    reasons = ['' if ok else 'fit did not converge' for ok in keep]
+    centre = np.array([line.params[1] if line is not None else np.nan for line in lines])
+    offset = np.abs(centre[:, None] - observed[None, :])
+    for i, (name, _, obs) in enumerate(expected):
+        if not keep[i]:
+            continue
+        shift = offset[i, i] / obs * C_KMS
+        nearest = int(np.argmin(offset[i]))
+        if shift > max_shift_kms:
+            keep[i], reasons[i] = False, f'fit centre {centre[i]:.1f} is {shift:.0f} km/s from the expected {obs:.1f}'
+        elif nearest != i:
+            keep[i], reasons[i] = False, f'fit centre {centre[i]:.1f} is on {expected[nearest][0]}'
+    # Two lines that peaked on the same pixel: only the one whose centre is closer keeps it
+    for i in np.flatnonzero(keep):
+        for j in np.flatnonzero(keep):
+            if j != i and lines[j].line_wav == lines[i].line_wav and offset[j, j] < offset[i, i]:
+                keep[i], reasons[i] = False, f'fit found the same peak as {expected[j][0]}'
+                break
+    return keep, reasons
+
+
+@profiling.profiled('auto_fit_lines')
+def auto_fit_lines(wavelengths, fluxes, continuum, z=None, cache=None, realisations=0, noise=None,
+                   max_shift_kms=MAX_SHIFT_KMS, min_peak_ratio=MIN_PEAK_RATIO, **kwargs):
+    '''
+    Finds the redshift (unless z is given) and fits every expected line in one batched call
+    (through cache, a fit_cache.ResultCache, if given), with Monte Carlo errors if realisations > 0.
+    noise is the spectrum's noise map (spectral_core.estimate_noise), worked out here unless given.
+    Fits that aren't really their line are dropped (see check_line_fits).
+    A redshift found here is not trusted, and no lines are kept, if its peak_ratio is below min_peak_ratio
+    (nothing is fit at all then) or if the strongest line expected at it was dropped: a quasar at the right z always
+    shows that one. The redshift result's problem says which.
+    Each kept SpectralLine gets name, rest_wav and redshift filled in.
+    Returns (redshift_result_or_None, lines, windows, failed) where lines only holds the kept fits,
+    windows[i] is the (xdata, continuum subtracted fluxes) that lines[i] was fitted to,
+    and failed lists (name, observed_wavelength, reason) for every expected line that was dropped.
+    '''
+    result = None
+    if z is None:
+        result = find_redshift(wavelengths, fluxes, continuum, **kwargs)
+        z = result.z
+        if result.peak_ratio < min_peak_ratio:
+            result.problem = f'ambiguous redshift, the peak at z = {result.alternative_z:.4f} is almost as high'
+            return result, [], [], []
+    expected = expected_lines(z, wavelengths)
+    if not expected:
+        return result, [], [], []
+
+    fitted, fit_windows, _ = spectral_core.fit_spectral_lines(wavelengths, fluxes, continuum, [obs for _, _, obs in expected],
+                                                              noise=noise, realisations=realisations, cache=cache)
+    keep, reasons = check_line_fits(expected, fitted, max_shift_kms)
+    if result is not None:
+        strongest = int(np.argmax([QUASAR_LINES[name][1] if name in QUASAR_LINES else 0. for name, _, _ in expected]))
+        if not keep[strongest]:
+            result.problem = f'wrong redshift? {expected[strongest][0]}, the strongest line expected, failed'
+            reasons = [reason or 'redshift rejected' for reason in reasons]
+            keep[:] = False
+    lines, windows, failed = [], [], []
+    for (name, rest, observed), line, window, ok, reason in zip(expected, fitted, fit_windows, keep, reasons):
+        if ok:
+            line.name, line.rest_wav, line.redshift = name, rest, z
+            lines.append(line)
+            windows.append(window)
+        else:
+            failed.append((name, observed, reason))
+    return result, lines, windows, failed
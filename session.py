@@ -0,0 +1,422 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Session snapshots: every object's spectrum (as loaded and as last seen), its continuum fit and the line catalog,
+in one binary file, so work can be picked up again without reparsing or refitting anything, in the GUI or
+in batch_reduce.
+
+A session is a plain .npz (np.load opens it too) laid out by column rather than by object:
+
+    objects.npy             one OBJECT_DTYPE row per object: name, source file, grids, continuum scalars, history
+    <field>.npy             every object's <field> one after the other, for each of RAGGED_FIELDS
+    <field>_offsets.npy     where each object's slice of <field> starts and ends (n_objects + 1 values)
+    lines.npy               the line catalog rows (line_catalog.LINE_DTYPE)
+
+The RAGGED_FIELDS members are stored uncompressed and 64 byte aligned inside the zip, so opening a session
+memory maps them in place (np.load reads every .npz member into memory instead), and an object's arrays are
+views into those maps. Opening a thousand objects is a dozen maps and two small tables, however big the spectra.
+Noisy float fluxes barely compress anyway; the tables, which are mostly string padding, are deflated.
+
+Sessions are written by streaming every object to temporary files (SessionWriter), so a batch run never holds
+more than one object's arrays, and the finished file replaces any old one in a single rename.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import shutil
+import struct
+import tempfile
+import zipfile
+
+import numpy as np
+
+import continuum as continuum_module
+import history as history_module
+import line_catalog
+import spectrum
+# ----------------------------
+
+
+SESSION_VERSION = 1
+SESSION_DIR = './Sessions/'
+SESSION_SUFFIX = '.npz'
+# Where the GUI saves the session when its window is closed
+LAST_SESSION_NAME = 'Last Session.npz'
+
+OBJECT_DTYPE = np.dtype([
+    ('name', 'U64'),
+    ('filename', 'U512'),
+    # The transforms between the original and current data (history.Step reprs), '' if none
+    ('steps', 'U1024'),
+    # Uniform grids as (start, step, n); start is NaN when the wavelengths are stored explicitly
+    ('original_start', 'f8'), ('original_step', 'f8'), ('original_n', 'i8'),
+    ('start', 'f8'), ('step', 'f8'), ('n', 'i8'),
+    ('has_continuum', '?'), ('n_iter', 'i4'), ('converged', '?'),
+    ('basis', 'U16'), ('domain_lo', 'f8'), ('domain_hi', 'f8'),
+])
+
+# Per-object arrays of any length, stored back to back
+RAGGED_FIELDS = {
+    'original_wavelengths': np.float64,
+    'original_fluxes': np.float64,
+    'wavelengths': np.float64,
+    'fluxes': np.float64,
+    'continuum': np.float64,
+    'sample_wavelengths': np.float64,
+    'sample_fluxes': np.float64,
+    'original_yfit': np.float64,
+    'sample_mask': np.bool_,
+    'coefficients': np.float64,
+    'knots': np.float64,
+}
+
+ALIGN = 64
+# Zip extra field id for the padding that aligns the uncompressed members
+PADDING_ID = 0x6e70
+
+
+# ----------------------------
+# One object
+# ----------------------------
+class SessionObject():
+    '''
+    One object of a session:
+    - name, filename: the object, and the file it was loaded from
+    - original_wavelengths, original_fluxes: the data as loaded
+    - wavelengths, fluxes: the data as last seen (the original arrays themselves if nothing was done to them)
+    - steps: how the current data was made from the original, e.g. "smooth(kernel='gaussian', ...)" ('' for nothing)
+    - continuum: the continuum.ContinuumFit on the current data, or None
+    - lines: the object's line catalog rows (line_catalog.LINE_DTYPE)
+    Wavelengths are spectrum.UniformGrids wherever the grid is uniform.
+    '''
+
+    __slots__ = ('name', 'filename', 'original_wavelengths', 'original_fluxes', 'wavelengths', 'fluxes', 'steps',
+                 'continuum', 'lines')
+
+    def __init__(self, name, wavelengths, fluxes, filename='', continuum=None, original_wavelengths=None,
+                 original_fluxes=None, steps='', lines=None):
+        self.name = name
+        self.filename = filename
+        self.wavelengths = wavelengths
+        self.fluxes = fluxes
+        self.original_wavelengths = wavelengths if original_wavelengths is None else original_wavelengths
+        self.original_fluxes = fluxes if original_fluxes is None else original_fluxes
+        self.steps = steps
+        self.continuum = continuum
+        self.lines = np.zeros(0, dtype=line_catalog.LINE_DTYPE) if lines is None else lines
+
+    def __repr__(self):
+        continuum = 'continuum' if self.continuum is not None else 'no continuum'
+        steps = f', {self.steps}' if self.steps else ''
+        return f'SessionObject({self.name!r}, {len(self.fluxes)} pixels, {continuum}, {len(self.lines)} lines{steps})'
+
+    @classmethod
+    def from_spectrum(cls, spec, filename='', continuum=None):
+        '''
+        From a spectrum.Spectrum (e.g. spectral_core.load_spectrum), with nothing done to it yet.
+        '''
+        return cls(spec.name, spec.wavelengths, spec.fluxes, filename=filename, continuum=continuum)
+
+    @classmethod
+    def from_history(cls, name, history, filename='', lines=None):
+        '''
+        From a history.SpectrumHistory: its original and current steps. The steps in between aren't kept.
+        '''
+        current, original = history.current, history.original
+        steps = ' -> '.join(repr(step) for step in history.steps[1:history.position + 1])
+        return cls(name, current.wavelengths, current.fluxes, filename=filename, continuum=current.continuum,
+                   original_wavelengths=original.wavelengths, original_fluxes=original.fluxes, steps=steps, lines=lines)
+
+    def to_history(self, depth=history_module.DEFAULT_DEPTH):
+        '''
+        A history.SpectrumHistory to carry on from: the original, plus the current data as one step if it differs.
+        The continuum goes on the current step.
+        '''
+        history = history_module.SpectrumHistory(self.original_wavelengths, self.original_fluxes, depth=depth)
+        if self.steps:
+            history.push(self.steps, self.wavelengths, self.fluxes)
+        history.current.continuum = self.continuum
+        return history
+
+
+# ----------------------------
+# Writing
+# ----------------------------
+def _grid_fields(wavelengths):
+    '''
+    (start, step, n) of a uniform grid, or (NaN, NaN, n) plus the array to store for anything else.
+    '''
+    grid = spectrum.detect_uniform_grid(wavelengths)
+    if grid is not None:
+        return (grid.start, grid.step, grid.n), np.zeros(0)
+    return (np.nan, np.nan, len(wavelengths)), np.asarray(wavelengths, dtype=np.float64)
+
+
+def _open_member(zf, name, compress):
+    '''
+    Opens name.npy for writing. Uncompressed members get an extra field in their zip header, sized so their
+    data (after the .npy header, itself padded to 64 bytes) starts on a 64 byte boundary of the file.
+    '''
+    info = zipfile.ZipInfo(name + '.npy')
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    if not compress:
+        # Fixed header fields, the name, the padding field's own 4 byte header, and the zip64 sizes force_zip64 adds
+        header = 30 + len(info.filename.encode()) + 4 + 20
+        padding = -(zf.fp.tell() + header) % ALIGN
+        info.extra = struct.pack('<HH', PADDING_ID, padding) + bytes(padding)
+    return zf.open(info, 'w', force_zip64=True)
+
+
+def _write_member(zf, name, dtype, n, source, compress=False):
+    '''
+    Writes n values of dtype as name.npy, copying the raw values from the file object source (or an array).
+    '''
+    with _open_member(zf, name, compress) as f:
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                 'fortran_order': False, 'shape': (n,)})
+        if isinstance(source, np.ndarray):
+            f.write(np.ascontiguousarray(source, dtype=dtype).tobytes())
+        else:
+            source.seek(0)
+            shutil.copyfileobj(source, f, 1 << 20)
+
+
+class SessionWriter():
+    '''
+    Streams objects (and line catalog rows) into a session file. Each add() goes straight to temporary files next
+    to path, and close() packs them into the .npz, replacing path in one rename. Leaving a with block on an
+    exception discards everything, so a failed run never clobbers an older session.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(self.directory, exist_ok=True)
+        self._spools = {field: tempfile.TemporaryFile(dir=self.directory) for field in RAGGED_FIELDS}
+        self._offsets = {field: [0] for field in RAGGED_FIELDS}
+        self._lines = tempfile.TemporaryFile(dir=self.directory)
+        self.n_lines = 0
+        self._objects = []
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def _append(self, field, values):
+        values = np.ascontiguousarray(values, dtype=RAGGED_FIELDS[field])
+        self._spools[field].write(values.tobytes())
+        self._offsets[field].append(self._offsets[field][-1] + len(values))
+
+    def add(self, obj):
+        '''
+        Adds a SessionObject and its lines.
+        '''
+        original_grid, original_wavelengths = _grid_fields(obj.original_wavelengths)
+        if obj.steps:
+            grid, wavelengths = _grid_fields(obj.wavelengths)
+            fluxes = obj.fluxes
+        else:
+            # Nothing done to the data, so the current arrays are the original ones
+            grid, wavelengths, fluxes = original_grid, np.zeros(0), np.zeros(0)
+
+        fit = obj.continuum
+        model = fit.model if fit is not None else None
+        self._objects.append((obj.name, obj.filename, obj.steps) + original_grid + grid +
+                             (fit is not None, fit.n_iter if fit is not None else 0,
+                              bool(fit.converged) if fit is not None else False,
+                              model.basis if model is not None else '',
+                              model.domain[0] if model is not None else np.nan,
+                              model.domain[1] if model is not None else np.nan))
+
+        empty = np.zeros(0)
+        self._append('original_wavelengths', original_wavelengths)
+        self._append('original_fluxes', obj.original_fluxes)
+        self._append('wavelengths', wavelengths)
+        self._append('fluxes', fluxes)
+        self._append('continuum', fit.continuum if fit is not None else empty)
+        self._append('sample_wavelengths', fit.sample_wavelengths if fit is not None else empty)
+        self._append('sample_fluxes', fit.sample_fluxes if fit is not None else empty)
+        self._append('original_yfit', fit.original_yfit if fit is not None else empty)
+        self._append('sample_mask', fit.mask if fit is not None and fit.mask is not None else np.zeros(0, dtype=bool))
+        self._append('coefficients', model.coefficients if model is not None else empty)
+        self._append('knots', model.knots if model is not None and model.knots is not None else empty)
+        self.add_lines(obj.lines)
+
+    def add_lines(self, rows):
+        '''
+        Adds line catalog rows (LINE_DTYPE records) of their own, e.g. for objects that aren't in the session.
+        '''
+        if not len(rows):
+            return
+        rows = np.asarray(rows, dtype=line_catalog.LINE_DTYPE)
+        self._lines.write(rows.tobytes())
+        self.n_lines += len(rows)
+
+    def close(self):
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp, 'wb') as f, zipfile.ZipFile(f, 'w') as zf:
+                _write_member(zf, 'version', np.int64, 1, np.array([SESSION_VERSION]), compress=True)
+                _write_member(zf, 'objects', OBJECT_DTYPE, len(self._objects),
+                              np.array(self._objects, dtype=OBJECT_DTYPE), compress=True)
+                _write_member(zf, 'lines', line_catalog.LINE_DTYPE, self.n_lines, self._lines, compress=True)
+                for field, dtype in RAGGED_FIELDS.items():
+                    offsets = np.array(self._offsets[field], dtype=np.int64)
+                    _write_member(zf, field, dtype, int(offsets[-1]), self._spools[field])
+                    _write_member(zf, f'{field}_offsets', np.int64, len(offsets), offsets, compress=True)
+            os.replace(tmp, self.path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            self.discard()
+
+    def discard(self):
+        for f in list(self._spools.values()) + [self._lines]:
+            f.close()
+
+
+def save_session(path, objects, rows=()):
+    '''
+    Writes SessionObjects (with their lines) and any other line catalog rows to path in one go. Returns path.
+    '''
+    with SessionWriter(path) as writer:
+        for obj in objects:
+            writer.add(obj)
+        writer.add_lines(rows)
+    return path
+
+
+# ----------------------------
+# Reading
+# ----------------------------
+def _read_member(path, zf, info, mmap=True):
+    '''
+    A .npy member as an array: memory mapped in place if it's stored uncompressed, otherwise read in.
+    '''
+    if info.compress_type != zipfile.ZIP_STORED or not mmap:
+        with zf.open(info) as f:
+            return np.lib.format.read_array(f)
+    with open(path, 'rb') as f:
+        # The local header's name and extra field lengths can differ from the central directory's
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', f.read(4))
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+class Session():
+    '''
+    An opened session file.
+    - objects: the OBJECT_DTYPE table, names: the object names
+    - lines: every line catalog row (LINE_DTYPE), including any of objects that aren't in the session
+    session[i] (or session.object(i)) builds the i'th SessionObject, with arrays that are views into the maps.
+    '''
+
+    def __init__(self, path, mmap=True):
+        self.path = path
+        with zipfile.ZipFile(path) as zf:
+            members = {info.filename[:-len('.npy')]: info for info in zf.infolist()}
+            version = int(_read_member(path, zf, members['version'])[0]) if 'version' in members else None
+            if version != SESSION_VERSION:
+                raise ValueError(f'{path} is not a version {SESSION_VERSION} session file')
+            self.objects = _read_member(path, zf, members['objects'])
+            self.lines = _read_member(path, zf, members['lines'])
+            self._fields = {field: _read_member(path, zf, members[field], mmap) for field in RAGGED_FIELDS}
+            self._offsets = {field: _read_member(path, zf, members[f'{field}_offsets']) for field in RAGGED_FIELDS}
+        # The lines sorted by object, so each object's lines are a binary search away
+        self._line_order = np.argsort(self.lines['object'], kind='stable')
+        self._line_objects = self.lines['object'][self._line_order]
+
+    def __len__(self):
+        return len(self.objects)
+
+    def __repr__(self):
+        return f'Session({self.path!r}, {len(self)} objects, {len(self.lines)} lines)'
+
+    def __getitem__(self, i):
+        return self.object(i)
+
+    def __iter__(self):
+        return (self.object(i) for i in range(len(self)))
+
+    @property
+    def names(self):
+        return self.objects['name']
+
+    def index(self, name):
+        matches = np.flatnonzero(self.objects['name'] == name)
+        if not len(matches):
+            raise KeyError(name)
+        return int(matches[0])
+
+    def lines_of(self, name):
+        lo, hi = np.searchsorted(self._line_objects, name, 'left'), np.searchsorted(self._line_objects, name, 'right')
+        return self.lines[self._line_order[lo:hi]]
+
+    def _field(self, field, i):
+        offsets = self._offsets[field]
+        return self._fields[field][offsets[i]:offsets[i + 1]]
+
+    def _wavelengths(self, field, start, step, n, i):
+        return spectrum.UniformGrid(start, step, n) if np.isfinite(start) else self._field(field, i)
+
+    def object(self, i):
+        row = self.objects[i]
+        original_wavelengths = self._wavelengths('original_wavelengths', row['original_start'], row['original_step'],
+                                                 row['original_n'], i)
+        original_fluxes = self._field('original_fluxes', i)
+        steps = str(row['steps'])
+        if steps:
+            wavelengths = self._wavelengths('wavelengths', row['start'], row['step'], row['n'], i)
+            fluxes = self._field('fluxes', i)
+        else:
+            wavelengths, fluxes = original_wavelengths, original_fluxes
+
+        fit = None
+        if row['has_continuum']:
+            model = None
+            if row['basis']:
+                knots = self._field('knots', i)
+                model = continuum_module.ContinuumModel(str(row['basis']), self._field('coefficients', i),
+                                                        (row['domain_lo'], row['domain_hi']),
+                                                        knots if len(knots) else None)
+            sample_wavelengths, sample_fluxes = self._field('sample_wavelengths', i), self._field('sample_fluxes', i)
+            mask = self._field('sample_mask', i)
+            kept = mask if len(mask) else slice(None)
+            fit = continuum_module.ContinuumFit(sample_wavelengths, sample_fluxes, self._field('original_yfit', i),
+                                                sample_wavelengths[kept], sample_fluxes[kept],
+                                                self._field('continuum', i), model=model,
+                                                mask=mask if len(mask) else None, n_iter=int(row['n_iter']),
+                                                converged=bool(row['converged']))
+        return SessionObject(str(row['name']), wavelengths, fluxes, filename=str(row['filename']), continuum=fit,
+                             original_wavelengths=original_wavelengths, original_fluxes=original_fluxes, steps=steps,
+                             lines=self.lines_of(str(row['name'])))
+
+
+def load_session(path, mmap=True):
+    '''
+    Opens a session file (see Session). With mmap=False every array is read into memory instead.
+    '''
+    return Session(path, mmap=mmap)
+
+
+def is_session(path):
+    return path.endswith(SESSION_SUFFIX) and os.path.isfile(path)
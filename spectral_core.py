@@ -0,0 +1,390 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+GUI-free core of the spectral analysis.
+Everything in here used to live inside the MainWindow methods of interactive_plot.py.
+It is pulled out so the same steps (load -> continuum -> line fits -> catalog) can be run
+from the GUI, from scripts, or from the batch reducer without ever starting Qt.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import numpy as np
+
+import spectrum_io
+import spectrum
+import gaussian_fit
+import line_measure
+import continuum
+import noise as noise_module
+import line_errors
+import line_catalog as line_catalog_module
+import profiling
+from continuum import ContinuumFit  # lived here before continuum.py, so keep it importable from here
+# ----------------------------
+
+
+CATALOG_FIELDS = ["Wavelength (Angstroms)", "Equivalent Width", "Peak Flux", "Total Flux"]
+
+
+# ----------------------------
+# For any equations used throughout
+# ----------------------------
+class Eq():
+
+    def gaussian(x, amplitude, mean, stddev):
+        return amplitude * np.exp(-((x - mean) / stddev) ** 2 / 2)
+
+
+# ----------------------------
+# Result containers
+# ----------------------------
+class SpectralLine():
+    '''
+    For each line, should store:
+    - Wavelength
+    - Maximum flux
+    - Equivalent width
+    - Total flux
+    and, when the fit covariance is known, 1 sigma errors on the equivalent width, total flux, and the Gaussian's
+    centre and width. Those come from the covariance, or from n_realisations Monte Carlo refits when that isn't 0
+    (see line_errors.py).
+    Lines found automatically (see redshift.py) also know their name, rest wavelength and redshift.
+    The fit is kept as its Gaussian parameters (amplitude, mean, stddev) rather than a sampled curve;
+    profile(x) evaluates it anywhere.
+    '''
+    __slots__ = ('line_wav', 'params', 'equivalent_width', 'max_flux', 'total_flux', 'equivalent_width_err',
+                 'total_flux_err', 'name', 'rest_wav', 'redshift', 'center_err', 'sigma_err', 'n_realisations')
+
+    def __init__(self, wavelength, params, eq_wid, max_flux, total_flux, eq_wid_err=None, total_flux_err=None,
+                 name='', rest_wav=None, redshift=None, center_err=None, sigma_err=None, n_realisations=0):
+        self.line_wav = wavelength
+        self.params = tuple(params)
+        self.equivalent_width = eq_wid
+        self.max_flux = max_flux
+        self.total_flux = total_flux
+        self.equivalent_width_err = eq_wid_err
+        self.total_flux_err = total_flux_err
+        self.name = name
+        self.rest_wav = rest_wav
+        self.redshift = redshift
+        self.center_err = center_err
+        self.sigma_err = sigma_err
+        self.n_realisations = n_realisations
+
+    def profile(self, x):
+        return Eq.gaussian(np.asarray(x, dtype=float), *self.params)
+
+
+# ----------------------------
+# Loading
+# ----------------------------
+def object_name_from_path(filename):
+    '''
+    Files are named like J0742_Object.csv, so the object name is everything before _Object.
+    Anything else just falls back to the file name without its extension.
+    '''
+    base = os.path.basename(filename)
+    if base.endswith('_Object.csv'):
+        return base[:-len('_Object.csv')]
+    return os.path.splitext(base)[0]
+
+
+@profiling.profiled('read_spectrum')
+def read_spectrum(filename, cache=True):
+    '''
+    Reads a spectrum file with a title line (and optional '# start' line) followed by
+    whitespace separated wavelength and flux columns.
+    Returns two contiguous float64 numpy arrays, memory mapped from the binary sidecar when cache=True.
+    '''
+    return spectrum_io.load_spectrum(filename, cache=cache)
+
+
+@profiling.profiled('load_spectrum')
+def load_spectrum(filename, dtype=np.float64, cache=True):
+    '''
+    Like read_spectrum, but returns a compact spectrum.Spectrum (uniform grids are stored as start/step/n).
+    '''
+    return spectrum.Spectrum.from_file(filename, name=object_name_from_path(filename), dtype=dtype, cache=cache)
+
+
+# ----------------------------
+# Continuum
+# ----------------------------
+@profiling.profiled('define_continuum')
+def define_continuum(wavelengths, fluxes, window=200., percentile=50., first_order=3, final_order=5,
+                     upper_sigma=2.5, lower_sigma=3., basis='legendre', cache=None, **kwargs):
+    '''
+    Takes a running median of every pixel over 200 Angstrom windows (one robust sample every 25 Angstroms)
+    and fits a third order polynomial to the samples.
+    It then removes every sample more than 2.5 sigma above or 3 sigma below a fifth order fit,
+    refitting until no more samples change, so emission lines and absorption troughs drop out.
+    All the knobs (window, percentile, orders, clip thresholds, Legendre or spline basis) are in continuum.fit_continuum.
+    With a fit_cache.ResultCache, the same fluxes and options return the stored fit.
+    Returns a ContinuumFit.
+    '''
+    options = dict(window=window, percentile=percentile, first_order=first_order, final_order=final_order,
+                   upper_sigma=upper_sigma, lower_sigma=lower_sigma, basis=basis, **kwargs)
+    if cache is not None:
+        return cache.call('fit_continuum', continuum.fit_continuum, wavelengths, fluxes, **options)
+    return continuum.fit_continuum(wavelengths, fluxes, **options)
+
+
+@profiling.profiled('define_continua')
+def define_continua(spectra, **kwargs):
+    '''
+    define_continuum for a list of spectrum.Spectrum objects. Spectra on the same wavelength grid
+    are stacked and fit together in one continuum.fit_continua call (shared design matrix, batched solves).
+    kwargs are the same options as define_continuum. Returns the ContinuumFits in the order given.
+    '''
+    groups = {}
+    for i, spec in enumerate(spectra):
+        groups.setdefault(spectrum.grid_key(spec.wavelengths), []).append(i)
+
+    fits = [None] * len(spectra)
+    for indices in groups.values():
+        fluxes = np.stack([spectra[i].fluxes for i in indices])
+        for i, fit in zip(indices, continuum.fit_continua(spectra[indices[0]].wavelengths, fluxes, **kwargs)):
+            fits[i] = fit
+    return fits
+
+
+def subtract_continuum(wavelengths, fluxes, continuum):
+    '''
+    The spectrum minus a continuum fit at every pixel. Returns (wavelengths, fluxes) like resample.smooth_and_rebin,
+    so it can be a history.SpectrumHistory step.
+    '''
+    return wavelengths, np.asarray(fluxes, dtype=np.float64) - continuum
+
+
+# ----------------------------
+# Noise
+# ----------------------------
+def estimate_noise(wavelengths, fluxes, cache=None):
+    '''
+    The spectrum's per-pixel noise (noise.noise_map), to be worked out once and handed to every fit that needs it.
+    With a fit_cache.ResultCache, the same fluxes return the stored map.
+    '''
+    if cache is not None:
+        return cache.call('noise_map', noise_module.noise_map, wavelengths, fluxes)
+    return noise_module.noise_map(wavelengths, fluxes)
+
+
+# ----------------------------
+# Line fitting
+# ----------------------------
+@profiling.profiled('fit_spectral_lines')
+def fit_spectral_lines(wavelengths, fluxes, continuum, xclicks, search_width=15, linewidth=None, noise=None,
+                       realisations=0, seed=0, cache=None):
+    '''
+    Fits every line in xclicks at once.
+    For each click, finds the maximum flux within search_width pixels to define the peak of the line,
+    subtracts the continuum around the peak, and fits a Gaussian to the residuals.
+    The window follows the line out to where the residual drops back into the noise (noise.line_bounds),
+    using the per-pixel noise map (estimate_noise, computed here unless given), so narrow lines get a few pixels
+    and broad lines all of their wings. With linewidth set, the old fixed window of linewidth pixels
+    either side of the peak is used instead.
+    All the windows are fit together by gaussian_fit.fit_gaussians (vectorized Levenberg-Marquardt).
+    Total flux and equivalent width come from the fit parameters in closed form (see line_measure),
+    so they cover the whole profile even when the line is wider than the window.
+    Errors come from the fit covariance, or with realisations > 0 from that many noise realisations of every
+    window refit in one batch (line_errors.monte_carlo_errors, reproducible for a given seed).
+
+    wavelengths may be a spectrum.UniformGrid, in which case the pixel lookups are arithmetic.
+    With a fit_cache.ResultCache, the noise map is kept per spectrum and fits are keyed on the peaks and windows
+    the clicks land on (plus the fluxes and continuum), so clicking the same line again is instant even if the
+    click moved a little.
+    Returns (lines, windows, result):
+    - lines: a SpectralLine per click, or None where the fit didn't converge
+    - windows: (xdata, cont_subtracted_fluxes) per click, for plotting
+    - result: the gaussian_fit.GaussianFitResult with parameters, covariances and convergence flags
+    '''
+    if not isinstance(wavelengths, spectrum.UniformGrid):
+        wavelengths = np.asarray(wavelengths, dtype=float)
+    fluxes = np.asarray(fluxes, dtype=float)
+    continuum = np.asarray(continuum, dtype=float)
+    n = len(fluxes)
+
+    # This section searches for the nearest local maximum, for every click at once
+    line_index = np.atleast_1d(spectrum.searchsorted(wavelengths, np.asarray(xclicks, dtype=float)))
+    cols = line_index[:, None] + np.arange(-search_width, search_width)
+    valid = (cols >= 0) & (cols < n)
+    max_wavelength_index = cols[np.arange(len(cols)), np.argmax(np.where(valid, fluxes[np.clip(cols, 0, n - 1)], -np.inf), axis=1)]
+
+    if noise is None and (linewidth is None or realisations):
+        noise = estimate_noise(wavelengths, fluxes, cache)
+    if linewidth is not None:
+        lo, hi = max_wavelength_index - linewidth, max_wavelength_index + linewidth - 1
+    else:
+        lo, hi = noise_module.line_bounds(fluxes - continuum, noise, max_wavelength_index)
+
+    args = (wavelengths, fluxes, continuum, max_wavelength_index, lo, hi)
+    if realisations:
+        args += (noise, realisations, seed)
+    if cache is not None:
+        return cache.call('fit_line_windows', _fit_line_windows, *args)
+    return _fit_line_windows(*args)
+
+
+def _fit_line_windows(wavelengths, fluxes, continuum, max_wavelength_index, lo, hi, noise=None, realisations=0, seed=0):
+    '''
+    Second half of fit_spectral_lines, once the peak and window (pixels lo to hi inclusive) of every line are known.
+    '''
+    n = len(fluxes)
+
+    # Windows padded to the widest one, masked past each line's own end and where they run off the spectrum
+    width = int((hi - lo).max()) + 1 if len(lo) else 0
+    cols = lo[:, None] + np.arange(width)
+    mask = (cols <= hi[:, None]) & (cols >= 0) & (cols < n)
+    cols = np.clip(cols, 0, n - 1)
+    xdata = spectrum.take(wavelengths, cols)
+    cont_subtracted_fluxes = fluxes[cols] - continuum[cols]
+    result = gaussian_fit.fit_gaussians(xdata, cont_subtracted_fluxes, mask=mask)
+
+    # Now we calculate the total flux and equivalent width of every line in one go
+    measured = line_measure.measure_lines(result.params, wavelengths, continuum, result.covariance)
+    center_err, sigma_err = result.errors[:, 1], result.errors[:, 2]
+    if realisations:
+        errors = line_errors.monte_carlo_errors(xdata, cont_subtracted_fluxes, mask, result.params, noise[cols],
+                                                wavelengths, continuum, realisations, seed)
+        measured.flux_err, measured.eq_wid_err = errors.flux_err, errors.eq_wid_err
+        center_err, sigma_err = errors.center_err, errors.sigma_err
+
+    lines = []
+    windows = []
+    for i, peak in enumerate(max_wavelength_index):
+        x, resid = xdata[i][mask[i]], cont_subtracted_fluxes[i][mask[i]]
+        windows.append((x, resid))
+        if not result.converged[i]:
+            lines.append(None)
+            continue
+        lines.append(SpectralLine(wavelength=wavelengths[peak], params=result.params[i],
+                                  eq_wid=measured.eq_wid[i], max_flux=fluxes[peak], total_flux=measured.flux[i],
+                                  eq_wid_err=measured.eq_wid_err[i], total_flux_err=measured.flux_err[i],
+                                  center_err=center_err[i], sigma_err=sigma_err[i], n_realisations=realisations))
+    return lines, windows, result
+
+
+def fit_spectral_line(wavelengths, fluxes, continuum, xclick, search_width=15, linewidth=None, noise=None,
+                      realisations=0, seed=0, cache=None):
+    '''
+    Single click version of fit_spectral_lines.
+    Raises RuntimeError if the fit doesn't converge.
+    Returns (SpectralLine, xdata, cont_subtracted_fluxes) so callers can plot the window that was fit.
+    '''
+    lines, windows, _ = fit_spectral_lines(wavelengths, fluxes, continuum, [xclick], search_width, linewidth, noise,
+                                           realisations, seed, cache)
+    if lines[0] is None:
+        raise RuntimeError(f'Gaussian fit near {xclick} did not converge')
+    return (lines[0],) + windows[0]
+
+
+# ----------------------------
+# Catalogs
+# ----------------------------
+def line_catalog_table(line_catalog):
+    '''
+    Builds a fresh PrettyTable of a list of SpectralLines or a line_catalog.LineCatalog.
+    '''
+    if not isinstance(line_catalog, line_catalog_module.LineCatalog):
+        rows = line_catalog_module.lines_to_rows(line_catalog)
+    else:
+        rows = line_catalog.rows
+    from prettytable import PrettyTable  # only needed for printing, so not imported with the module
+    table = PrettyTable()
+    table.field_names = CATALOG_FIELDS
+    for row in rows:
+        table.add_row([row['wavelength'], row['eq_wid'], row['peak_flux'], row['total_flux']])
+    return table
+
+
+def catalog_path(object_name, directory="./Line Catalogs/"):
+    '''
+    Where an object's catalog goes, without extension: CatalogWriter adds .csv and .cols.
+    '''
+    return os.path.join(directory, f'{object_name} Line Catalog')
+
+
+@profiling.profiled('write_line_catalog')
+def write_line_catalog(object_name, line_catalog, directory="./Line Catalogs/", columnar=False):
+    '''
+    Saves the emission line data (SpectralLines, or line_catalog.LINE_DTYPE rows) as a space delimited .csv
+    named after the object (plus the binary columnar copy with columnar=True). Returns the path of the .csv.
+    '''
+    if not isinstance(line_catalog, np.ndarray):
+        line_catalog = line_catalog_module.lines_to_rows(line_catalog, object_name)
+    with line_catalog_module.CatalogWriter(catalog_path(object_name, directory), columnar=columnar) as writer:
+        writer.write(line_catalog)
+    return writer.csv_path
+
+
+# ----------------------------
+# Whole-object reduction
+# ----------------------------
+def reduce_spectrum(filename, line_wavelengths=(), output_dir=None, auto_lines=False, continuum_options=None,
+                    continuum_fit=None, cache=None, realisations=0, state=None):
+    '''
+    Runs the full load -> continuum -> line fits chain on one file, with no GUI.
+    line_wavelengths are observed wavelengths to fit, i.e. where one would have clicked.
+    With auto_lines, the redshift is found by cross-correlation and every expected quasar line is fit as well.
+    Lines that fail to fit (or, for automatic lines, land on some other feature) are skipped and reported in the
+    returned errors list, and so is a redshift that redshift.auto_fit_lines doesn't trust (no automatic lines then).
+    continuum_options are passed on to define_continuum, unless a precomputed continuum_fit
+    (e.g. from define_continua) is given. cache is an optional fit_cache.ResultCache for the fits.
+    realisations > 0 gives every line Monte Carlo errors from that many noise realisations (see fit_spectral_lines).
+    If output_dir is given, the object's line catalog is written there too.
+
+    state is a session.SessionObject to work on instead of loading filename (e.g. an object of a session saved from
+    the GUI): its current data is reduced as it stands, its continuum is used if it has one, and the new lines go
+    after the ones it already has, replacing any they are refits of (line_catalog.merge_rows), so reducing a session
+    again doesn't list its lines twice. The continuum and every line, old and new, are stored back on it.
+
+    Returns (object_name, line_catalog, errors, redshift_result), where line_catalog only holds the lines fit here
+    and redshift_result is the redshift.RedshiftResult (None without auto_lines).
+    '''
+    # Every stage below is profiled under this object's name
+    with profiling.stage('reduce_spectrum', state.name if state is not None else object_name_from_path(filename)):
+        if state is None:
+            spec = load_spectrum(filename)
+            object_name, wavelengths, fluxes = spec.name, spec.wavelengths, spec.fluxes
+        else:
+            object_name, wavelengths, fluxes = state.name, state.wavelengths, state.fluxes
+            continuum_fit = state.continuum if continuum_fit is None else continuum_fit
+        if continuum_fit is None:
+            continuum_fit = define_continuum(wavelengths, fluxes, cache=cache, **(continuum_options or {}))
+
+        line_catalog = []
+        errors = []
+        z_result = None
+        # One noise map serves the clicked and the automatic lines
+        noise = estimate_noise(wavelengths, fluxes, cache) if len(line_wavelengths) or auto_lines else None
+        if len(line_wavelengths):
+            lines, _, _ = fit_spectral_lines(wavelengths, fluxes, continuum_fit.continuum, line_wavelengths,
+                                             noise=noise, realisations=realisations, cache=cache)
+            for xclick, line in zip(line_wavelengths, lines):
+                if line is None:
+                    errors.append(f'{object_name}: line near {xclick} failed (fit did not converge)')
+                else:
+                    line_catalog.append(line)
+
+        if auto_lines:
+            import redshift  # redshift builds on this module, so it can't be imported at the top
+            z_result, lines, _, failed = redshift.auto_fit_lines(wavelengths, fluxes, continuum_fit.continuum, cache=cache,
+                                                                 realisations=realisations, noise=noise)
+            line_catalog.extend(lines)
+            if z_result.problem:
+                errors.append(f'{object_name}: no automatic lines, {z_result.problem}')
+            for name, observed, reason in failed:
+                errors.append(f'{object_name}: {name} near {observed:.1f} failed ({reason})')
+
+        rows = line_catalog_module.lines_to_rows(line_catalog, object_name)
+        if state is not None:
+            state.continuum = continuum_fit
+            state.lines = rows = line_catalog_module.merge_rows(state.lines, rows)
+        if output_dir is not None:
+            write_line_catalog(object_name, rows, output_dir)
+    return object_name, line_catalog, errors, z_result
@@ -0,0 +1,240 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Compact spectrum container.
+Every example file sits on a uniform grid (3400.00 + 1.5*i Angstroms), so there is no reason to
+hold a whole wavelength array in memory. A UniformGrid stores only (start, step, n), behaves like
+a read-only array when it needs to, and turns wavelength -> pixel lookups into arithmetic.
+Non-uniform grids fall back to a plain explicit array.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import numpy as np
+
+import spectrum_io
+# ----------------------------
+
+
+# ----------------------------
+# Wavelength grids
+# ----------------------------
+class UniformGrid():
+    '''
+    Wavelengths start + step * i for i in range(n).
+    Indexing with an int gives a float, slicing gives another UniformGrid (so [::2] stays compact),
+    and numpy functions see a normal float64 array through __array__.
+    '''
+
+    __slots__ = ('start', 'step', 'n')
+
+    def __init__(self, start, step, n):
+        self.start = float(start)
+        self.step = float(step)
+        self.n = int(n)
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f'UniformGrid(start={self.start}, step={self.step}, n={self.n})'
+
+    def __eq__(self, other):
+        if isinstance(other, UniformGrid):
+            return (self.start, self.step, self.n) == (other.start, other.step, other.n)
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((self.start, self.step, self.n))
+
+    @property
+    def shape(self):
+        return (self.n,)
+
+    @property
+    def nbytes(self):
+        return 0
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            lo, hi, stride = key.indices(self.n)
+            return UniformGrid(self.start + lo * self.step, self.step * stride, len(range(lo, hi, stride)))
+        if np.ndim(key) == 0:
+            i = int(key)
+            if i < 0:
+                i += self.n
+            if not 0 <= i < self.n:
+                raise IndexError(f'index {key} is out of bounds for a grid of {self.n} pixels')
+            return self.start + i * self.step
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self.start + self.step * np.arange(self.n, dtype=np.float64)
+        return out if dtype is None else out.astype(dtype, copy=False)
+
+    def to_array(self):
+        return np.asarray(self)
+
+    def searchsorted(self, x):
+        '''
+        Same answer as np.searchsorted(wavelengths, x) (left side), but O(1).
+        Works on scalars and arrays.
+        '''
+        pos = (np.asarray(x, dtype=np.float64) - self.start) / self.step
+        # Points that land on the grid up to floating point noise belong to that pixel, like searchsorted says
+        idx = np.ceil(pos - 1e-9)
+        idx = np.clip(idx, 0, self.n).astype(np.intp)
+        return int(idx) if idx.ndim == 0 else idx
+
+    def take(self, indices):
+        '''
+        Wavelengths at an array of pixel indices, without building the whole grid.
+        '''
+        return self.start + self.step * np.asarray(indices, dtype=np.float64)
+
+    def index_of(self, x):
+        '''
+        Index of the pixel nearest to wavelength x, clipped to the grid.
+        '''
+        idx = np.clip(np.rint((np.asarray(x, dtype=np.float64) - self.start) / self.step), 0, self.n - 1).astype(np.intp)
+        return int(idx) if idx.ndim == 0 else idx
+
+
+def detect_uniform_grid(wavelengths, rtol=1e-3, atol=0.011):
+    '''
+    Returns a UniformGrid if every wavelength is within max(rtol*step, atol) of start + step*i, otherwise None.
+    The text files round wavelengths to 0.01 Angstrom, so each is up to 0.005 off the true grid, and start and step
+    (taken from the first and last wavelengths) are rounded too: the misfit can approach 0.01, which atol covers
+    (on the 1.5 Angstrom grid rtol*step alone is only 0.0015). atol is capped at a quarter step so a fine grid
+    can't pass with pixels out of place.
+    '''
+    if isinstance(wavelengths, UniformGrid):
+        return wavelengths
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    n = len(wavelengths)
+    if n < 2:
+        return None
+    start = wavelengths[0]
+    step = (wavelengths[-1] - start) / (n - 1)
+    if step <= 0:
+        return None
+    tolerance = max(rtol * step, min(atol, step / 4))
+    # Chunked so a multi-million pixel check doesn't allocate a second full array
+    chunk = 1 << 20
+    for lo in range(0, n, chunk):
+        i = np.arange(lo, min(lo + chunk, n), dtype=np.float64)
+        if np.max(np.abs(wavelengths[lo:lo + chunk] - (start + step * i))) > tolerance:
+            return None
+    return UniformGrid(start, step, n)
+
+
+def grid_key(wavelengths):
+    '''
+    Hashable key that is equal for identical wavelength grids, so spectra can be grouped by grid.
+    '''
+    if isinstance(wavelengths, UniformGrid):
+        return wavelengths
+    return np.asarray(wavelengths, dtype=np.float64).tobytes()
+
+
+def searchsorted(wavelengths, x):
+    '''
+    np.searchsorted that takes the O(1) shortcut when the wavelengths are a UniformGrid.
+    '''
+    if isinstance(wavelengths, UniformGrid):
+        return wavelengths.searchsorted(x)
+    return np.searchsorted(wavelengths, x)
+
+
+def take(wavelengths, indices):
+    '''
+    wavelengths[indices] for either kind of grid.
+    '''
+    if isinstance(wavelengths, UniformGrid):
+        return wavelengths.take(indices)
+    return np.asarray(wavelengths)[indices]
+
+
+def interp(wavelengths, values, x):
+    '''
+    np.interp(x, wavelengths, values), done with index arithmetic for a UniformGrid.
+    Points off the ends take the end values, like np.interp.
+    '''
+    if not isinstance(wavelengths, UniformGrid):
+        return np.interp(x, wavelengths, values)
+    values = np.asarray(values)
+    pos = np.clip((np.asarray(x, dtype=np.float64) - wavelengths.start) / wavelengths.step, 0, wavelengths.n - 1)
+    lo = np.minimum(pos.astype(np.intp), max(wavelengths.n - 2, 0))
+    frac = pos - lo
+    hi = np.minimum(lo + 1, wavelengths.n - 1)
+    return values[lo] * (1 - frac) + values[hi] * frac
+
+
+# ----------------------------
+# Spectrum container
+# ----------------------------
+class Spectrum():
+    '''
+    A single spectrum.
+    - wavelengths: a UniformGrid when the grid is uniform, otherwise a float64 array
+    - fluxes: a contiguous float64 (or float32) array
+    '''
+
+    __slots__ = ('wavelengths', 'fluxes', 'name')
+
+    def __init__(self, wavelengths, fluxes, name='', dtype=np.float64, rtol=1e-3):
+        grid = detect_uniform_grid(wavelengths, rtol=rtol)
+        self.wavelengths = grid if grid is not None else np.ascontiguousarray(wavelengths, dtype=np.float64)
+        self.fluxes = np.ascontiguousarray(fluxes, dtype=dtype)
+        self.name = name
+        if len(self.wavelengths) != len(self.fluxes):
+            raise ValueError(f'{len(self.wavelengths)} wavelengths but {len(self.fluxes)} fluxes')
+
+    @classmethod
+    def from_file(cls, filename, name='', dtype=np.float64, cache=True):
+        wavelengths, fluxes = spectrum_io.load_spectrum(filename, cache=cache)
+        return cls(wavelengths, fluxes, name=name, dtype=dtype)
+
+    def __len__(self):
+        return len(self.fluxes)
+
+    def __repr__(self):
+        return f'Spectrum({self.name!r}, {self.wavelengths!r}, fluxes={self.fluxes.dtype}[{len(self.fluxes)}])'
+
+    @property
+    def is_uniform(self):
+        return isinstance(self.wavelengths, UniformGrid)
+
+    @property
+    def nbytes(self):
+        return self.fluxes.nbytes + (0 if self.is_uniform else self.wavelengths.nbytes)
+
+    def searchsorted(self, x):
+        return searchsorted(self.wavelengths, x)
+
+    def index_of(self, x):
+        '''
+        Index of the pixel nearest to wavelength x.
+        '''
+        if self.is_uniform:
+            return self.wavelengths.index_of(x)
+        w = self.wavelengths
+        idx = np.clip(np.searchsorted(w, x), 1, len(w) - 1)
+        idx = idx - ((np.asarray(x) - w[idx - 1]) < (w[idx] - np.asarray(x)))
+        return int(idx) if np.ndim(idx) == 0 else idx
+
+    def window(self, lo, hi):
+        '''
+        Pixels lo:hi as a new Spectrum sharing memory with this one.
+        '''
+        out = Spectrum.__new__(Spectrum)
+        out.wavelengths = self.wavelengths[lo:hi]
+        out.fluxes = self.fluxes[lo:hi]
+        out.name = self.name
+        return out
+
+    def wavelength_array(self):
+        return np.asarray(self.wavelengths, dtype=np.float64)
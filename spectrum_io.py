@@ -0,0 +1,135 @@
+'''
+Zachary Stevens
+Final Project - ASTR 5470
+Quasar Spectral Analysis in Python
+
+Spectrum file reading.
+Two header variants show up in the example files:
+
+    Wavelength (Angstroms) Flux (erg/s/cm2/A)          "Wavelength (Angstroms)" "Flux (erg/s/cm2/A)"
+    # start                                            3400.00 0
+    3400.00 0                                          3401.50 "3.0632e-16 "
+    ...                                                ...
+
+Both are parsed straight into float64 NumPy arrays (no DataFrame), and the result is saved to a
+binary .npy sidecar so that opening the same object again is just a memory map.
+The sidecar is keyed on the source file's size and modification time, so editing the file invalidates it.
+'''
+
+# ----------------------------
+# Import statements
+# ----------------------------
+import os
+import glob
+import numpy as np
+# ----------------------------
+
+
+CACHE_DIR_NAME = '.spectrum_cache'
+
+
+# ----------------------------
+# Parsing
+# ----------------------------
+def _is_data_line(line):
+    '''
+    True if the first two whitespace separated tokens of a line are both numbers (quotes allowed).
+    '''
+    tokens = line.replace('"', ' ').split()
+    if len(tokens) < 2:
+        return False
+    try:
+        float(tokens[0])
+        float(tokens[1])
+    except ValueError:
+        return False
+    return True
+
+
+def count_header_lines(filename, max_lines=20):
+    '''
+    Counts the lines before the first wavelength/flux pair.
+    That is 2 for the title + '# start' files, 1 for the quoted-title files, and 0 for bare columns.
+    '''
+    with open(filename, 'r') as f:
+        for n, line in enumerate(f):
+            if n >= max_lines:
+                break
+            if _is_data_line(line):
+                return n
+    raise ValueError(f"{filename} doesn't look like a two column spectrum file")
+
+
+def parse_spectrum(filename):
+    '''
+    Parses a spectrum text file into a C-contiguous (2, n) float64 array: row 0 is wavelength, row 1 is flux.
+    Each row is itself contiguous, so wavelengths and fluxes can be handed out as views.
+    '''
+    skiprows = count_header_lines(filename)
+    data = np.loadtxt(filename, skiprows=skiprows, comments='#', quotechar='"', usecols=(0, 1), ndmin=2, dtype=np.float64)
+    return np.ascontiguousarray(data.T)
+
+
+# ----------------------------
+# Sidecar cache
+# ----------------------------
+def sidecar_path(filename, cache_dir=None):
+    '''
+    Path of the sidecar for the current version of filename.
+    The size and mtime are baked into the name, so a stale sidecar simply never matches.
+    By default sidecars live in a .spectrum_cache folder next to the source file.
+    '''
+    st = os.stat(filename)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), CACHE_DIR_NAME)
+    base = os.path.basename(filename)
+    return os.path.join(cache_dir, f'{base}.{st.st_size}-{st.st_mtime_ns}.npy')
+
+
+def _write_sidecar(path, data):
+    '''
+    Writes the sidecar atomically and removes any older sidecars of the same source file.
+    Failures (read-only directories etc.) are not fatal, we just don't get a cache.
+    '''
+    directory = os.path.dirname(path)
+    source_name = os.path.basename(path).rsplit('.', 2)[0]
+    try:
+        os.makedirs(directory, exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, path)
+        for old in glob.glob(os.path.join(glob.escape(directory), glob.escape(source_name) + '.*.npy')):
+            if old != path:
+                os.remove(old)
+    except OSError:
+        pass
+
+
+def load_spectrum_array(filename, cache=True, cache_dir=None, mmap=True):
+    '''
+    Returns the (2, n) float64 array for filename.
+    With cache=True an up to date sidecar is memory mapped (read only) if it exists,
+    otherwise the text is parsed and a sidecar is written for next time.
+    '''
+    if not cache:
+        return parse_spectrum(filename)
+
+    path = sidecar_path(filename, cache_dir)
+    if os.path.exists(path):
+        try:
+            return np.load(path, mmap_mode='r' if mmap else None)
+        except (OSError, ValueError):
+            pass  # half written or corrupt, just reparse
+
+    data = parse_spectrum(filename)
+    _write_sidecar(path, data)
+    return data
+
+
+def load_spectrum(filename, cache=True, cache_dir=None, mmap=True):
+    '''
+    Returns (wavelengths, fluxes) as contiguous float64 arrays.
+    '''
+    data = load_spectrum_array(filename, cache=cache, cache_dir=cache_dir, mmap=mmap)
+    return data[0], data[1]